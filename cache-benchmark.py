@@ -0,0 +1,53 @@
+from django.core.management import setup_environ
+import settings, sys, os, time, shutil, tempfile
+
+setup_environ(settings)
+
+from results.Pipeline import Pipeline
+from results.Cache import CacheClass
+
+# Benchmarks reading and writing the results of pipelines to the cache with
+# each codec, reporting the latency and the space saved against storing them
+# uncompressed.
+
+CODECS = [('none', 0), ('zlib', 1), ('zlib', 6), ('zlib', 9), ('bz2', 1), ('bz2', 9)]
+REPEATS = 3
+
+def benchmark(value, codec, level):
+    """ Returns the best write and read times in seconds for the value, and
+        the size of its cache file in bytes. """
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = CacheClass(cache_dir, {'codec': codec, 'level': level})
+        writes = []
+        reads = []
+        for i in range(REPEATS):
+            started = time.time()
+            cache.set('benchmark', value)
+            writes.append(time.time() - started)
+            started = time.time()
+            cache.get('benchmark')
+            reads.append(time.time() - started)
+        size = os.path.getsize(cache._key_to_file('benchmark'))
+    finally:
+        shutil.rmtree(cache_dir)
+    return min(writes), min(reads), size
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Usage: python cache-benchmark.py pipeline [pipeline ...]"
+        sys.exit(1)
+
+    for encoded in sys.argv[1:]:
+        p = Pipeline()
+        p.decode(encoded)
+        p.apply()
+        value = {'data_table': p.dataTable}
+        print "%s (%d rows)" % (encoded, len(p.dataTable.rows))
+        print "  %-6s %5s %10s %10s %12s %8s" % ('codec', 'level', 'write ms', 'read ms', 'bytes', 'saved')
+        baseline = None
+        for (codec, level) in CODECS:
+            (write, read, size) = benchmark(value, codec, level)
+            if baseline is None:
+                baseline = size
+            print "  %-6s %5d %10.1f %10.1f %12d %7.1f%%" % (codec, level, write * 1000, read * 1000, size, 100.0 * (baseline - size) / baseline)
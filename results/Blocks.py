@@ -5,9 +5,9 @@ which it describes.
 """
 
 import math, copy, os, time
-import subprocess
-from plotty.results.DataTypes import DataRow, DataAggregate, ScenarioValue
-from plotty.results.Utilities import present_scenario, present_scenario_csv, present_value, present_value_csv_graph, scenario_hash
+import subprocess, heapq, functools, random
+from plotty.results.DataTypes import DataRow, DataAggregate, ScenarioValue, divide_all, bootstrap_all
+from plotty.results.Utilities import present_scenario, present_scenario_csv, present_value, present_value_csv_graph, scenario_hash, scenario_sort_key, quantile, welch_t_test, mann_whitney_u, measure, measured
 from plotty.results.Exceptions import PipelineAmbiguityException, PipelineError, PipelineBlockException
 import plotty.results.PipelineEncoder as PipelineEncoder
 from plotty.results.models import *
@@ -19,8 +19,27 @@ import re
 class Block(object):
     """ The base object for blocks. Defines methods all blocks should implement.
     """
+
+    # Row-local blocks only ever look at (and change) one row at a time, so
+    # they can also be applied through prepare(), applyRow() and finish().
+    # The pipeline uses this to fuse consecutive row-local blocks into a
+    # single pass over the rows.
+    ROW_LOCAL = False
+
+    # Indexed blocks find the rows they keep through the table's indexes in
+    # apply(), without looking at every row. A fused run that starts with
+    # one applies it first and passes only the rows it keeps through the
+    # rest of the run.
+    INDEXED = False
+
     def __init__(self):
         self.flags = 0
+        # The number of groups the last apply() formed, for blocks that
+        # group rows
+        self.group_count = None
+        # (name, note, cost) for the steps of the last apply() that are
+        # worth timing on their own, with costs from Utilities.measured
+        self.timings = []
     
     def decode(self, param_string, cache_key):
         """ Decodes a paramater string and stores the configuration in local
@@ -31,12 +50,70 @@ class Block(object):
             caching results or calculations for reuse. """
         pass
     
+    def canonical(self, param_string):
+        """ Returns the paramater string decode was given, in a canonical form
+            that is the same for every paramater string configuring this
+            block to do the same thing, for use in cache keys. By default,
+            only the flagword is normalised. """
+        parts = param_string.split(PipelineEncoder.GROUP_SEPARATOR)
+        parts[0] = str(self.flags)
+        return PipelineEncoder.GROUP_SEPARATOR.join(parts)
+
     def apply(self, data_table, messages):
         """ Apply this block to the data_table. data_table is passed by reference,
             so this method does not return.
 
             Can throw PipelineAmbiguityException or PipelineBlockException. """
         pass
+
+    def prepare(self, data_table, messages):
+        """ For row-local blocks, check this block's columns against the
+            data_table and update its columns, before any rows are seen.
+
+            Can throw PipelineError. """
+        pass
+
+    def applyRow(self, row):
+        """ For row-local blocks, apply this block to a single row. Rows are
+            never modified, so this returns a new row if the row changes,
+            the row itself if not, or None if it should be thrown out. """
+        return row
+
+    def finish(self, data_table, messages):
+        """ For row-local blocks, called once applyRow has seen every row. """
+        pass
+
+    def commutesWith(self, block, data_table):
+        """ Returns True if block, which follows this one in the pipeline,
+            can be applied before this one to the data_table without changing
+            the result (or the exceptions thrown). Blocks that return True
+            must also implement scenarioValuesAfter. """
+        return False
+
+    def scenarioValuesAfter(self, data_table):
+        """ Returns the scenario values that applying this block to the
+            data_table would leave, as a dictionary mapping each column to a
+            set of values, without changing the data_table. Throws whatever
+            apply would. """
+        raise NotImplementedError
+
+    def estimate(self, stats):
+        """ Estimates the effect of this block without applying it, for
+            explaining a pipeline. stats describes the table the block would
+            be applied to, as returned by DataTable.columnStatistics.
+            Returns the stats of the table the block would leave, and the
+            number of groups it would form (or None). Estimates assume that
+            columns are independent and that their values are equally common.
+            By default, a block is assumed to change nothing. """
+        return stats, None
+
+    def estimateGroups(self, stats, columns):
+        """ Estimates the number of distinct combinations of values the given
+            scenario columns take. """
+        groups = 1
+        for col in columns:
+            groups *= stats['scenario'].get(col, 1)
+        return max(1, min(stats['rows'], groups))
     
     def getFlag(self, flag):
         """ Get a flag's value """
@@ -45,10 +122,14 @@ class Block(object):
 class FormatBlock(Block):
     """ Adds configured formatting information to the table for a specified column. """
 
+    ROW_LOCAL = True
+
     def __init__(self):
         super(FormatBlock, self).__init__()
         self.column = None
         self.key = None
+        self.styles = {}
+        self.missing = set()
 
     def decode(self, param_string, cache_key):
         """ Decode a format block from an encoded pipeline string.
@@ -74,40 +155,62 @@ class FormatBlock(Block):
     def apply(self, data_table, messages):
         """ Apply this block to the given data table.
         """
+        self.prepare(data_table, messages)
+        if self.column != '<VALUES>':
+            data_table.replaceRows(dict([(i, self.applyRow(row)) for (i, row) in zip(data_table.rowIds(), data_table)]))
+        self.finish(data_table, messages)
+
+    def prepare(self, data_table, messages):
+        """ Check the column and load the style, and format the value columns
+            if they are the ones being formatted.
+        """
         isValues = self.column == '<VALUES>'
         if not (isValues or self.column in data_table.scenarioColumns):
             raise PipelineError("Invalid column specified for block")
 
-        styles = {}
+        self.styles = {}
+        self.missing = set()
 
         try:
             style = FormatStyle.objects.get(key=self.key);
             for dbe in FormatStyleEntry.objects.filter(formatstyle=style).order_by('index').all():
-                styles[dbe.value] = ScenarioValue(dbe.index, dbe.value, dbe.display, dbe.group, dbe.color)
+                self.styles[dbe.value] = ScenarioValue(dbe.index, dbe.value, dbe.display, dbe.group, dbe.color)
         except:
             raise PipelineError("Error loading style")
 
-        missing = set()
         if isValues:
             for valCol in data_table.valueColumns:
-                if valCol not in styles:
-                    missing.add(valCol)
+                if valCol not in self.styles:
+                    self.missing.add(valCol)
                 else:
-                    data_table.valueColumnsDisplay[valCol] = styles[valCol];
-        else:
-            for row in data_table:
-                val = row.scenario[self.column]
-                if val not in styles:
-                    missing.add(val)
-                else:
-                    row.scenario[self.column] = styles[val]
+                    data_table.valueColumnsDisplay[valCol] = self.styles[valCol];
 
-        for m in missing:
+    def applyRow(self, row):
+        """ Format the configured scenario column of a single row.
+        """
+        if self.column == '<VALUES>':
+            return row
+        val = row.scenario[self.column]
+        if val not in self.styles:
+            self.missing.add(val)
+            return row
+        scenario = dict(row.scenario)
+        scenario[self.column] = self.styles[val]
+        return DataRow(scenario, row.values)
+
+    def finish(self, data_table, messages):
+        """ Warn about any values the style had no entry for.
+        """
+        if self.column != '<VALUES>':
+            data_table.invalidateIndexes([self.column])
+        for m in self.missing:
             messages.warn("Format missing entry for %s value %s" % (self.column, m))
 
 class CompositeScenarioBlock(Block):
     """ Allows the introduction of new, logical scenario columns based on existing columns. """
 
+    ROW_LOCAL = True
+
     def __init__(self):
         """ Define the single instance variable of a CompositeScenarioBlock.
         
@@ -116,6 +219,7 @@ class CompositeScenarioBlock(Block):
         super(CompositeScenarioBlock, self).__init__()
 
         self.columns = []
+        self.composite_col = None
 
 
     def decode(self, param_string, cache_key):
@@ -141,27 +245,60 @@ class CompositeScenarioBlock(Block):
     def apply(self, data_table, messages):
         """ Apply this block to the given data table.
         """
+        self.prepare(data_table, messages)
+        data_table.replaceRows(dict([(i, self.applyRow(row)) for (i, row) in zip(data_table.rowIds(), data_table)]))
+        self.finish(data_table, messages)
+
+    def prepare(self, data_table, messages):
+        """ Replace the combined scenario columns with the composite column.
+        """
         for col in self.columns:
             if not col in data_table.scenarioColumns:
                 raise PipelineError("Invalid columns specified for block")
             data_table.scenarioColumns.remove(col)
+        self.composite_col = '-'.join(self.columns)
+        data_table.scenarioColumns.add(self.composite_col)
 
-        composite_col = '-'.join(self.columns)
-        for row in data_table:
-            row.scenario[composite_col] = ScenarioValue('-'.join(ScenarioValue(row.scenario[x]).value for x in self.columns))
-            for col in self.columns:
-                del row.scenario[col]
+    def applyRow(self, row):
+        """ Combine the columns of a single row.
+        """
+        scenario = dict(row.scenario)
+        scenario[self.composite_col] = ScenarioValue('-'.join(ScenarioValue(row.scenario[x]).value for x in self.columns))
+        for col in self.columns:
+            del scenario[col]
+        return DataRow(scenario, row.values)
+
+    def finish(self, data_table, messages):
+        """ Throw away the indexes on the columns that changed.
+        """
+        data_table.invalidateIndexes(self.columns + [self.composite_col])
 
-        data_table.scenarioColumns.add(composite_col) 
+    def estimate(self, stats):
+        new_stats = copy.deepcopy(stats)
+        for col in self.columns:
+            new_stats['scenario'].pop(col, None)
+        new_stats['scenario']['-'.join(self.columns)] = self.estimateGroups(stats, self.columns)
+        return new_stats, None
 
 class FilterBlock(Block):
     """ Filters the datatable by including or excluding particular rows based
         on criteria. The rows that do not match every filter are thrown out 
-        (that is, the list of filters is ANDed together). """
+        (that is, the list of filters is ANDed together), unless the
+        MATCH_ANY flag is set, in which case rows that match at least one
+        filter are kept (the filters are ORed together). """
+
+    ROW_LOCAL = True
+    INDEXED = True
 
     TYPE = {
         'IS': '1',
-        'IS_NOT': '2'
+        'IS_NOT': '2',
+        'IN': '3',
+        'NOT_IN': '4'
+    }
+
+    FLAGS = {
+        'MATCH_ANY': 1 << 0
     }
 
     def __init__(self):
@@ -169,23 +306,27 @@ class FilterBlock(Block):
         
         filters:  An array of dictionaries describing the filters to be applied.
         Each filter has three properties:
-         * column -- the scenario column to be checked (string)
-         * value  -- the value the specified scenario column should
-                     take
-         * is     -- if true, each row must have the specified scenario
-                     column set to the specified value. If false, each
-                     row must *not* have the specified column set to
-                     the specified value.
+         * scenario -- the scenario column to be checked (string)
+         * values   -- the set of values the specified scenario column
+                       should take (a single value for IS and IS_NOT
+                       filters)
+         * is       -- if true, each row must have the specified scenario
+                       column set to one of the specified values. If
+                       false, each row must *not* have the specified column
+                       set to any of the specified values.
         """
         super(FilterBlock, self).__init__()
 
         self.filters = []
+        self.removed_scenario_cols = set()
 
 
     def decode(self, param_string, cache_key):
         """ Decode a filter block from an encoded pipeline string.
             Filter blocks are encoded in the form:
             filter1scenario^filter1is^filter1value&filter2scenario^...
+            For IN and NOT_IN filters, the value is a list of values
+            separated by the tuple separator (value1;value2;value3).
         """
         parts = param_string.split(PipelineEncoder.GROUP_SEPARATOR)
         # There must be at least two - a flagword and one filter
@@ -201,58 +342,157 @@ class FilterBlock(Block):
             if len(settings) != 3:
                 logging.debug("Filter invalid: not enough parts in %s" % filt_str)
                 continue
+            if settings[1] in (FilterBlock.TYPE['IN'], FilterBlock.TYPE['NOT_IN']):
+                values = set(settings[2].split(PipelineEncoder.TUPLE_SEPARATOR))
+            else:
+                values = set([settings[2]])
             self.filters.append({
                 'scenario': settings[0],
-                'is':       (settings[1] == FilterBlock.TYPE['IS']),
-                'value':    settings[2]
+                'is':       (settings[1] in (FilterBlock.TYPE['IS'], FilterBlock.TYPE['IN'])),
+                'values':   values
             })
 
+    def canonical(self, param_string):
+        """ The filters are sorted, with their values, and a filter on a
+            single value is always IS (or IS_NOT). MATCH_ANY makes no
+            difference to a single filter (or none), so it is cleared. """
+        flags = self.flags
+        if len(self.filters) <= 1:
+            flags &= ~FilterBlock.FLAGS['MATCH_ANY']
+        filters = []
+        for filt in self.filters:
+            if len(filt['values']) == 1:
+                type = FilterBlock.TYPE['IS'] if filt['is'] else FilterBlock.TYPE['IS_NOT']
+            else:
+                type = FilterBlock.TYPE['IN'] if filt['is'] else FilterBlock.TYPE['NOT_IN']
+            values = PipelineEncoder.TUPLE_SEPARATOR.join(sorted(filt['values']))
+            filters.append(PipelineEncoder.PARAM_SEPARATOR.join([filt['scenario'], type, values]))
+        return PipelineEncoder.GROUP_SEPARATOR.join([str(flags)] + sorted(filters))
+
     def apply(self, data_table, messages):
         """ Apply this block to the given data table.
         """
+        self.prepare(data_table, messages)
+
+        match_any = self.matchAny()
+
+        # Use the table's inverted indexes to find the rows matching each
+        # filter, which is the union of the rows taking each of its values.
+        # The filters are then combined with set intersections (or unions
+        # when matching any filter).
+        all_rows = set(data_table.rowIds())
+        keep = set() if match_any else set(all_rows)
+        for filt in self.filters:
+            index = data_table.scenarioIndex(filt['scenario'])
+            matches = set()
+            for value in filt['values']:
+                if value in index:
+                    matches |= index[value]
+            if not filt['is']:
+                matches = all_rows - matches
+            if match_any:
+                keep |= matches
+            else:
+                keep &= matches
+        data_table.selectRows(keep)
+
+        # Delete the scenario columns
+        replacements = {}
+        for (i, row) in zip(data_table.rowIds(), data_table):
+            new_row = self.removeColumns(row)
+            if new_row is not row:
+                replacements[i] = new_row
+        data_table.replaceRows(replacements)
+        self.finish(data_table, messages)
+
+    def prepare(self, data_table, messages):
+        """ Check the filtered columns, and work out which columns the filters
+            leave with a single value.
+        """
         for f in self.filters:
             if not f['scenario'] in data_table.scenarioColumns:
                 raise PipelineError("Invalid columns specified for block")
 
-        new_rows = []
-        removed_scenario_cols = set()
-        for filt in self.filters:
-            if filt['is']:
-                removed_scenario_cols.add(filt['scenario'])
-
-        for row in data_table:
-            add = True
-            for filt in self.filters:
-                if filt['is']:
-                    if filt['scenario'] not in row.scenario or row.scenario[filt['scenario']] != filt['value']:
-                        add = False
-                        break
-                else:
-                    if filt['scenario'] in row.scenario and row.scenario[filt['scenario']] == filt['value']:
-                        add = False
-                        break
-            if add:
-                # Delete the scenario columns
-                for col in removed_scenario_cols:
-                    if col in row.scenario:
-                        del row.scenario[col]
-                new_rows.append(row)
+        self.removed_scenario_cols = self.removedColumns()
+        data_table.scenarioColumns -= self.removed_scenario_cols
 
+    def removedColumns(self):
+        """ Returns the set of scenario columns this block removes.
+        """
+        # A column can only be removed if every row left must have the same
+        # value for it.
         # We do it this way because calling .remove(x) on a set raises a key
         # value error if it wasn't in the set
         removed_scenario_cols = set()
+        if not self.getFlag(FilterBlock.FLAGS['MATCH_ANY']) or len(self.filters) == 1:
+            for filt in self.filters:
+                if filt['is'] and len(filt['values']) == 1:
+                    removed_scenario_cols.add(filt['scenario'])
+        return removed_scenario_cols
+
+    def matchAny(self):
+        """ Returns True if rows need only match one of the filters. A block
+            whose filters were all invalid keeps every row, whether or not
+            MATCH_ANY is set. """
+        return self.getFlag(FilterBlock.FLAGS['MATCH_ANY']) and len(self.filters) > 0
+
+    def applyRow(self, row):
+        """ Check a single row against the filters, removing the columns
+            that now have a single value if it is kept.
+        """
+        matches = ((row.scenario.get(f['scenario']) in f['values']) == f['is'] for f in self.filters)
+        if self.matchAny():
+            keep = any(matches)
+        else:
+            keep = all(matches)
+        if not keep:
+            return None
+        return self.removeColumns(row)
+
+    def removeColumns(self, row):
+        """ Returns the row without the columns that now have a single value
+            (or the row itself if it has none of them).
+        """
+        if not any(col in row.scenario for col in self.removed_scenario_cols):
+            return row
+        scenario = dict([(key, val) for (key, val) in row.scenario.iteritems() if key not in self.removed_scenario_cols])
+        return DataRow(scenario, row.values)
+
+    def finish(self, data_table, messages):
+        """ Throw away the indexes on the removed columns.
+        """
+        data_table.invalidateIndexes(self.removed_scenario_cols)
+
+    def estimate(self, stats):
+        new_stats = copy.deepcopy(stats)
+        match_any = self.matchAny()
+        keep = 0.0 if match_any else 1.0
         for filt in self.filters:
-            if filt['is']:
-                removed_scenario_cols.add(filt['scenario'])
-        
-        data_table.scenarioColumns -= removed_scenario_cols
-        data_table.rows = new_rows
+            count = stats['scenario'].get(filt['scenario'], 1)
+            fraction = min(1.0, float(len(filt['values'])) / count)
+            if not filt['is']:
+                fraction = 1 - fraction
+            if match_any:
+                keep = keep + fraction - keep * fraction
+            else:
+                keep *= fraction
+                if filt['is']:
+                    new_stats['scenario'][filt['scenario']] = min(count, len(filt['values']))
+                else:
+                    new_stats['scenario'][filt['scenario']] = max(1, count - len(filt['values']))
+        new_stats['rows'] = stats['rows'] * keep
+        for col in self.removedColumns():
+            new_stats['scenario'].pop(col, None)
+        return new_stats, None
 
 class ValueFilterBlock(Block):
     """ Filters the datatable by including or excluding particular rows based
         on value criteria. The rows that do not match every filter are thrown out 
         (that is, the list of filters is ANDed together). """
 
+    ROW_LOCAL = True
+    INDEXED = True
+
     TYPE = {
         'IS': '1',
         'IS_NOT': '2'
@@ -307,23 +547,493 @@ class ValueFilterBlock(Block):
                 'upperbound':   upperbound
             })
 
+    def canonical(self, param_string):
+        """ The filters are sorted, with their bounds written out in full. """
+        filters = []
+        for filt in self.filters:
+            type = ValueFilterBlock.TYPE['IS'] if filt['is'] else ValueFilterBlock.TYPE['IS_NOT']
+            filters.append(PipelineEncoder.PARAM_SEPARATOR.join([filt['column'], type, repr(filt['lowerbound']), repr(filt['upperbound'])]))
+        return PipelineEncoder.GROUP_SEPARATOR.join([str(self.flags)] + sorted(filters))
+
     def apply(self, data_table, messages):
         """ Apply this block to the given data table.
         """
+        self.prepare(data_table, messages)
+
+        # Rows without a filter's column never match it, whether the filter
+        # is IS or IS_NOT
+        keep = set(data_table.rowIds())
+        for filt in self.filters:
+            in_bounds = data_table.valueRange(filt['column'], filt['lowerbound'], filt['upperbound'])
+            if filt['is']:
+                keep &= in_bounds
+            else:
+                values, present = data_table.valueArray(filt['column'])
+                keep &= present
+                keep -= in_bounds
+        data_table.selectRows(keep)
+
+    def prepare(self, data_table, messages):
+        """ Check the filtered columns.
+        """
         for f in self.filters:
             if not f['column'] in data_table.valueColumns:
                 raise PipelineError("Invalid columns specified for block")
-        new_rows = []
+
+    def applyRow(self, row):
+        """ Check a single row against the filters.
+        """
+        for filt in self.filters:
+            if filt['column'] not in row.values:
+                return None
+            val = float(row.values[filt['column']])
+            if (filt['lowerbound'] <= val <= filt['upperbound']) != filt['is']:
+                return None
+        return row
+
+    def estimate(self, stats):
+        """ Assumes values are spread evenly over the range of their column,
+            or that a third of them are in bounds if the range is unknown.
+        """
+        new_stats = copy.deepcopy(stats)
+        keep = 1.0
+        for filt in self.filters:
+            lower, upper = filt['lowerbound'], filt['upperbound']
+            value_range = new_stats['values'].get(filt['column'])
+            if value_range is None:
+                fraction = 1.0 / 3
+            else:
+                (low, high) = value_range
+                if high > low:
+                    fraction = max(0.0, min(upper, high) - max(lower, low)) / (high - low)
+                else:
+                    fraction = 1.0 if lower <= low <= upper else 0.0
+                if filt['is'] and fraction > 0:
+                    new_stats['values'][filt['column']] = (max(lower, low), min(upper, high))
+            if not filt['is']:
+                fraction = 1 - fraction
+            keep *= fraction
+        new_stats['rows'] = stats['rows'] * keep
+        return new_stats, None
+
+
+class SortBlock(Block):
+    """ Sorts the rows of the datatable by one or more scenario or value
+        columns, and optionally keeps only the first few rows of each group.
+        The rows kept are sorted together, not group by group, so the table
+        is ordered by the sort columns either way. Rows which are missing a
+        sort column are placed after those that have it, whichever direction
+        that column is sorted in, and rows which are missing a grouping
+        column are grouped as if it were None. """
+
+    TYPE = {
+        'ASCENDING': '1',
+        'DESCENDING': '2'
+    }
+
+    def __init__(self):
+        """ Define the instance variables of a SortBlock.
+
+        keys:   An array of dictionaries describing the columns to sort by, in
+                order of precedence. Each key has two properties:
+                 * column     -- the scenario or value column to sort by
+                 * descending -- true if the column is sorted largest first
+        limit:  The number of rows to keep from each group, or 0 to keep them
+                all.
+        group:  The scenario columns used to group the rows before the limit
+                is applied. If empty, the limit applies to the whole table.
+        """
+        super(SortBlock, self).__init__()
+
+        self.keys = []
+        self.limit = 0
+        self.group = []
+
+    def decode(self, param_string, cache_key):
+        """ Decode a sort block from an encoded pipeline string.
+            Sort blocks are encoded in the form:
+            limit^group1;group2&key1column^key1type&key2column^...
+        """
+        parts = param_string.split(PipelineEncoder.GROUP_SEPARATOR)
+        # There must be at least three - a flagword, the settings and one key
+        if len(parts) < 3:
+            raise PipelineError("Sort block invalid: not enough parts")
+
+        self.flags = int(parts[0])
+
+        settings = parts[1].split(PipelineEncoder.PARAM_SEPARATOR)
+        # Exactly two settings - limit and grouping
+        if len(settings) != 2:
+            raise PipelineError("Sort block invalid: incorrect number of settings")
+        try:
+            self.limit = int(settings[0])
+        except ValueError:
+            raise PipelineError("Invalid limit (%s) for Sort block - the limit must be a whole number" % settings[0])
+        if self.limit < 0:
+            raise PipelineError("Invalid limit (%s) for Sort block - the limit must not be negative" % settings[0])
+        self.group = filter(lambda x: x != '', settings[1].split(PipelineEncoder.TUPLE_SEPARATOR))
+
+        # Everything past the second part is a sort key
+        for key_str in parts[2:]:
+            settings = key_str.split(PipelineEncoder.PARAM_SEPARATOR)
+            # Must be exactly two parts - column and type
+            if len(settings) != 2:
+                logging.debug("Sort invalid: not enough parts in %s" % key_str)
+                continue
+            self.keys.append({
+                'column':       settings[0],
+                'descending':   (settings[1] == SortBlock.TYPE['DESCENDING'])
+            })
+
+    def sortKey(self, row, scenario_keys):
+        """ Returns the sort key for a row, as a list with one entry for each
+            sort column. Each entry is None if the row is missing that column.
+        """
+        key = []
+        for (k, is_scenario) in zip(self.keys, scenario_keys):
+            if is_scenario:
+                if k['column'] in row.scenario:
+                    key.append(scenario_sort_key(row.scenario[k['column']]))
+                else:
+                    key.append(None)
+            else:
+                if k['column'] in row.values and not math.isnan(float(row.values[k['column']])):
+                    key.append(float(row.values[k['column']]))
+                else:
+                    key.append(None)
+        return key
+
+    def compareKeys(self, a, b):
+        """ Compares two sort keys produced by sortKey. """
+        for (k, x, y) in zip(self.keys, a, b):
+            if x == y:
+                continue
+            # Missing values always come last
+            if x is None:
+                return 1
+            if y is None:
+                return -1
+            if k['descending']:
+                return cmp(y, x)
+            return cmp(x, y)
+        return 0
+
+    def apply(self, data_table, messages):
+        """ Apply this block to the given data table. When a limit is set, the
+            rows to keep from each group are picked with a heap, so that only
+            those rows are ever fully ordered.
+        """
+        for col in self.group:
+            if not col in data_table.scenarioColumns:
+                raise PipelineError("Invalid columns specified for block")
+        scenario_keys = []
+        for k in self.keys:
+            if k['column'] in data_table.scenarioColumns:
+                scenario_keys.append(True)
+            elif k['column'] in data_table.valueColumns:
+                scenario_keys.append(False)
+            else:
+                raise PipelineError("Invalid columns specified for block")
+
+        # Group the rows, keeping the groups in the order they first appear
+        groups = {}
+        group_order = []
         for row in data_table:
-            add = True
-            for filt in self.filters:
-              if add:
-                in_data = filt['column'] in row.values
-                in_bounds = in_data and (row.values[filt['column']] >= filt['lowerbound'] and row.values[filt['column']] <= filt['upperbound'])
-                add = in_data and (bool(in_bounds) == bool(filt['is']))
-            if add:
-                new_rows.append(row)
-        data_table.rows = new_rows
+            group = tuple([row.scenario.get(col) for col in self.group])
+            if group not in groups:
+                groups[group] = []
+                group_order.append(group)
+            groups[group].append((self.sortKey(row, scenario_keys), row))
+
+        # Order each group, keeping only as many rows as needed, and then
+        # order the rows kept from every group together. The sort is stable,
+        # so equal rows stay in the order of their groups.
+        key = functools.cmp_to_key(lambda a, b: self.compareKeys(a[0], b[0]))
+        new_rows = []
+        for group in group_order:
+            rows = groups[group]
+            if self.limit > 0 and self.limit < len(rows):
+                rows = heapq.nsmallest(self.limit, rows, key=key)
+            else:
+                rows.sort(key=key)
+            new_rows.extend(rows)
+        if len(group_order) > 1:
+            new_rows.sort(key=key)
+
+        data_table.rows = [row for (k, row) in new_rows]
+        self.group_count = len(group_order)
+
+    def estimate(self, stats):
+        groups = self.estimateGroups(stats, self.group)
+        new_stats = copy.deepcopy(stats)
+        if self.limit > 0:
+            new_stats['rows'] = min(stats['rows'], self.limit * groups)
+        return new_stats, groups
+
+
+class SampleBlock(Block):
+    """ Keeps a uniform random sample of the rows in the datatable, either of
+        the whole table or of each group of rows. The sample is chosen with a
+        fixed seed, so the same pipeline always produces the same sample. """
+
+    def __init__(self):
+        """ Define the instance variables of a SampleBlock.
+
+        size:   The number of rows to keep from each group.
+        seed:   The seed for the random number generator.
+        group:  The scenario columns used to group the rows before sampling.
+                If empty, the sample is taken from the whole table.
+        """
+        super(SampleBlock, self).__init__()
+
+        self.size = 0
+        self.seed = 0
+        self.group = []
+
+    def decode(self, param_string, cache_key):
+        """ Decode a sample block from an encoded pipeline string.
+            Sample blocks are encoded in the form:
+            size^seed^group1;group2
+        """
+        parts = param_string.split(PipelineEncoder.GROUP_SEPARATOR)
+        # Exactly two parts - flagword and settings
+        if len(parts) != 2:
+            raise PipelineError("Sample block invalid: incorrect number of parts")
+
+        self.flags = int(parts[0])
+
+        settings = parts[1].split(PipelineEncoder.PARAM_SEPARATOR)
+        # Exactly three settings - size, seed and grouping
+        if len(settings) != 3:
+            raise PipelineError("Sample block invalid: incorrect number of settings")
+        try:
+            self.size = int(settings[0])
+            self.seed = int(settings[1])
+        except ValueError:
+            raise PipelineError("Invalid size (%s) or seed (%s) for Sample block - both must be whole numbers" % (settings[0], settings[1]))
+        if self.size < 1:
+            raise PipelineError("Invalid size (%s) for Sample block - the size must be at least one" % settings[0])
+        self.group = filter(lambda x: x != '', settings[2].split(PipelineEncoder.TUPLE_SEPARATOR))
+
+    def apply(self, data_table, messages):
+        """ Apply this block to the given data table. The sample is taken in a
+            single pass with reservoir sampling, and the rows that are kept
+            stay in their original order.
+        """
+        for col in self.group:
+            if not col in data_table.scenarioColumns:
+                raise PipelineError("Invalid columns specified for block")
+
+        rng = random.Random(self.seed)
+        ignored_rows = 0
+        reservoirs = {}
+        seen = {}
+        for (i, row) in zip(data_table.rowIds(), data_table):
+            try:
+                group = tuple([row.scenario[col] for col in self.group])
+            except KeyError:
+                ignored_rows += 1
+                continue
+            if group not in reservoirs:
+                reservoirs[group] = []
+                seen[group] = 0
+            reservoir = reservoirs[group]
+            n = seen[group]
+            seen[group] = n + 1
+            if n < self.size:
+                reservoir.append(i)
+            else:
+                j = rng.randint(0, n)
+                if j < self.size:
+                    reservoir[j] = i
+
+        keep = set()
+        for reservoir in reservoirs.itervalues():
+            keep.update(reservoir)
+        data_table.selectRows(keep)
+        self.group_count = len(reservoirs)
+
+        if ignored_rows > 0:
+            logging.info("Sample block ignored %d rows because they were missing a scenario column from the selected grouping", ignored_rows)
+
+    def estimate(self, stats):
+        groups = self.estimateGroups(stats, self.group)
+        new_stats = copy.deepcopy(stats)
+        new_stats['rows'] = min(stats['rows'], self.size * groups)
+        return new_stats, groups
+
+
+class OutlierBlock(Block):
+    """ Removes outlying rows before they are aggregated. Rows are grouped in
+        the same way as AggregateBlock groups them, that is, every row whose
+        scenario differs only in the specified column is in the same group.
+        Within each group, a row is an outlier if any of the chosen value
+        columns is outside the bounds given by the type of test:
+        * IQR   -- more than threshold interquartile ranges outside the
+                   quartiles
+        * MAD   -- more than threshold (scaled) median absolute deviations
+                   from the median
+        * SIGMA -- more than threshold standard deviations from the mean
+        Groups with no spread in a column never have outliers in that column.
+    """
+
+    TYPE = {
+        'IQR': '1',
+        'MAD': '2',
+        'SIGMA': '3'
+    }
+
+    FLAGS = {
+        'FLAG_ONLY': 1 << 0
+    }
+
+    # The scenario column added to mark outliers when they are flagged rather
+    # than removed
+    FLAG_COLUMN = 'outlier'
+
+    # Scales the MAD so that it estimates the standard deviation of normally
+    # distributed data
+    MAD_SCALE = 1.4826
+
+    def __init__(self):
+        super(OutlierBlock, self).__init__()
+        self.type = None
+        self.column = None
+        self.threshold = None
+        self.values = []
+
+    def decode(self, param_string, cache_key):
+        """ Decode an outlier block from an encoded pipeline string.
+            Outlier blocks are encoded in the form:
+            type^column^threshold&value1^value2
+            where the number is the TYPE chosen, column is the scenario column
+            and the values are the value columns to test (all of them if
+            empty).
+        """
+        parts = param_string.split(PipelineEncoder.GROUP_SEPARATOR)
+        # Exactly three parts - flagword, settings and value columns
+        if len(parts) != 3:
+            raise PipelineError("Outlier block invalid: incorrect number of parts")
+
+        self.flags = int(parts[0])
+
+        settings = parts[1].split(PipelineEncoder.PARAM_SEPARATOR)
+        # Exactly three settings - type, column and threshold
+        if len(settings) != 3:
+            raise PipelineError("Outlier block invalid: incorrect number of settings")
+        if settings[0] not in OutlierBlock.TYPE.values():
+            raise PipelineError("Outlier block invalid: unknown type %s" % settings[0])
+
+        self.type = settings[0]
+        self.column = settings[1]
+        try:
+            self.threshold = float(settings[2])
+        except ValueError:
+            raise PipelineError("Invalid threshold (%s) for Outlier block - the threshold must be a valid Python float" % settings[2])
+        self.values = filter(lambda x: x != '', parts[2].split(PipelineEncoder.PARAM_SEPARATOR))
+
+    def canonical(self, param_string):
+        """ The value columns are tested independently, so they are sorted.
+        """
+        settings = PipelineEncoder.PARAM_SEPARATOR.join([self.type, self.column, repr(self.threshold)])
+        return PipelineEncoder.GROUP_SEPARATOR.join([str(self.flags), settings, PipelineEncoder.PARAM_SEPARATOR.join(sorted(set(self.values)))])
+
+    def bounds(self, vals):
+        """ Returns the (lower, upper) bounds outside which values in the given
+            list are outliers, or None if the list has no spread. The list is
+            reordered in place.
+        """
+        if self.type == OutlierBlock.TYPE['IQR']:
+            q1 = quantile(vals, 0.25)
+            q3 = quantile(vals, 0.75)
+            spread = q3 - q1
+            if spread == 0:
+                return None
+            return (q1 - self.threshold * spread, q3 + self.threshold * spread)
+        elif self.type == OutlierBlock.TYPE['MAD']:
+            median = quantile(vals, 0.5)
+            spread = OutlierBlock.MAD_SCALE * quantile([abs(v - median) for v in vals], 0.5)
+            if spread == 0:
+                return None
+            return (median - self.threshold * spread, median + self.threshold * spread)
+        else:
+            if len(vals) < 2:
+                return None
+            mean = math.fsum(vals) / len(vals)
+            spread = math.sqrt(math.fsum([(v - mean) ** 2 for v in vals]) / (len(vals) - 1))
+            if spread == 0:
+                return None
+            return (mean - self.threshold * spread, mean + self.threshold * spread)
+
+    def apply(self, data_table, messages):
+        """ Apply this block to the given data table. The bounds for each group
+            are found by selection rather than by sorting the group.
+        """
+        if not self.column in data_table.scenarioColumns:
+            raise PipelineError("Invalid columns specified for block")
+        for v in self.values:
+            if not v in data_table.valueColumns:
+                raise PipelineError("Invalid columns specified for block")
+        if self.values:
+            columns = self.values
+        else:
+            columns = list(data_table.valueColumns)
+
+        # Group the rows based on their scenarios except for the specified column
+        groups = {}
+        rows = {}
+        ignored_rows = 0
+        for (i, row) in zip(data_table.rowIds(), data_table):
+            if self.column not in row.scenario:
+                ignored_rows += 1
+                continue
+            schash = scenario_hash(scenario=row.scenario, exclude=[self.column])
+            if schash not in groups:
+                groups[schash] = []
+            groups[schash].append(i)
+            rows[i] = row
+
+        # Find the outliers in each group, a column at a time
+        outliers = set()
+        for ids in groups.itervalues():
+            for col in columns:
+                present = [i for i in ids if col in rows[i].values]
+                vals = [float(rows[i].values[col]) for i in present]
+                bounds = self.bounds(list(vals))
+                if bounds is None:
+                    continue
+                (lower, upper) = bounds
+                for (i, v) in zip(present, vals):
+                    if v < lower or v > upper:
+                        outliers.add(i)
+
+        if self.getFlag(OutlierBlock.FLAGS['FLAG_ONLY']):
+            replacements = {}
+            for (i, row) in rows.iteritems():
+                scenario = dict(row.scenario)
+                scenario[OutlierBlock.FLAG_COLUMN] = 'yes' if i in outliers else 'no'
+                replacements[i] = DataRow(scenario, row.values)
+            data_table.replaceRows(replacements)
+            data_table.scenarioColumns.add(OutlierBlock.FLAG_COLUMN)
+            data_table.invalidateIndexes([OutlierBlock.FLAG_COLUMN])
+        else:
+            data_table.selectRows(set(data_table.rowIds()) - outliers)
+
+        self.group_count = len(groups)
+
+        if ignored_rows > 0:
+            logging.info('Outlier block (over %s) ignored %d rows.', self.column, ignored_rows)
+        if len(outliers) > 0:
+            logging.info('Outlier block (over %s) found %d outlying rows.', self.column, len(outliers))
+
+    def estimate(self, stats):
+        """ Assumes there are no outliers.
+        """
+        groups = self.estimateGroups(stats, [col for col in stats['scenario'] if col != self.column])
+        new_stats = copy.deepcopy(stats)
+        if self.getFlag(OutlierBlock.FLAGS['FLAG_ONLY']):
+            new_stats['scenario'][OutlierBlock.FLAG_COLUMN] = 2
+        return new_stats, groups
 
 
 class AggregateBlock(Block):
@@ -337,29 +1047,40 @@ class AggregateBlock(Block):
         Keyword arguments:
         * column -- the column on which the aggregate is performed (i.e. the
                     column which is ignored when regrouping rows).
-        * type   -- the type of aggregate to generate, either 'mean' or 'geomean'
+        * type   -- the type of aggregate to generate, either 'mean', 'geomean',
+                    'median', 'p90' or 'p99'
     """
 
     TYPE = {
         '1': 'mean',
-        '2': 'geomean'
+        '2': 'geomean',
+        '3': 'median',
+        '4': 'p90',
+        '5': 'p99'
     }
 
     FLAGS = {
-        'ADD_SEPARATE_COLUMN': 1 << 0
+        'ADD_SEPARATE_COLUMN': 1 << 0,
+        'BOOTSTRAP_CI': 1 << 1
     }
 
+    # The number of resamples used for bootstrap confidence intervals if none
+    # is given
+    DEFAULT_RESAMPLES = 1000
+
     def __init__(self):
         super(AggregateBlock, self).__init__()
         self.column = None
         self.type = None
+        self.resamples = AggregateBlock.DEFAULT_RESAMPLES
 
     def decode(self, param_string, cache_key):
         """ Decode an aggregate block from an encoded pipeline string.
             Aggregate blocks are encoded in the form:
             1&column
             where the number is the TYPE chosen, and column is the scenario
-            column.
+            column. If the BOOTSTRAP_CI flag is set, the number of resamples
+            may follow the column, as in 1&column^resamples.
         """
         parts = param_string.split(PipelineEncoder.GROUP_SEPARATOR)
         # Exactly two parts - flagword and settings
@@ -369,12 +1090,19 @@ class AggregateBlock(Block):
         self.flags = int(parts[0])
 
         settings = parts[1].split(PipelineEncoder.PARAM_SEPARATOR)
-        # Exactly two settings - type and column
-        if len(settings) != 2:
+        # Two settings - type and column - and optionally the resamples
+        if len(settings) not in (2, 3):
             raise PipelineError("Aggregate block invalid: incorrect number of settings")
 
         self.type = settings[0]
         self.column = settings[1]
+        if len(settings) == 3:
+            try:
+                self.resamples = int(settings[2])
+            except ValueError:
+                raise PipelineError("Invalid number of resamples (%s) for Aggregate block - it must be a whole number" % settings[2])
+            if self.resamples < 1:
+                raise PipelineError("Invalid number of resamples (%s) for Aggregate block - it must be at least one" % settings[2])
 
     def apply(self, data_table, messages):
         """ Apply this block to the given data table.
@@ -383,6 +1111,10 @@ class AggregateBlock(Block):
             raise PipelineError("Invalid columns specified for block")
 
         groups = {}
+        # The groups are output in the order they first appear, so that the
+        # order of the rows doesn't depend on how the scenarios hash (see
+        # commutesWith)
+        group_order = []
         basescenarios = set()
         scenarios = {}
         ignored_rows = 0
@@ -399,6 +1131,7 @@ class AggregateBlock(Block):
             schash = scenario_hash(scenario=row.scenario, exclude=[self.column])
             if schash not in scenarios:
                 groups[schash] = []
+                group_order.append(schash)
                 scenarios[schash] = copy.copy(row.scenario)
                 if not self.getFlag(AggregateBlock.FLAGS['ADD_SEPARATE_COLUMN']):
                     del scenarios[schash][self.column]
@@ -415,26 +1148,258 @@ class AggregateBlock(Block):
                     vals[key].append(val)
             aggregates[sc] = vals
 
+        # Bootstrap the confidence intervals of every group at once
+        if self.getFlag(AggregateBlock.FLAGS['BOOTSTRAP_CI']):
+            bootstrap_all(dict([(sc + '\0' + key, agg) for (sc, vals) in aggregates.iteritems() for (key, agg) in vals.iteritems()]), self.resamples)
+
         # Update the rows
         if self.getFlag(AggregateBlock.FLAGS['ADD_SEPARATE_COLUMN']):
-            for row in data_table:
+            added_cols = set()
+            replacements = {}
+            for (i, row) in zip(data_table.rowIds(), data_table):
                 schash = scenario_hash(scenario=row.scenario, exclude=[self.column])
                 if schash in aggregates:
+                    values = dict(row.values)
                     for key,agg in aggregates[schash].items():
-                        row.values[key + "." + self.TYPE[self.type]] = agg
+                        values[key + "." + self.TYPE[self.type]] = agg
+                        added_cols.add(key + "." + self.TYPE[self.type])
+                    replacements[i] = DataRow(row.scenario, values)
+            data_table.replaceRows(replacements)
+            data_table.invalidateIndexes(valueColumns=added_cols)
         else:
             new_rows = []
-            for sc,rows in groups.items():
+            for sc in group_order:
                 new_row = DataRow()
                 new_row.scenario = scenarios[sc]
                 new_row.values = aggregates[sc]
                 new_rows.append(new_row)
             data_table.rows = new_rows
             data_table.scenarioColumns -= set([self.column])
+        self.group_count = len(groups)
         
         if ignored_rows > 0:
             logging.info('Aggregate block (%s over %s) ignored %d rows.', self.type, self.column, ignored_rows)
 
+    def estimate(self, stats):
+        groups = self.estimateGroups(stats, [col for col in stats['scenario'] if col != self.column])
+        new_stats = copy.deepcopy(stats)
+        if self.getFlag(AggregateBlock.FLAGS['ADD_SEPARATE_COLUMN']):
+            for key in stats['values']:
+                new_stats['values'][key + "." + self.TYPE[self.type]] = stats['values'][key]
+        else:
+            new_stats['rows'] = groups
+            new_stats['scenario'].pop(self.column, None)
+        return new_stats, groups
+
+    def commutesWith(self, block, data_table):
+        """ A filter on other scenario columns keeps or throws away whole
+            groups, so it can be applied first, unless the bootstrap (which
+            is seeded by group) or a separate column is in use. The groups
+            are output in the order they first appear, which a filter doesn't
+            change, so the rows come out in the same order either way.
+        """
+        if not isinstance(block, FilterBlock):
+            return False
+        if self.flags & (AggregateBlock.FLAGS['ADD_SEPARATE_COLUMN'] | AggregateBlock.FLAGS['BOOTSTRAP_CI']):
+            return False
+        if not self.column in data_table.scenarioColumns:
+            return False
+        for f in block.filters:
+            if f['scenario'] == self.column or not f['scenario'] in data_table.scenarioColumns:
+                return False
+        return True
+
+    def scenarioValuesAfter(self, data_table):
+        """ Check the table for ambiguous scenarios, and work out the
+            scenario values of the groups.
+        """
+        if not self.column in data_table.scenarioColumns:
+            raise PipelineError("Invalid columns specified for block")
+
+        scenarioValues = {}
+        basescenarios = set()
+        for row in data_table:
+            if self.column not in row.scenario:
+                continue
+            schash = scenario_hash(scenario=row.scenario)
+            if schash in basescenarios:
+                raise PipelineAmbiguityException("Base scenario not unique %s" % row.scenario)
+            basescenarios.add(schash)
+            for col in row.scenario:
+                if col == self.column:
+                    continue
+                if col in scenarioValues:
+                    scenarioValues[col].add(row.scenario[col])
+                else:
+                    scenarioValues[col] = set([row.scenario[col]])
+        return scenarioValues
+
+
+
+class ComparisonBlock(Block):
+    """ Compares two values of a scenario column (for example two builds)
+        within each group of rows that differ only in that column. For each
+        value column, a test of the samples from the candidate rows against
+        those from the baseline rows replaces the value with three columns:
+        * value.effect      -- the effect size; Cohen's d for Welch's t-test,
+                               and the rank-biserial correlation for the
+                               Mann-Whitney U test
+        * value.p           -- the two-tailed p-value of the test
+        * value.significant -- 1 if the p-value is below the significance
+                               level implied by settings.CONFIDENCE_LEVEL,
+                               otherwise 0
+        The samples are the raw values held by DataAggregates, so this block
+        is normally used after an aggregate. Groups without both a baseline
+        and a candidate are thrown away. Each value column of each group is
+        tested on its own, in pure Python; the tests are not batched, so the
+        time taken grows with the number of groups and their sizes.
+    """
+
+    TYPE = {
+        'WELCH': '1',
+        'MANN_WHITNEY': '2'
+    }
+
+    def __init__(self):
+        super(ComparisonBlock, self).__init__()
+        self.type = None
+        self.column = None
+        self.baseline = None
+        self.candidate = None
+
+    def decode(self, param_string, cache_key):
+        """ Decode a comparison block from an encoded pipeline string.
+            Comparison blocks are encoded in the form:
+            type^column^baseline^candidate
+            where the number is the TYPE chosen, column is the scenario column
+            and baseline and candidate are the values being compared.
+        """
+        parts = param_string.split(PipelineEncoder.GROUP_SEPARATOR)
+        # Exactly two parts - flagword and settings
+        if len(parts) != 2:
+            raise PipelineError("Comparison block invalid: incorrect number of parts")
+
+        self.flags = int(parts[0])
+
+        settings = parts[1].split(PipelineEncoder.PARAM_SEPARATOR)
+        # Exactly four settings - type, column, baseline and candidate
+        if len(settings) != 4:
+            raise PipelineError("Comparison block invalid: incorrect number of settings")
+        if settings[0] not in ComparisonBlock.TYPE.values():
+            raise PipelineError("Comparison block invalid: unknown type %s" % settings[0])
+
+        self.type = settings[0]
+        self.column = settings[1]
+        self.baseline = settings[2]
+        self.candidate = settings[3]
+
+    def samples(self, val):
+        """ Returns the raw samples behind a value, as a list of floats. """
+        if isinstance(val, DataAggregate):
+            return [float(v) for v in val.values()]
+        return [float(val)]
+
+    def compare(self, baseline, candidate):
+        """ Compares two lists of samples, returning (effect, p). """
+        if self.type == ComparisonBlock.TYPE['WELCH']:
+            t, df, p = welch_t_test(baseline, candidate)
+            if math.isnan(p):
+                return float('nan'), p
+            mb = math.fsum(baseline) / len(baseline)
+            mc = math.fsum(candidate) / len(candidate)
+            vb = math.fsum([(x - mb) ** 2 for x in baseline]) / (len(baseline) - 1)
+            vc = math.fsum([(x - mc) ** 2 for x in candidate]) / (len(candidate) - 1)
+            return (mc - mb) / math.sqrt((vb + vc) / 2), p
+        else:
+            u, p = mann_whitney_u(baseline, candidate)
+            if math.isnan(p):
+                return float('nan'), p
+            return 2 * u / (len(baseline) * len(candidate)) - 1, p
+
+    def apply(self, data_table, messages):
+        """ Apply this block to the given data table.
+        """
+        if not self.column in data_table.scenarioColumns:
+            raise PipelineError("Invalid columns specified for block")
+
+        # Gather the samples on each side of every group
+        groups = {}
+        group_order = []
+        ignored_rows = 0
+        for row in data_table:
+            if self.column not in row.scenario:
+                ignored_rows += 1
+                continue
+            if row.scenario[self.column] == self.baseline:
+                side = 0
+            elif row.scenario[self.column] == self.candidate:
+                side = 1
+            else:
+                continue
+            schash = scenario_hash(scenario=row.scenario, exclude=[self.column])
+            if schash not in groups:
+                scenario = copy.copy(row.scenario)
+                del scenario[self.column]
+                groups[schash] = (scenario, ({}, {}))
+                group_order.append(schash)
+            samples = groups[schash][1][side]
+            for (key, val) in row.values.items():
+                if key not in samples:
+                    samples[key] = []
+                samples[key].extend(self.samples(val))
+
+        # Test each value column in each group
+        unmatched = 0
+        alpha = 1 - settings.CONFIDENCE_LEVEL
+        new_rows = []
+        for schash in group_order:
+            scenario, (baseline, candidate) = groups[schash]
+            if len(baseline) == 0 or len(candidate) == 0:
+                unmatched += 1
+                continue
+            values = {}
+            for key in baseline:
+                if key not in candidate:
+                    continue
+                effect, p = self.compare(baseline[key], candidate[key])
+                if math.isnan(p):
+                    continue
+                values[key + '.effect'] = effect
+                values[key + '.p'] = p
+                values[key + '.significant'] = 1.0 if p < alpha else 0.0
+            new_rows.append(DataRow(scenario=scenario, values=values))
+
+        # Wrap it all up
+        valueColumns = set()
+        valueColumnsDisplay = {}
+        for key in data_table.valueColumns:
+            for suffix in ('effect', 'p', 'significant'):
+                valueColumns.add(key + '.' + suffix)
+                valueColumnsDisplay[key + '.' + suffix] = str(data_table.valueColumnsDisplay.get(key, key)) + '.' + suffix
+        data_table.rows = new_rows
+        data_table.scenarioColumns -= set([self.column])
+        data_table.valueColumns = valueColumns
+        data_table.valueColumnsDisplay = valueColumnsDisplay
+        self.group_count = len(group_order)
+
+        if ignored_rows > 0:
+            logging.info('Comparison block (over %s) ignored %d rows.', self.column, ignored_rows)
+        if unmatched > 0:
+            logging.info('Comparison block (over %s) threw away %d groups without both a %s and a %s row.', self.column, unmatched, self.baseline, self.candidate)
+
+    def estimate(self, stats):
+        """ Assumes every group has both a baseline and a candidate.
+        """
+        groups = self.estimateGroups(stats, [col for col in stats['scenario'] if col != self.column])
+        new_stats = copy.deepcopy(stats)
+        new_stats['rows'] = groups
+        new_stats['scenario'].pop(self.column, None)
+        new_stats['values'] = {}
+        for key in stats['values']:
+            new_stats['values'][key + '.effect'] = None
+            new_stats['values'][key + '.p'] = (0.0, 1.0)
+            new_stats['values'][key + '.significant'] = (0.0, 1.0)
+        return new_stats, groups
 
 
 class NormaliseBlock(Block):
@@ -513,13 +1478,75 @@ class NormaliseBlock(Block):
             self.normaliserValue = parts[nextIdx].strip()
     
     def apply(self, data_table, messages):
-        """ Apply this block to the given data table.
+        """ Apply this block to the given data table. This is done as a hash
+            join: the normalisers are collected into a map keyed by group,
+            and then each value column is divided by its normalisers at once.
         """
-        ignored_rows = []
-        no_normaliser_rows = []
+        no_normaliser_rows = 0
 
-        groups = {}
+        self.checkColumns(data_table)
+        rows, groups = self.groupRows(data_table)
+        ignored_rows = len(data_table.rows) - len(rows)
+
+        # Get a map of normalisers
+        normalisers = {}
+        if self.type == NormaliseBlock.TYPE['SELECT']:
+            normalisers, rows, groups = self.processSelectNormaliser(rows, groups)
+        elif self.type == NormaliseBlock.TYPE['BEST']:
+            normalisers = self.processBestNormaliser(rows, groups)
 
+        # Join every row to its normaliser, gathering the values to divide
+        # for each value column
+        specific = self.getFlag(NormaliseBlock.FLAGS['NORMALISE_TO_SPECIFIC_VALUE'])
+        columns = {}
+        new_rows = []
+        for row, group in zip(rows, groups):
+            if group not in normalisers:
+                no_normaliser_rows += 1
+                continue
+            normaliser = normalisers[group]
+            new_row = DataRow(row.scenario, {})
+            for key in row.values.keys():
+                normaliserValueKey = self.normaliserValue if specific else key
+                if normaliserValueKey in normaliser:
+                    if key not in columns:
+                        columns[key] = ([], [], [])
+                    column_rows, values, divisors = columns[key]
+                    column_rows.append(new_row)
+                    values.append(row.values[key])
+                    divisors.append(normaliser[normaliserValueKey])
+            new_rows.append(new_row)
+
+        # Perform the normalisation, a column at a time
+        for key, (column_rows, values, divisors) in columns.iteritems():
+            if self.getFlag(NormaliseBlock.FLAGS['INVERT_RESULT']):
+                results = divide_all(divisors, values)
+            else:
+                results = divide_all(values, divisors)
+            for row, result in zip(column_rows, results):
+                row.values[key] = result
+
+        # Wrap it all up
+        data_table.rows = new_rows
+        self.group_count = len(normalisers)
+
+        if ignored_rows > 0:
+            logging.info("Normaliser block ignored %d rows because they were missing a scenario column from the selected grouping", ignored_rows)
+        if no_normaliser_rows > 0:
+            logging.info("Normaliser block ignored %d rows because no normaliser existed for them", no_normaliser_rows)
+
+    def estimate(self, stats):
+        """ Assumes every group has a normaliser.
+        """
+        groups = self.estimateGroups(stats, self.group)
+        new_stats = copy.deepcopy(stats)
+        for key in stats['values']:
+            new_stats['values'][key] = None
+        return new_stats, groups
+
+    def checkColumns(self, data_table):
+        """ Check the columns this block uses are in the table.
+        """
         for col in self.group:
             if not col in data_table.scenarioColumns:
                 raise PipelineError("Invalid columns specified for block")
@@ -531,62 +1558,61 @@ class NormaliseBlock(Block):
             if not self.normaliserValue in data_table.valueColumns:
                 raise PipelineError("Invalid columns specified for block")
 
-        # Group the rows up as needed
+    def groupRows(self, data_table):
+        """ Work out the group of each row, skipping those that don't have
+            all the group columns defined. Returns the rows and their groups.
+        """
+        rows = []
+        groups = []
         for row in data_table:
-            # Check if all the group columns are defined
-            skip = False
-            for key in self.group:
-                if key not in row.scenario:
-                    skip = True
-                    break
-            if skip:
-                ignored_rows.append(row)
+            try:
+                groups.append(tuple([row.scenario[key] for key in self.group]))
+            except KeyError:
                 continue
-            
-            # Hash the scenario and insert it into its group
-            sc_hash = scenario_hash(scenario=row.scenario, include=self.group)
-            if sc_hash not in groups:
-                groups[sc_hash] = []
-            groups[sc_hash].append(row)
+            rows.append(row)
+        return rows, groups
 
-        # Get a set of normalisers
-        normalisers = {}
+    def commutesWith(self, block, data_table):
+        """ A filter on the group columns keeps or throws away whole groups,
+            so it can be applied first, as long as it doesn't remove any of
+            those columns.
+        """
+        if not isinstance(block, FilterBlock):
+            return False
+        try:
+            self.checkColumns(data_table)
+        except PipelineError:
+            return False
+        if block.removedColumns() & set(self.group):
+            return False
+        for f in block.filters:
+            if not f['scenario'] in self.group:
+                return False
+        return True
+
+    def scenarioValuesAfter(self, data_table):
+        """ Find the normalisers, and work out the scenario values of the
+            rows that have one.
+        """
+        self.checkColumns(data_table)
+        rows, groups = self.groupRows(data_table)
         if self.type == NormaliseBlock.TYPE['SELECT']:
-            normalisers = self.processSelectNormaliser(groups)
-        elif self.type == NormaliseBlock.TYPE['BEST']:
-            normalisers = self.processBestNormaliser(groups)
+            normalisers, rows, groups = self.processSelectNormaliser(rows, groups)
+        else:
+            normalisers = set(groups)
 
-        # Perform the normalisation
-        new_rows = []
-        for (scenario, rows) in groups.iteritems():
-            if scenario not in normalisers:
-                no_normaliser_rows.extend(rows)
+        scenarioValues = {}
+        for row, group in zip(rows, groups):
+            if group not in normalisers:
                 continue
-            for row in rows:
-                for key in row.values.keys():
-                    if self.getFlag(NormaliseBlock.FLAGS['NORMALISE_TO_SPECIFIC_VALUE']):
-                        normaliserValueKey = self.normaliserValue
-                    else:
-                        normaliserValueKey = key
-                    if normaliserValueKey in normalisers[scenario]:
-                        if self.getFlag(NormaliseBlock.FLAGS['INVERT_RESULT']):
-                            row.values[key] = normalisers[scenario][normaliserValueKey] / row.values[key]
-                        else:
-                            row.values[key] = row.values[key] / normalisers[scenario][normaliserValueKey]
-                    else:
-                        del row.values[key]
-                        
-            new_rows.extend(rows)
-        
-        # Wrap it all up
-        data_table.rows = new_rows
-
-        if len(ignored_rows) > 0:
-            logging.info("Normaliser block ignored %d rows because they were missing a scenario column from the selected grouping", len(ignored_rows))
-        if len(no_normaliser_rows) > 0:
-            logging.info("Normaliser block ignored %d rows because no normaliser existed for them", len(no_normaliser_rows))
+            for col in row.scenario:
+                if col in scenarioValues:
+                    scenarioValues[col].add(row.scenario[col])
+                else:
+                    scenarioValues[col] = set([row.scenario[col]])
+        return scenarioValues
 
-    def processSelectNormaliser(self, groups):
+    def processSelectNormaliser(self, rows, groups):
         """ Normalises the rows to a specified normaliser. The normaliser is
             specified by a column and value in the scenario of each row. Rows
             in the table are first grouped by every column except the one chosen
@@ -595,61 +1621,65 @@ class NormaliseBlock(Block):
             then normalised to the chosen normaliser. Groups for which no
             normaliser exists are thrown away.
             
-            datatable: the DataTable to be normalised, passed by reference.
-            Keyword arguments:
-            * column -- the column from which the normaliser will be decided.
-            * value  -- the value which the specified column should be equal to
-                        in order to select that row as a normaliser.
+            rows: the rows to be normalised.
+            groups: the group of each row, in the same order.
+            Returns the map of normalisers by group, and the rows and groups
+            that remain once rows missing a normaliser column are removed.
         """
         
         normalisers = {}
-
-        select_ignored_rows = []
-
-        for (scenario, rows) in groups.iteritems():
-            for (i, row) in enumerate(rows):
-                match = True
-                for selection in self.normaliser:
-                    if selection['scenario'] not in row.scenario:
-                        select_ignored_rows.append(row)
-                        del rows[i]
-                        match = False
-                        break
-                    elif row.scenario[selection['scenario']] != selection['value']:
-                        match = False
-                        break
-                if match:
-                    if scenario not in normalisers:
-                        normalisers[scenario] = copy.copy(row.values)
-                    else:
-                        raise PipelineAmbiguityException('More than one normaliser was found for the scenario %s. Both <pre>%s</pre> and <pre>%s</pre> were valid normalisers. Did you forget to set the right grouping for normalisation?' % (row.scenario, normalisers[scenario], row.values))
+        kept_rows = []
+        kept_groups = []
+
+        select_ignored_rows = 0
+
+        for row, group in zip(rows, groups):
+            match = True
+            missing = False
+            for selection in self.normaliser:
+                if selection['scenario'] not in row.scenario:
+                    match = False
+                    missing = True
+                    break
+                elif row.scenario[selection['scenario']] != selection['value']:
+                    match = False
+                    break
+            if missing:
+                select_ignored_rows += 1
+                continue
+            kept_rows.append(row)
+            kept_groups.append(group)
+            if match:
+                if group not in normalisers:
+                    normalisers[group] = copy.copy(row.values)
+                else:
+                    raise PipelineAmbiguityException('More than one normaliser was found for the scenario %s. Both <pre>%s</pre> and <pre>%s</pre> were valid normalisers. Did you forget to set the right grouping for normalisation?' % (row.scenario, normalisers[group], row.values))
         
-        if len(select_ignored_rows) > 0:
-            logging.info("Normaliser block ignored %d rows because they were missing a scenario column from the selected normaliser", len(select_ignored_rows))
+        if select_ignored_rows > 0:
+            logging.info("Normaliser block ignored %d rows because they were missing a scenario column from the selected normaliser", select_ignored_rows)
 
-        return normalisers
+        return normalisers, kept_rows, kept_groups
   
-    def processBestNormaliser(self, groups):
+    def processBestNormaliser(self, rows, groups):
         """ Normalises the rows to the best normaliser available. The rows in the
             table are firstly grouped by comparing their scenarios only on the
             specified columns. Then the best value in each group is found and
             used to normalise the other rows in that group.
             
-            datatable: the DataTable to be normalised, passed by reference.
-            Keyword arguments:
-            * group -- a list of scenario columns which should be used for
-                       grouping the rows before normalisation.
+            rows: the rows to be normalised.
+            groups: the group of each row, in the same order.
+            Returns the map of normalisers by group.
         """
 
         normalisers = {}
 
-        for (scenario, rows) in groups.iteritems():
-            normaliser = {}
-            for row in rows:
-                for (key, val) in row.values.items():
-                    if float(val) != 0 and float(val) < normaliser.get(key, float('inf')):
-                        normaliser[key] = val
-            normalisers[scenario] = normaliser
+        for row, group in zip(rows, groups):
+            if group not in normalisers:
+                normalisers[group] = {}
+            normaliser = normalisers[group]
+            for (key, val) in row.values.items():
+                if float(val) != 0 and float(val) < normaliser.get(key, float('inf')):
+                    normaliser[key] = val
 
         return normalisers
 
@@ -1106,8 +2136,10 @@ class GraphBlock(Block):
             raise PipelineError("Error formatting gnuplot: could not find " + str(ke) + " (maybe invalid gnuplot text)")
         gp_file.write(formatted_code)
         gp_file.close()
+        started = measure()
         process = subprocess.Popen([settings.GNUPLOT_EXECUTABLE, gp_file.name], cwd=settings.GRAPH_CACHE_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         (stdout, stderr) = process.communicate()
+        self.timings.append(('gnuplot', graph_hash, measured(started)))
 
         suffixes = set()
         for s in [e.replace(graph_hash + '.','') for e in os.listdir(settings.GRAPH_CACHE_DIR) if e.startswith(graph_hash)]:
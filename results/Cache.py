@@ -1,8 +1,18 @@
-"File-based cache backend"
+"File-based cache backend, with an SQLite index of the entries"
 
 import os
+import logging
 import time
+import fcntl
+import tempfile
 import shutil
+import sqlite3
+import threading
+import itertools
+import copy
+import zlib
+import bz2
+from collections import OrderedDict
 try:
     import cPickle as pickle
 except ImportError:
@@ -11,6 +21,215 @@ except ImportError:
 from django.core.cache.backends.base import BaseCache
 from django.utils.hashcompat import md5_constructor
 
+# The index records the path (relative to the cache directory), expiry time,
+# last access time, size and cost of every entry, and keeps running totals of
+# the number of entries and their size, so that neither needs a walk over the
+# cache directory. The cost of an entry is the time in seconds it took to
+# compute, and its priority is the last time it was accessed plus its cost
+# times the cost weight: entries are culled in order of priority.
+# Older indexes, and the entries they describe, are thrown away, so this is
+# bumped whenever the index or the format of the entries changes.
+INDEX_VERSION = 5
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL,
+    cost REAL NOT NULL,
+    priority REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+CREATE INDEX IF NOT EXISTS entries_priority ON entries (priority);
+CREATE TABLE IF NOT EXISTS totals (
+    entries INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+INSERT INTO totals SELECT 0, 0 WHERE NOT EXISTS (SELECT * FROM totals);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE totals SET entries = entries + 1, size = size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE totals SET entries = entries - 1, size = size - old.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN
+    UPDATE totals SET size = size - old.size + new.size;
+END;
+"""
+INDEX_DROP = """
+DROP TABLE IF EXISTS entries;
+DROP TABLE IF EXISTS totals;
+"""
+
+def protect(value):
+    """ Returns a copy of a value from the memory tier that the caller can
+        change without changing the value kept in the tier. The containers
+        in the value (or in a dictionary value) are copied, and tables are
+        snapshotted, sharing their rows, since rows are never modified.
+    """
+    if isinstance(value, dict):
+        return dict([(k, _protect(v)) for (k, v) in value.iteritems()])
+    return _protect(value)
+
+def _protect(value):
+    if hasattr(value, 'snapshot'):
+        return value.snapshot()
+    if isinstance(value, (list, set, dict)):
+        return copy.copy(value)
+    return value
+
+class MemoryTier(object):
+    """ A bounded store of the most recently used cache entries, kept in
+        memory in front of their files so that they don't have to be read and
+        unpickled again by this process. Entries are sized by their pickled
+        (uncompressed) values, and are only used while their file has the
+        same modification time and size, so values written by other
+        processes are never hidden.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, fname, stat):
+        """ Returns (expiry, header, value) for a file, or None. """
+        with self.lock:
+            entry = self.entries.pop(fname, None)
+            if entry is None:
+                return None
+            (mtime, file_size, size, exp, header, value) = entry
+            if mtime != stat.st_mtime or file_size != stat.st_size:
+                self.size -= size
+                return None
+            # Move it to the most recently used end
+            self.entries[fname] = entry
+            return (exp, header, value)
+
+    def put(self, fname, stat, size, exp, header, value):
+        with self.lock:
+            self._discard(fname)
+            if size > self.max_size:
+                return
+            self.entries[fname] = (stat.st_mtime, stat.st_size, size, exp, header, value)
+            self.size += size
+            while self.size > self.max_size:
+                (old, entry) = self.entries.popitem(last=False)
+                self.size -= entry[2]
+
+    def discard(self, fname):
+        with self.lock:
+            self._discard(fname)
+
+    def _discard(self, fname):
+        entry = self.entries.pop(fname, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+class FileLock(object):
+    """ An exclusive lock on a file, shared between processes, for use in a
+        with statement. Entering waits up to timeout seconds for the lock,
+        and records whether it was acquired and whether it had to wait for
+        it: if it wasn't acquired the caller goes ahead without it. The lock
+        belongs to the open file, so the operating system releases it if the
+        process holding it dies, and a stale lock never outlives its holder.
+        Lock files may be removed by anyone who holds them (see
+        CacheClass._prune_locks), so a lock only counts once the file it was
+        taken on is still the one in place.
+    """
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, fname, timeout):
+        self.fname = fname
+        self.timeout = timeout
+        self.file = None
+        self.acquired = False
+        self.waited = False
+
+    def __enter__(self):
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                self.file = open(self.fname, 'a')
+            except (IOError, OSError):
+                return self
+            try:
+                fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                self.file.close()
+                self.file = None
+                self.waited = True
+                if time.time() >= deadline:
+                    return self
+                time.sleep(self.POLL_INTERVAL)
+                continue
+            if self._in_place():
+                self.acquired = True
+                return self
+            # The file was removed before we locked it, so try again on the
+            # one that replaces it
+            self.file.close()
+            self.file = None
+
+    def _in_place(self):
+        """ Whether the open file is still the one at fname. """
+        try:
+            mine = os.fstat(self.file.fileno())
+            theirs = os.stat(self.fname)
+        except OSError:
+            return False
+        return (mine.st_dev, mine.st_ino) == (theirs.st_dev, theirs.st_ino)
+
+    def __exit__(self, *exc_info):
+        if self.file is not None:
+            if self.acquired:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+        return False
+
+# The prefix of the temporary files entries are written to
+TEMP_PREFIX = '.tmp'
+
+# Reads of entries are written to the index after this many entries have
+# been read, or this many seconds have passed
+TOUCH_BATCH = 100
+TOUCH_INTERVAL = 30
+
+# The permissions of the files in the cache. Temporary files are created
+# readable only by their owner, so they are given the permissions an ordinary
+# file would have been created with before being renamed into place. Reading
+# the umask means setting it, so it is only read once.
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0666 & ~UMASK
+
+class CorruptEntry(Exception):
+    """ Raised while reading an entry that is truncated or fails its
+        checksum. """
+    pass
+
+# The codecs values can be compressed with, as (compress, decompress), where
+# compress takes the level to compress at
+CODECS = {
+    'none': (lambda data, level: data, lambda data: data),
+    'zlib': (zlib.compress, zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+}
+
+# The (lowest, highest) level each codec accepts
+CODEC_LEVELS = {
+    'none': (0, 0),
+    'zlib': (0, 9),
+    'bz2': (1, 9),
+}
+
 class CacheClass(BaseCache):
     def __init__(self, dir, params):
         BaseCache.__init__(self, params)
@@ -27,7 +246,59 @@ class CacheClass(BaseCache):
         except (ValueError, TypeError):
             self._cull_frequency = 3
 
+        # The total size of the entries in bytes, or 0 for no limit
+        max_size = params.get('max_size', 0)
+        try:
+            self._max_size = int(max_size)
+        except (ValueError, TypeError):
+            self._max_size = 0
+
+        # How many seconds of recency each second of an entry's cost is
+        # worth, or 0 to cull the least recently used entries first
+        cost_weight = params.get('cost_weight', 0)
+        try:
+            self._cost_weight = float(cost_weight)
+        except (ValueError, TypeError):
+            self._cost_weight = 0.0
+
+        # The codec to compress values with, and the level to compress at
+        self._codec = params.get('codec', 'none')
+        if self._codec not in CODECS:
+            self._codec = 'none'
+
+        level = params.get('level', 6)
+        try:
+            self._level = int(level)
+        except (ValueError, TypeError):
+            self._level = 6
+        (lowest, highest) = CODEC_LEVELS[self._codec]
+        self._level = max(lowest, min(highest, self._level))
+
+        # The size in bytes of the memory tier of this process, or 0 to read
+        # every value from its file
+        memory_size = params.get('memory_size', 0)
+        try:
+            self._memory = MemoryTier(int(memory_size))
+        except (ValueError, TypeError):
+            self._memory = MemoryTier(0)
+
+        # The number of bytes read from and written to the cache by this
+        # process, for explaining pipelines
+        self.bytes_read = 0
+        self.bytes_written = 0
+
         self._dir = dir
+        self._index = os.path.join(self._dir, 'index.sqlite3')
+        # Lock files are kept apart from the entries, and are never removed,
+        # since a process may be waiting on one
+        self._locks = os.path.join(self._dir, 'locks')
+        # SQLite connections can't be shared between threads
+        self._local = threading.local()
+        # Reads of entries not yet written to the index, by path, and when
+        # they were last written
+        self._touches = {}
+        self._touches_lock = threading.Lock()
+        self._touched = time.time()
         if not os.path.exists(self._dir):
             self._createdir()
 
@@ -38,55 +309,170 @@ class CacheClass(BaseCache):
         self.set(key, value, timeout)
         return True
 
+    # Each entry is stored as four pickles: its expiry time, its header, the
+    # name of the codec its value was compressed with together with the
+    # length and CRC-32 of the stored value, and its value (which is
+    # compressed unless the codec is 'none'). The header is a small dictionary
+    # describing the value, which get_header can read without unpickling the
+    # value. Recently used entries are also kept unpickled in the memory tier.
+    # Entries are written to a temporary file and renamed into place, so a
+    # reader never sees one half written; an entry that is corrupt anyway,
+    # because it is truncated or fails its checksum, is removed when read.
+
+    # An index that can't be used - because it is read only, or locked by
+    # another process for too long - makes every operation miss, as if the
+    # cache were empty, rather than failing the caller.
+
     def get(self, key, default=None):
         fname = self._key_to_file(key)
         try:
+            # Opening the index first throws away entries in an older format
+            self._db()
+            entry = self._memory.get(fname, os.stat(fname))
+            if entry is not None:
+                (exp, header, value) = entry
+                now = time.time()
+                if exp < now:
+                    self._delete(fname)
+                    return default
+                self._touch(fname, now)
+                return protect(value)
             f = open(fname, 'rb')
-            s = f.read()
             try:
-                exp = pickle.loads(s)
+                exp = pickle.load(f)
                 now = time.time()
                 if exp < now:
                     self._delete(fname)
                 else:
-                    # 12 bytes for the expiry: 2 byte protocol ID, 1 byte type,
-                    # 8 byte data, 1 byte stop
-                    return pickle.loads(s[12:])
+                    header = pickle.load(f)
+                    (codec, length, checksum) = pickle.load(f)
+                    data = f.read()
+                    if len(data) != length or zlib.crc32(data) != checksum:
+                        raise CorruptEntry()
+                    data = CODECS[codec][1](data)
+                    value = pickle.loads(data)
+                    self.bytes_read += f.tell()
+                    self._touch(fname, now)
+                    self._memory.put(fname, os.fstat(f.fileno()), len(data), exp, header, protect(value))
+                    return value
+            finally:
+                f.close()
+        except (IOError, OSError, sqlite3.Error):
+            pass
+        except (CorruptEntry, EOFError, ValueError, KeyError, zlib.error, pickle.PickleError):
+            self._discard_corrupt(fname)
+        return default
+
+    def get_header(self, key, default=None):
+        """ Returns the header stored with an entry, plus the size of the
+            entry in bytes, without reading the value. Reading the header
+            doesn't count as using the entry.
+        """
+        fname = self._key_to_file(key)
+        try:
+            self._db()
+            stat = os.stat(fname)
+            entry = self._memory.get(fname, stat)
+            if entry is not None:
+                (exp, header, value) = entry
+                if exp < time.time():
+                    self._delete(fname)
+                    return default
+                header = dict(header)
+                header['size'] = stat.st_size
+                return header
+            f = open(fname, 'rb')
+            try:
+                exp = pickle.load(f)
+                if exp < time.time():
+                    self._delete(fname)
+                else:
+                    header = dict(pickle.load(f))
+                    (codec, length, checksum) = pickle.load(f)
+                    self.bytes_read += f.tell()
+                    # A truncated entry can be caught without reading its value
+                    size = os.fstat(f.fileno()).st_size
+                    if size != f.tell() + length:
+                        raise CorruptEntry()
+                    header['size'] = size
+                    return header
             finally:
                 f.close()
-        except (IOError, OSError, EOFError, pickle.PickleError):
+        except (IOError, OSError, sqlite3.Error):
             pass
+        except (CorruptEntry, EOFError, ValueError, pickle.PickleError):
+            self._discard_corrupt(fname)
         return default
 
-    def set(self, key, value, timeout=None):
+    def set(self, key, value, timeout=None, cost=0, header=None):
+        """ Sets a value in the cache. cost is the time in seconds it took to
+            compute the value, so that expensive values are culled last, and
+            header is a dictionary describing the value for get_header.
+        """
         fname = self._key_to_file(key)
         dirname = os.path.dirname(fname)
 
         if timeout is None:
             timeout = self.default_timeout
 
-        self._cull()
+        now = time.time()
+        exp = pickle.dumps(now + timeout, pickle.HIGHEST_PROTOCOL)
+        h = pickle.dumps(header or {}, pickle.HIGHEST_PROTOCOL)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        v = CODECS[self._codec][0](data, self._level)
+        c = pickle.dumps((self._codec, len(v), zlib.crc32(v)), pickle.HIGHEST_PROTOCOL)
+        size = len(exp) + len(h) + len(c) + len(v)
+
+        # A value bigger than the whole cache would only push everything else
+        # out, so it isn't cached at all
+        if self._max_size > 0 and size > self._max_size:
+            self.delete(key)
+            return
 
         try:
+            self._cull(size)
+
             if not os.path.exists(dirname):
                 os.makedirs(dirname)
 
-            now = time.time()
-            exp = pickle.dumps(now + timeout, pickle.HIGHEST_PROTOCOL)
-            v = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
-            with open(fname, 'wb') as f:
-                f.write(exp)
-                f.write(v)
+            (fd, tmp) = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=dirname)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    os.fchmod(f.fileno(), FILE_MODE)
+                    f.write(exp)
+                    f.write(h)
+                    f.write(c)
+                    f.write(v)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp, fname)
+            except:
+                os.remove(tmp)
+                raise
+            self._memory.put(fname, os.stat(fname), len(data), now + timeout, header or {}, protect(value))
+            self.bytes_written += size
+            self._record(fname, now + timeout, now, size, cost)
         except (IOError, OSError):
             pass
+        except sqlite3.Error:
+            # An entry missing from the index would never be culled
+            try:
+                self._remove(fname)
+            except (IOError, OSError):
+                pass
 
     def delete(self, key):
         try:
             self._delete(self._key_to_file(key))
-        except (IOError, OSError):
+        except (IOError, OSError, sqlite3.Error):
             pass
 
     def _delete(self, fname):
+        self._forget([fname])
+        self._remove(fname)
+
+    def _remove(self, fname):
+        self._memory.discard(fname)
         os.remove(fname)
         try:
             # Remove the 2 subdirs if they're empty
@@ -96,44 +482,68 @@ class CacheClass(BaseCache):
         except (IOError, OSError):
             pass
 
+    def _discard_corrupt(self, fname):
+        logging.warning("Removing corrupt cache entry %s" % fname)
+        try:
+            self._delete(fname)
+        except (IOError, OSError, sqlite3.Error):
+            pass
+
     def has_key(self, key):
         fname = self._key_to_file(key)
         try:
-            f = open(fname, 'rb')
-            try:
-                exp = pickle.load(f)
-                now = time.time()
-                if exp < now:
+            row = self._db().execute('SELECT expires FROM entries WHERE path = ?', (self._relative(fname),)).fetchone()
+            if row is None:
+                return False
+            if row[0] < time.time():
+                try:
                     self._delete(fname)
-                    return False
-                else:
-                    return True
-            finally:
-                f.close()
-        except (IOError, OSError, EOFError, pickle.PickleError):
+                except (IOError, OSError):
+                    pass
+                return False
+        except sqlite3.Error:
             return False
+        return True
 
-    def _cull(self):
-        if int(self._num_entries) < self._max_entries:
-            return
-
-        try:
-            filelist = sorted(os.listdir(self._dir))
-        except (IOError, OSError):
+    def _cull(self, incoming=0):
+        """ When the cache is full - it has max_entries entries, or adding
+            incoming bytes would take it over max_size - removes expired
+            entries and then the entries with the lowest priority, until it
+            is back under (1 - 1/cull_frequency) of both limits (or removes
+            every entry, if cull_frequency is 0). The entries are found with
+            the index rather than by walking the cache.
+        """
+        db = self._db()
+        self._flush_touches()
+        (entries, size) = db.execute('SELECT entries, size FROM totals').fetchone()
+        if entries < self._max_entries and (self._max_size == 0 or size + incoming <= self._max_size):
             return
 
         if self._cull_frequency == 0:
-            doomed = filelist
+            doomed = [path for (path,) in db.execute('SELECT path FROM entries')]
         else:
-            doomed = [os.path.join(self._dir, k) for (i, k) in enumerate(filelist) if i % self._cull_frequency == 0]
+            max_entries = self._max_entries - self._max_entries / self._cull_frequency
+            max_size = self._max_size - self._max_size / self._cull_frequency
+            now = time.time()
+            candidates = itertools.chain(
+                db.execute('SELECT path, size FROM entries WHERE expires < ?', (now,)).fetchall(),
+                db.execute('SELECT path, size FROM entries WHERE expires >= ? ORDER BY priority', (now,)))
+            doomed = []
+            for (path, entry_size) in candidates:
+                if entries < max_entries and (self._max_size == 0 or size + incoming <= max_size):
+                    break
+                doomed.append(path)
+                entries -= 1
+                size -= entry_size
 
-        for topdir in doomed:
+        doomed = [os.path.join(self._dir, path) for path in doomed]
+        self._forget(doomed)
+        for fname in doomed:
             try:
-                for root, _, files in os.walk(topdir):
-                    for f in files:
-                        self._delete(os.path.join(root, f))
+                self._remove(fname)
             except (IOError, OSError):
                 pass
+        self._prune_locks()
 
     def _createdir(self):
         try:
@@ -141,6 +551,35 @@ class CacheClass(BaseCache):
         except OSError:
             raise EnvironmentError("Cache directory '%s' does not exist and could not be created'" % self._dir)
 
+    def lock(self, key, timeout):
+        """ Returns a FileLock on a key, which other processes computing the
+            value of the key can wait on rather than computing it too. """
+        if not os.path.exists(self._locks):
+            try:
+                os.makedirs(self._locks)
+            except OSError:
+                pass
+        path = md5_constructor(key.encode('utf-8')).hexdigest()
+        return FileLock(os.path.join(self._locks, path), timeout)
+
+    def _prune_locks(self):
+        """ Removes the lock files that no process holds. Each is locked
+            before it is removed, so nobody can be holding it, and anyone who
+            opened it meanwhile notices it has gone once they lock it.
+        """
+        try:
+            names = os.listdir(self._locks)
+        except (IOError, OSError):
+            return
+        for name in names:
+            fname = os.path.join(self._locks, name)
+            try:
+                with open(fname, 'a') as f:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.remove(fname)
+            except (IOError, OSError):
+                pass
+
     def _key_to_file(self, key):
         """
         Convert the filename into an md5 string. We'll turn the first couple
@@ -154,15 +593,172 @@ class CacheClass(BaseCache):
         path = os.path.join(path[:2], path[2:4], path[4:])
         return os.path.join(self._dir, path)
 
+    def _relative(self, fname):
+        return os.path.relpath(fname, self._dir)
+
+    def _db(self):
+        """ Returns this thread's connection to the index, creating the index
+            if it doesn't exist (or has been deleted along with the cache).
+        """
+        db = getattr(self._local, 'db', None)
+        if db is not None and os.path.exists(self._index):
+            return db
+        if db is not None:
+            db.close()
+        if not os.path.exists(self._dir):
+            self._createdir()
+        exists = os.path.exists(self._index)
+        db = sqlite3.connect(self._index, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        # An index from an older version of this backend is thrown away, along
+        # with its entries, which may be in an older format
+        if db.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+            db.executescript(INDEX_DROP)
+            if exists:
+                self._remove_entries()
+        db.executescript(INDEX_SCHEMA)
+        db.execute('PRAGMA user_version = %d' % INDEX_VERSION)
+        # The index is shared by everyone who shares the cache, like the
+        # entries (SQLite gives its -wal and -shm files the same permissions
+        # as the index, but they may already exist)
+        for path in (self._index, self._index + '-wal', self._index + '-shm'):
+            try:
+                os.chmod(path, FILE_MODE)
+            except OSError:
+                pass
+        self._local.db = db
+        if not exists:
+            self._rebuild()
+        return db
+
+    def _rebuild(self):
+        """ Adds the entries already in the cache directory to a new index.
+            This is the only time the cache directory is walked. Entries that
+            aren't in the current format - from before there was an index,
+            or half written - are removed rather than added.
+        """
+        db = self._db()
+        now = time.time()
+        rows = []
+        for root, dirs, files in os.walk(self._dir):
+            if root == self._dir:
+                if 'locks' in dirs:
+                    dirs.remove('locks')
+                continue
+            for name in files:
+                fname = os.path.join(root, name)
+                if name.startswith(TEMP_PREFIX):
+                    # Left behind by a process that died while writing it
+                    try:
+                        os.remove(fname)
+                    except (IOError, OSError):
+                        pass
+                    continue
+                try:
+                    with open(fname, 'rb') as f:
+                        exp = pickle.load(f)
+                        header = pickle.load(f)
+                        (codec, length, checksum) = pickle.load(f)
+                        size = os.fstat(f.fileno()).st_size
+                        current = isinstance(header, dict) and codec in CODECS and size == f.tell() + length
+                except (IOError, OSError):
+                    continue
+                except Exception:
+                    # Older entries hold arbitrary pickles where the header
+                    # should be, which can fail to load in any number of ways
+                    current = False
+                if current:
+                    rows.append((self._relative(fname), exp, now, size, 0, now))
+                else:
+                    try:
+                        self._remove(fname)
+                    except (IOError, OSError):
+                        pass
+        with db:
+            db.executemany('INSERT OR IGNORE INTO entries (path, expires, accessed, size, cost, priority) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def _remove_entries(self):
+        """ Removes every entry from the cache directory, leaving the index.
+        """
+        self._memory.clear()
+        for name in os.listdir(self._dir):
+            path = os.path.join(self._dir, name)
+            if os.path.isdir(path) and path != self._locks:
+                shutil.rmtree(path, True)
+
+    def _record(self, fname, expires, accessed, size, cost):
+        """ Adds or updates the index entry for a file. """
+        path = self._relative(fname)
+        with self._touches_lock:
+            self._touches.pop(path, None)
+        priority = accessed + self._cost_weight * cost
+        db = self._db()
+        with db:
+            cursor = db.execute('UPDATE entries SET expires = ?, accessed = ?, size = ?, cost = ?, priority = ? WHERE path = ?', (expires, accessed, size, cost, priority, path))
+            if cursor.rowcount == 0:
+                db.execute('INSERT INTO entries (path, expires, accessed, size, cost, priority) VALUES (?, ?, ?, ?, ?, ?)', (path, expires, accessed, size, cost, priority))
+
+    def _touch(self, fname, accessed):
+        """ Records that a file was read, which raises its priority. So that
+            reading an entry doesn't take a write transaction on the index,
+            reads are only written to it in batches - every TOUCH_BATCH
+            entries or TOUCH_INTERVAL seconds, and before culling. """
+        with self._touches_lock:
+            self._touches[self._relative(fname)] = accessed
+            if len(self._touches) < TOUCH_BATCH and accessed - self._touched < TOUCH_INTERVAL:
+                return
+        self._flush_touches()
+
+    def _flush_touches(self):
+        with self._touches_lock:
+            touches = self._touches
+            self._touches = {}
+            self._touched = time.time()
+        if len(touches) == 0:
+            return
+        db = self._db()
+        with db:
+            db.executemany('UPDATE entries SET accessed = ?, priority = ? + ? * cost WHERE path = ?',
+                [(accessed, accessed, self._cost_weight, path) for (path, accessed) in touches.iteritems()])
+
+    def _forget(self, fnames):
+        """ Removes the index entries for files. """
+        db = self._db()
+        with db:
+            db.executemany('DELETE FROM entries WHERE path = ?', [(self._relative(fname),) for fname in fnames])
+
     def _get_num_entries(self):
-        count = 0
-        for _,_,files in os.walk(self._dir):
-            count += len(files)
-        return count
+        return self._db().execute('SELECT entries FROM totals').fetchone()[0]
     _num_entries = property(_get_num_entries)
 
+    def _get_size(self):
+        return self._db().execute('SELECT size FROM totals').fetchone()[0]
+    _size = property(_get_size)
+
     def clear(self):
+        self._memory.clear()
+        with self._touches_lock:
+            self._touches = {}
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+        # Locks that are held stay, so that their holders still exclude
+        # anyone else
+        self._prune_locks()
         try:
-            shutil.rmtree(self._dir)
+            names = os.listdir(self._dir)
         except (IOError, OSError):
-            pass
+            names = []
+        for name in names:
+            path = os.path.join(self._dir, name)
+            if path == self._locks:
+                continue
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except (IOError, OSError):
+                pass
@@ -1,11 +1,12 @@
 from django.core.cache import cache
-import logging, sys, csv, os, math, re, string, subprocess, time, stat
+import logging, sys, csv, os, math, re, string, subprocess, time, stat, random, multiprocessing, copy
 from plotty import settings
-from plotty.results.Utilities import present_value, present_value_csv, scenario_hash, length_cmp, t_quantile
+from plotty.results.Utilities import present_value, present_value_csv, scenario_hash, length_cmp, t_quantile, normdev, quantile, select_kth
 from plotty.results.Exceptions import LogTabulateStarted, PipelineError
 from plotty.results.CSVParser import parse_csv
-import tempfile
+import tempfile, hashlib
 import StringIO, urllib
+from array import array
 
 class Messages(object):
 
@@ -68,6 +69,7 @@ class DataTable:
             if cached_vals is None or cached_vals['last_modified'] < file_last_modified:
                 # cache is invalid, we need to reload
                 messages = Messages()
+                started = time.time()
                 try:
                     rows, lastModified, scenarioColumns, valueColumns = self.loadLog(log, wait, messages)
                 except LogTabulateStarted as e:
@@ -81,7 +83,7 @@ class DataTable:
                     'rows': rows,
                     'scenarioColumns': scenarioColumns,
                     'valueColumns': valueColumns,
-                    'messages': messages})
+                    'messages': messages}, cost=time.time() - started)
                 
                 logging.debug('For log %s: cache empty or expired, stored %d rows to cache.' % (log, len(rows)))
             else:
@@ -98,6 +100,7 @@ class DataTable:
             if self.lastModified < lastModified: 
                 self.lastModified = lastModified
         self.valueColumnsDisplay = dict([(x,x) for x in self.valueColumns])
+        self.invalidateIndexes()
 
     def __iter__(self):
         """ Lets us do `for row in datatable` instead of 
@@ -105,6 +108,187 @@ class DataTable:
         """
         return iter(self.rows)
 
+    def __getstate__(self):
+        """ The indexes are only valid for the lifetime of this object (and
+            can be rebuilt cheaply), so we don't pickle them into the cache.
+        """
+        state = self.__dict__.copy()
+        for key in ('_indexBase', '_indexRows', '_indexLive', '_scenarioIndexes', '_valueArrays'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.invalidateIndexes()
+
+    # Snapshots
+    #
+    # Rows, and lists of rows, are never modified once they are in a table.
+    # Blocks that change a row make a new DataRow instead (sharing whichever
+    # of its dictionaries they don't change), and put it in a new list of
+    # rows. This means a snapshot of a table only has to copy its columns,
+    # and shares its rows with the table it was taken from, so the result of
+    # every stage of a pipeline can be kept in memory for what it changed.
+
+    def snapshot(self):
+        """ Returns a copy of this table that is unaffected by any later
+            changes to it, sharing its rows and indexes.
+        """
+        snap = copy.copy(self)
+        snap.scenarioColumns = set(self.scenarioColumns)
+        snap.valueColumns = set(self.valueColumns)
+        snap.valueColumnsDisplay = dict(self.valueColumnsDisplay)
+        snap.messages = Messages()
+        snap.messages.extend(self.messages)
+        snap._scenarioIndexes = dict(self._scenarioIndexes)
+        snap._valueArrays = dict(self._valueArrays)
+        return snap
+
+    def diff(self, other):
+        """ Compares this table to another that shares rows with it, such as a
+            snapshot taken earlier. Returns a tuple (removed, added) of the
+            rows that are only in the other table and only in this one.
+        """
+        mine = set(map(id, self.rows))
+        theirs = set(map(id, other.rows))
+        removed = [row for row in other.rows if id(row) not in mine]
+        added = [row for row in self.rows if id(row) not in theirs]
+        return removed, added
+
+    # Indexes
+    #
+    # Indexes refer to rows by their row id, which is the row's position in
+    # self._indexBase - the list of rows at the time the first index was
+    # built. Blocks that only throw rows away (like FilterBlock) can use
+    # selectRows() to do so, and blocks that change rows can use
+    # replaceRows(), while keeping the indexes valid; assigning self.rows
+    # directly invalidates them. Blocks that change scenarios must call
+    # invalidateIndexes() on the columns they changed themselves.
+
+    def invalidateIndexes(self, scenarioColumns=None, valueColumns=None):
+        """ Throws away the indexes for the given scenario and value columns,
+            or all indexes if no columns are given.
+        """
+        if scenarioColumns is None and valueColumns is None:
+            self._indexBase = None
+            self._indexRows = None
+            self._indexLive = None
+            self._scenarioIndexes = {}
+            self._valueArrays = {}
+            return
+        for col in scenarioColumns or []:
+            self._scenarioIndexes.pop(col, None)
+        for col in valueColumns or []:
+            self._valueArrays.pop(col, None)
+
+    def _checkIndexes(self):
+        """ Make sure the indexes still refer to self.rows, and start a new
+            set of indexes if they don't.
+        """
+        if self._indexRows is not self.rows:
+            self.invalidateIndexes()
+            self._indexBase = self.rows
+            self._indexRows = self.rows
+            self._indexLive = None
+
+    def rowIds(self):
+        """ Returns the ids of the rows currently in the table, in order. """
+        self._checkIndexes()
+        if self._indexLive is None:
+            return range(len(self.rows))
+        return self._indexLive
+
+    def scenarioIndex(self, column):
+        """ Returns an inverted index for a scenario column, as a dictionary
+            mapping each value of that column to the set of ids of the rows
+            that take that value. Rows without the column are not indexed.
+            The index is built on demand and kept until the scenarios change.
+        """
+        self._checkIndexes()
+        if column not in self._scenarioIndexes:
+            index = {}
+            base = self._indexBase
+            for i in self.rowIds():
+                scenario = base[i].scenario
+                if column in scenario:
+                    val = scenario[column]
+                    if val in index:
+                        index[val].add(i)
+                    else:
+                        index[val] = set([i])
+            self._scenarioIndexes[column] = index
+        return self._scenarioIndexes[column]
+
+    def valueArray(self, column):
+        """ Returns a value column as a tuple (values, present). values is an
+            array of floats indexed by row id, which is NaN for rows without
+            the column, and present is the set of ids of the rows that have
+            the column. Built on demand, so that aggregates only need to be
+            converted to floats once.
+        """
+        self._checkIndexes()
+        if column not in self._valueArrays:
+            base = self._indexBase
+            values = array('d', [float('nan')]) * len(base)
+            present = set()
+            for i in self.rowIds():
+                rowValues = base[i].values
+                if column in rowValues:
+                    values[i] = float(rowValues[column])
+                    present.add(i)
+            self._valueArrays[column] = (values, present)
+        return self._valueArrays[column]
+
+    def valueRange(self, column, lowerbound, upperbound):
+        """ Returns the set of ids of the rows whose value for a column lies
+            between the given bounds (inclusive), comparing against the
+            column's array of values.
+        """
+        values, present = self.valueArray(column)
+        return set([i for i in present if lowerbound <= values[i] <= upperbound])
+
+    def columnStatistics(self):
+        """ Returns statistics describing the table, used to estimate the
+            effect of blocks without applying them. This is a dictionary of
+             * rows     -- the number of rows
+             * scenario -- maps each scenario column to its number of values
+             * values   -- maps each value column to the (min, max) of its
+                           values, or None if it has none (or they're unknown)
+        """
+        stats = {'rows': len(self.rows), 'scenario': {}, 'values': {}}
+        for col in self.scenarioColumns:
+            stats['scenario'][col] = len(self.scenarioIndex(col))
+        for col in self.valueColumns:
+            values, present = self.valueArray(col)
+            vals = [values[i] for i in present if values[i] == values[i]]
+            stats['values'][col] = (min(vals), max(vals)) if vals else None
+        return stats
+
+    def selectRows(self, ids):
+        """ Keeps only the rows with the given ids (which may be any iterable),
+            preserving their order and the indexes built so far.
+        """
+        self._checkIndexes()
+        live = sorted(ids)
+        base = self._indexBase
+        self.rows = [base[i] for i in live]
+        self._indexRows = self.rows
+        self._indexLive = live
+
+    def replaceRows(self, replacements):
+        """ Replaces rows, given as a dictionary mapping the ids of the rows
+            to replace to the new rows, preserving the indexes built so far.
+        """
+        live = self.rowIds()
+        if len(replacements) == 0:
+            return
+        base = list(self._indexBase)
+        for (i, row) in replacements.iteritems():
+            base[i] = row
+        self._indexBase = base
+        self.rows = [base[i] for i in live]
+        self._indexRows = self.rows
+
     def loadLog(self, log, wait, messages):
         """ Load a log file directly (services the cache)
             
@@ -318,7 +502,9 @@ class DataTable:
             # any other value column
             vals.add(expr)
 
-        for row in self.rows:
+        replacements = {}
+        for (i, row) in zip(self.rowIds(), self.rows):
+            values = dict(row.values)
             # Calculate derived cols first, since they might not be selected
             # in their own right.
             for name,code,subst in derived_vals:
@@ -326,11 +512,11 @@ class DataTable:
                 evaled_subst = {}
                 invalid = False
                 for token,key in subst.items():
-                    if key not in row.values:
+                    if key not in values:
                         invalid = True
                         break
                     else:
-                        evaled_subst[token] = row.values[key]
+                        evaled_subst[token] = values[key]
                 if invalid:
                     continue
                 
@@ -339,15 +525,18 @@ class DataTable:
                 # import statement, are available to the code. This is pretty good
                 # security, but does restrict us somewhat in mathematics.
                 try:
-                    row.values[name] = eval(code, {'__builtins__': None}, evaled_subst)
+                    values[name] = eval(code, {'__builtins__': None}, evaled_subst)
                 except:
                     continue
             
             # Now select the value columns we're after
-            for (key,val) in row.values.items():
+            for key in values.keys():
                 if key not in vals:
-                    del row.values[key]
+                    del values[key]
+            replacements[i] = DataRow(row.scenario, values)
 
+        self.replaceRows(replacements)
+        self.invalidateIndexes(valueColumns=self.valueColumns | vals)
         self.valueColumns = vals
         self.valueColumnsDisplay = dict([(x,x if x not in self.valueColumnsDisplay else self.valueColumnsDisplay[x]) for x in vals])
 
@@ -357,11 +546,9 @@ class DataTable:
             
             cols: a list of scenario columns to keep.
         """
-        for row in self.rows:
-            for (key,val) in row.scenario.items():
-                if key not in cols:
-                    del row.scenario[key]
+        self.rows = [DataRow(dict([(key, val) for (key, val) in row.scenario.iteritems() if key in cols]), row.values) for row in self.rows]
         self.scenarioColumns = set(cols)
+        self.invalidateIndexes()
 
     def getScenarioValues(self):
         scenarioValues = {}
@@ -370,21 +557,7 @@ class DataTable:
                 if col not in scenarioValues:
                     scenarioValues[col] = set()
                 scenarioValues[col].add(row.scenario[col])
-        for k in scenarioValues.iterkeys():
-            valuesList = list(scenarioValues[k])
-            formattedValues = []
-            otherValues = []
-            for v in valuesList:
-                if isinstance(v, ScenarioValue):
-                    formattedValues.append(v)
-                else:
-                    otherValues.append(v)
-            formattedValues.sort(key=lambda fv: fv.index)
-            otherValues.sort()
-            formattedValues.extend(otherValues)
-            scenarioValues[k] = formattedValues
-
-        return scenarioValues
+        return order_scenario_values(scenarioValues)
 
     def renderToTable(self):
         """ Renders the values in this data table into a HTML table. """
@@ -455,7 +628,9 @@ class DataTable:
 class DataRow:
     """ A simple object that holds a row of data. The data is stored in two
         dictionaries - DataRow.scenario for the scenario columns, and
-        DataRow.values for the value columns. 
+        DataRow.values for the value columns. Once a row is in a DataTable it
+        is never modified, since snapshots of the table may share it; a new
+        row is made instead.
     """
     def __init__(self, scenario=None, values=None):
         if scenario is None:
@@ -523,15 +698,24 @@ class DataAggregate:
         in which case relevant statistical techniques are used to determine
         the new confidence interval and standard deviation.
     """
+    # The aggregate types that report a quantile of the values, rather than
+    # an average
+    QUANTILES = {
+        'median': 0.5,
+        'p90': 0.9,
+        'p99': 0.99
+    }
+
     def __init__(self, newType):
         """ Create a new DataAggregate of the specified type.
         
-            newType: either 'mean' or 'geomean', the type of aggregate
-                     reported by this object.
+            newType: 'mean', 'geomean' or one of the QUANTILES, the type of
+                     aggregate reported by this object.
         """
         self.type = newType
         self._isValid = False
         self._values = []
+        self._interval = None
 
     # Private methods
     
@@ -576,7 +760,9 @@ class DataAggregate:
 
         self._min = valMin
         self._max = valMax
-        if self.type == 'geomean':
+        if self.type in DataAggregate.QUANTILES:
+            self._calculateQuantile(allow_cis)
+        elif self.type == 'geomean':
             if valLogSum is not None:
                 self._value = math.exp(valLogSum / n)
             else:
@@ -595,27 +781,74 @@ class DataAggregate:
             else:
                 self._stdev = 0
                 self._ciUp = self._ciDown = float('nan')
+
+        # A confidence interval computed elsewhere (see bootstrap_all) replaces
+        # the one computed here, along with the standard deviation it implies
+        # so that division uses the same interval
+        if self._interval is not None:
+            self._ciDown, self._ciUp = self._interval
+            tinv = t_quantile(1 - settings.CONFIDENCE_LEVEL, n-1)
+            self._stdev = (self._ciUp - self._ciDown) / (2 * tinv) * math.sqrt(n)
         
         self._isValid = True
 
+    def _calculateQuantile(self, allow_cis):
+        """ Calculates the summary statistics for a quantile aggregate. The
+            quantile and the bounds of its confidence interval are found by
+            selection rather than by sorting the values. The confidence
+            interval is the distribution-free one given by the binomial
+            distribution of the ranks (approximated by a normal), and the
+            standard deviation is the one implied by that interval, so that
+            division by other DataAggregates still works.
+        """
+        q = DataAggregate.QUANTILES[self.type]
+        vals = [float(v) for v in self._values]
+        n = len(vals)
+        self._value = quantile(vals, q)
+        self._stdev = 0
+        self._ciUp = self._ciDown = float('nan')
+        if not allow_cis:
+            return
+        z = -normdev((1 - settings.CONFIDENCE_LEVEL) / 2)
+        delta = z * math.sqrt(n * q * (1 - q))
+        # 1-based ranks of the bounds of the interval
+        lower = int(math.floor(n * q - delta))
+        upper = int(math.ceil(n * q + delta + 1))
+        if lower < 1 or upper > n:
+            return
+        self._ciDown = select_kth(vals, lower - 1)
+        self._ciUp = select_kth(vals, upper - 1)
+        self._stdev = (self._ciUp - self._ciDown) / (2 * z) * math.sqrt(n)
+
     # Mutators
     
     def append(self, value):
         """ Push a new value into this aggregate. """
         self._values.append(value)
+        self._interval = None
         self._isValid = False
     
     def map(self, func):
         """ Apply a function to every value in this aggregate. """
         self._isValid = False
+        self._interval = None
         self._values = map(func, self._values)
     
     def setType(self, newType):
         """ Change the type of this aggregate.
         
-            newType : either 'mean' or 'geomean'.
+            newType : 'mean', 'geomean' or one of the QUANTILES.
         """
         self.type = newType
+        self._interval = None
+        self._isValid = False
+
+    def setInterval(self, ciDown, ciUp):
+        """ Replace the confidence interval of this aggregate with one that
+            has been computed elsewhere, such as by bootstrap_all. The
+            interval is dropped again if the values or type change.
+        """
+        self._interval = (ciDown, ciUp)
         self._isValid = False
     
     def manual(self, value, ciUp, ciDown, newMin, newMax):
@@ -711,6 +944,14 @@ class DataAggregate:
             in this DataAggregate by the other value, and force the summary
             data to be regenerated.
         """
+        return self.divide(other)
+
+    def divide(self, other, tinvs=None):
+        """ Divides this DataAggregate by some other value, as for __div__.
+            tinvs is an optional dictionary used to memoise the t quantiles
+            by degrees of freedom, so that a batch of divisions (see
+            divide_all) only computes each quantile once.
+        """
         if isinstance(other, DataAggregate):
             #logging.debug(other)
             res = DataAggregate(self.type)
@@ -721,7 +962,13 @@ class DataAggregate:
             
             # Motulsky, 'Intuitive Biostatistics', pp285-6
             if self.value() <> 0 and other.value() <> 0:
-                tinv = t_quantile(1 - settings.CONFIDENCE_LEVEL, self.count() + other.count() - 2)
+                df = self.count() + other.count() - 2
+                if tinvs is None:
+                    tinv = t_quantile(1 - settings.CONFIDENCE_LEVEL, df)
+                elif df in tinvs:
+                    tinv = tinvs[df]
+                else:
+                    tinv = tinvs[df] = t_quantile(1 - settings.CONFIDENCE_LEVEL, df)
                 g = (tinv * (other.sem() / other.value()))**2
                 if g >= 1.0:
                     ciUp = ciDown = float('nan')
@@ -744,4 +991,114 @@ class DataAggregate:
         else:
             res = copy.copy(self)
             res.map(lambda d: d / float(other))
+            # An interval computed elsewhere scales with the values
+            if self._interval is not None:
+                (ciDown, ciUp) = (self._interval[0] / float(other), self._interval[1] / float(other))
+                if float(other) < 0:
+                    (ciDown, ciUp) = (ciUp, ciDown)
+                res.setInterval(ciDown, ciUp)
             return res
+
+def order_scenario_values(scenarioValues):
+    """ Turns a dictionary mapping each scenario column to the set of
+        values it takes into one mapping each column to a sorted list of
+        those values, with formatted values first (in format order).
+    """
+    for k in scenarioValues.iterkeys():
+        valuesList = list(scenarioValues[k])
+        formattedValues = []
+        otherValues = []
+        for v in valuesList:
+            if isinstance(v, ScenarioValue):
+                formattedValues.append(v)
+            else:
+                otherValues.append(v)
+        formattedValues.sort(key=lambda fv: (fv.index, fv.value))
+        otherValues.sort()
+        formattedValues.extend(otherValues)
+        scenarioValues[k] = formattedValues
+
+    return scenarioValues
+
+def divide_all(numerators, denominators):
+    """ Divides each of the numerators by the corresponding denominator,
+        returning a list of the results. This is equivalent to dividing each
+        pair in turn, except that the t quantiles needed for DataAggregates
+        are only computed once for each number of degrees of freedom, which
+        is where most of the time goes when normalising a large table.
+    """
+    tinvs = {}
+    results = []
+    for (num, den) in zip(numerators, denominators):
+        if isinstance(num, DataAggregate):
+            results.append(num.divide(den, tinvs))
+        else:
+            results.append(num / den)
+    return results
+
+def bootstrap_interval(job):
+    """ Computes a percentile bootstrap confidence interval for one aggregate.
+        job is a tuple (type, values, resamples, seed), where type is an
+        aggregate type and values are floats. Returns the interval as a tuple
+        (ciDown, ciUp). This is a plain function so it can be sent to a
+        process pool.
+    """
+    (aggType, vals, resamples, seed) = job
+    rng = random.Random(seed)
+    n = len(vals)
+    if aggType == 'geomean':
+        vals = [math.log(v) for v in vals]
+    stats = []
+    for i in xrange(resamples):
+        sample = [vals[int(rng.random() * n)] for j in xrange(n)]
+        if aggType in DataAggregate.QUANTILES:
+            stats.append(quantile(sample, DataAggregate.QUANTILES[aggType]))
+        else:
+            stats.append(math.fsum(sample) / n)
+    alpha = 1 - settings.CONFIDENCE_LEVEL
+    ciDown = quantile(stats, alpha / 2)
+    ciUp = quantile(stats, 1 - alpha / 2)
+    if aggType == 'geomean':
+        return (math.exp(ciDown), math.exp(ciUp))
+    return (ciDown, ciUp)
+
+def bootstrap_all(aggregates, resamples):
+    """ Replaces the confidence intervals of DataAggregates with percentile
+        bootstrap intervals. aggregates is a dictionary mapping a string
+        identifying each aggregate (such as its scenario hash and column) to
+        the aggregate. Each aggregate is resampled with its own generator,
+        seeded from settings.BOOTSTRAP_SEED and its identity, so its interval
+        depends neither on how the work is split up nor on which other
+        aggregates there are. The work is done in this process, unless
+        settings.BOOTSTRAP_PROCESSES opts in to a pool and there are enough
+        aggregates to spread over it.
+    """
+    jobs = []
+    targets = []
+    for (identity, agg) in sorted(aggregates.iteritems()):
+        vals = agg.values()
+        # Aggregates of aggregates and single values have no interval, and
+        # the geomean of non-positive values has none either
+        if len(vals) < 2 or any([isinstance(v, DataAggregate) for v in vals]):
+            continue
+        vals = [float(v) for v in vals]
+        if agg.type == 'geomean' and min(vals) <= 0:
+            continue
+        if isinstance(identity, unicode):
+            identity = identity.encode('utf-8')
+        seed = int(hashlib.md5('%d\0%s' % (settings.BOOTSTRAP_SEED, identity)).hexdigest(), 16)
+        jobs.append((agg.type, vals, resamples, seed))
+        targets.append(agg)
+
+    if settings.BOOTSTRAP_PROCESSES > 1 and len(jobs) >= settings.BOOTSTRAP_POOL_MIN_GROUPS:
+        pool = multiprocessing.Pool(settings.BOOTSTRAP_PROCESSES)
+        try:
+            intervals = pool.map(bootstrap_interval, jobs, max(1, len(jobs) / (4 * settings.BOOTSTRAP_PROCESSES)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        intervals = map(bootstrap_interval, jobs)
+
+    for (agg, (ciDown, ciUp)) in zip(targets, intervals):
+        agg.setInterval(ciDown, ciUp)
@@ -1,9 +1,10 @@
 import plotty.results.PipelineEncoder
 from django.core.cache import cache
-from django.db.models import Max
-from plotty.results.DataTypes import DataTable, DataRow, DataAggregate, Messages
+from plotty.results.DataTypes import DataTable, DataRow, DataAggregate, Messages, order_scenario_values
+from plotty.results.Utilities import measure, measured
 from plotty.results.Blocks import *
 from plotty.results.Exceptions import *
+from django.utils.hashcompat import md5_constructor
 import plotty.results.PipelineEncoder as PipelineEncoder
 import sys, traceback, logging, copy, os, time
 
@@ -15,8 +16,24 @@ BLOCK_MAPPINGS = {
     '5': ValueFilterBlock,
     '6': CompositeScenarioBlock,
     '7': FormatBlock,
+    '8': SortBlock,
+    '9': SampleBlock,
+    'a': OutlierBlock,
+    'b': ComparisonBlock,
 }
 
+# The time this process has spent writing pipeline results to the cache, and
+# the number of cells (rows times columns) in the tables it wrote, from which
+# Pipeline.keep estimates how long the next write will take
+CACHE_WRITES = {'time': 0.0, 'cells': 0}
+
+class BlockFailed(Exception):
+    """ Raised by Pipeline.compute when a block fails with a PipelineError or
+        PipelineAmbiguityException, so that Pipeline.apply can apply the
+        blocks before it again outside its lock, before raising the error. """
+    def __init__(self, error):
+        self.error = error
+
 class Pipeline(object):
     """ A Pipeline consists of selected log files, selected scenario columns and
         value columns, and a set of blocks.
@@ -26,6 +43,8 @@ class Pipeline(object):
         which results from applying a Pipeline to a set of data. """
 
     FLAG_NOTHING = 0
+    # Run the pipeline over a sample of the rows, for quick interactive use
+    FLAG_PREVIEW = 1 << 0
 
     def __init__(self, web_client=False):
         self.timestamp = time.time()
@@ -45,9 +64,22 @@ class Pipeline(object):
         # blocks
         self.cacheAvailableKey = ""
         self.cacheKeyBase = ""
+        # The last modified time of each of the logs, and of the formats the
+        # blocks use, keyed by (kind, key) as returned by dependencies
+        self.modified = {}
+        # A description of each step of the last apply, for explaining it,
+        # and of the cache lookups made by decode
+        self.trace = []
+        self.decodeTrace = []
+        # A snapshot of the latest result apply kept, keyed by cache key, so
+        # that the pipeline can be applied again (for example when a block
+        # fails) without going back to the cache
+        self.snapshots = {}
 
     def decode(self, encoded):
         """ Decodes an entire paramater string. """
+        self.decodeTrace = []
+        self.snapshots = {}
         try:
             parts = encoded.split(PipelineEncoder.BLOCK_SEPARATOR)
             # Flagword and pipeline-config are required
@@ -61,19 +93,26 @@ class Pipeline(object):
             if len(pipelineConfig) != 4:
                 raise PipelineError("Decode invalid because not enough pipeline-config parts")
             
-            self.logs = pipelineConfig[0].split(PipelineEncoder.PARAM_SEPARATOR)
+            # The logs are loaded in a fixed order, so that listing them in a
+            # different order describes the same pipeline
+            self.logs = sorted(pipelineConfig[0].split(PipelineEncoder.PARAM_SEPARATOR))
             self.scenarioCols = set(pipelineConfig[1].split(PipelineEncoder.PARAM_SEPARATOR))
             self.valueCols = set(pipelineConfig[2].split(PipelineEncoder.PARAM_SEPARATOR))
             # Filter whitespace-only values
             self.derivedValueCols = set(filter(lambda x: x != '', pipelineConfig[3].split(PipelineEncoder.PARAM_SEPARATOR)))
 
-            # Put the first two parts back into a string, to be used as a 
-            # cache key
-            # XXX TODO: we don't do anything sensible about sorting/order in
-            # the paramater lists, that would make two different encoded strings
-            # represent the same pipeline
+            # The cache keys are digests of the pipeline in a canonical form,
+            # in which the parameter lists are sorted and each block is
+            # encoded as its canonical() form, so that encoded strings that
+            # differ only in the order of their lists share cache entries
+            canonical = PipelineEncoder.BLOCK_SEPARATOR.join([str(self.flags), PipelineEncoder.GROUP_SEPARATOR.join([
+                PipelineEncoder.PARAM_SEPARATOR.join(self.logs),
+                PipelineEncoder.PARAM_SEPARATOR.join(sorted(self.scenarioCols)),
+                PipelineEncoder.PARAM_SEPARATOR.join(sorted(self.valueCols)),
+                PipelineEncoder.PARAM_SEPARATOR.join(sorted(self.derivedValueCols))])])
+            self.cacheKeyBase = self.cacheKey(canonical)
+
             encoded_cumulative = PipelineEncoder.BLOCK_SEPARATOR.join(parts[0:2])
-            self.cacheKeyBase = encoded_cumulative
 
             # Index 2 onwards are blocks
             for params in parts[2:]:
@@ -83,56 +122,382 @@ class Pipeline(object):
                 # Chomp the first character, the block ID
                 block = BLOCK_MAPPINGS[params[0]]()
                 block.decode(params[1:], encoded_cumulative)
-                self.blocks.append((block, encoded_cumulative))
+                canonical += PipelineEncoder.BLOCK_SEPARATOR + params[0] + block.canonical(params[1:])
+                self.blocks.append((block, self.cacheKey(canonical)))
             
             # Now try to determine how late in the pipeline we can load from
-            # an existing cache.
-            # First, get a date to test with - if cached values are older than
-            # the last modified date of the log file(s), we can't use them
-            lastModified = 0
-            for l in self.logs:
-                mtime = os.path.getmtime(os.path.join(settings.BM_LOG_DIR, l))
-                if mtime > lastModified:
-                    lastModified = mtime
-
-
-            usedFormats = [b.key for (b, ec) in self.blocks if isinstance(b, FormatBlock)]
-            if len(usedFormats) > 0:
-                lastModifiedFormat = FormatStyle.objects.filter(key__in=usedFormats).aggregate(Max('modified'))['modified__max']
-                if lastModifiedFormat:
-                    lastModifiedFormat = time.mktime(lastModifiedFormat.timetuple())
-                    if (lastModifiedFormat > lastModified):
-                        lastModified = lastModifiedFormat
-
-            usedFormats = [b.format_key for (b, ec) in self.blocks if isinstance(b, GraphBlock)]
-            if len(usedFormats) > 0:
-                lastModifiedFormat = GraphFormat.objects.filter(key__in=usedFormats).aggregate(Max('modified'))['modified__max']
-                if lastModifiedFormat:
-                    lastModifiedFormat = time.mktime(lastModifiedFormat.timetuple())
-                    if (lastModifiedFormat > lastModified):
-                        lastModified = lastModifiedFormat
-
-            # Now work backwards, checking where we can break into the
-            # pipeline. 
-            for idx in range(len(parts), 1, -1):
-                possibleCacheKey = PipelineEncoder.BLOCK_SEPARATOR.join(parts[:idx])
-                cacheValue = cache.get(possibleCacheKey)
-                if cacheValue != None:
-                    if cacheValue['last_modified'] >= lastModified:
-                        logging.debug("Found partial result %s in the cache" % possibleCacheKey)
-                        # Good cache value, let's use it
-                        self.cacheAvailableKey = possibleCacheKey
-                        self.cacheAvailableIndex = idx - 2 # Account for the first two chunks
-                        break
-                    else:
-                        # Too old, clean it up
-                        cache.delete(possibleCacheKey)
+            # an existing cache. Cached values are only used if nothing they
+            # depend on has changed since they were cached.
+            self.modified = self.modifiedTimes()
 
+            self.probeCache(self.decodeTrace)
 
         except:
             raise PipelineLoadException(*sys.exc_info())
-        
+
+    def probeCache(self, trace=None):
+        """ Works backwards through the pipeline, checking where we can break
+            into it from the cache. Only the headers of the cache entries are
+            read here; apply reads the value of the one we pick. """
+        self.cacheAvailableIndex = -1
+        self.cacheAvailableKey = ""
+        for idx in range(len(self.blocks), -1, -1):
+            possibleCacheKey = self.stepKey(idx)
+            header = self.cacheGetHeader(possibleCacheKey, trace)
+            if header != None:
+                if self.upToDate(header):
+                    logging.debug("Found partial result %s in the cache" % possibleCacheKey)
+                    # Good cache value, let's use it
+                    self.cacheAvailableKey = possibleCacheKey
+                    self.cacheAvailableIndex = idx
+                    break
+                else:
+                    # Too old, clean it up
+                    cache.delete(possibleCacheKey)
+
+    def preview(self):
+        """ Cuts the data table down to a sample of its rows, so that a
+            pipeline can be built up quickly before running it on all the
+            data. """
+        total = len(self.dataTable.rows)
+        if total <= settings.PREVIEW_ROWS:
+            return
+        sample = SampleBlock()
+        sample.size = settings.PREVIEW_ROWS
+        sample.seed = settings.PREVIEW_SEED
+        sample.apply(self.dataTable, self.messages)
+        self.messages.info("Previewing a sample of %d of the %d rows" % (len(self.dataTable.rows), total))
+
+    def cacheBytes(self):
+        """ Returns the number of bytes read from and written to the cache so
+            far, as far as the cache backend counts them. """
+        return (getattr(cache, 'bytes_read', 0), getattr(cache, 'bytes_written', 0))
+
+    def cacheGet(self, key, trace=None):
+        """ Gets a value from the cache, adding an entry for the lookup to the
+            given trace (by default, the trace of this apply). """
+        started = measure()
+        cacheBefore = self.cacheBytes()
+        value = cache.get(key)
+        self.traceCache('cache get', key, started, cacheBefore, trace, 'hit' if value is not None else 'miss')
+        return value
+
+    def cacheGetHeader(self, key, trace=None):
+        """ Gets the header of a value in the cache, like cacheGet. """
+        started = measure()
+        cacheBefore = self.cacheBytes()
+        header = cache.get_header(key)
+        self.traceCache('cache probe', key, started, cacheBefore, trace, 'hit' if header is not None else 'miss')
+        return header
+
+    def cacheLoad(self):
+        """ Gets the value decode found in the cache, or None if it has been
+            culled since, in which case the pipeline is applied from the
+            start. """
+        cacheValue = self.cacheGet(self.cacheAvailableKey)
+        if cacheValue is None:
+            logging.debug("Partial result %s left the cache after decoding" % self.cacheAvailableKey)
+            self.cacheAvailableIndex = -1
+            self.cacheAvailableKey = ""
+        return cacheValue
+
+    def cacheSet(self, key, value, cost=0, header=None):
+        """ Puts a value in the cache, adding an entry for it to the trace.
+            cost is the time in seconds it took to compute the value, and
+            header describes it for cacheGetHeader. """
+        started = measure()
+        cacheBefore = self.cacheBytes()
+        cache.set(key, value, cost=cost, header=header)
+        self.traceCache('cache set', key, started, cacheBefore)
+
+    def cacheKey(self, canonical):
+        """ Returns the cache key for a pipeline in canonical form. """
+        if isinstance(canonical, unicode):
+            canonical = canonical.encode('utf-8')
+        return 'pipeline:' + md5_constructor(canonical).hexdigest()
+
+    def stepKey(self, index):
+        """ Returns the cache key for the result of the first index blocks. """
+        if index == 0:
+            return self.cacheKeyBase
+        return self.blocks[index - 1][1]
+
+    def keep(self, index, value, cost=0):
+        """ Caches the result of the first index blocks, and keeps a snapshot
+            of it in memory in place of the one before, which is no use once
+            there is a later one. Snapshots share rows with the data table,
+            so they cost only what the following steps change. cost is the
+            time in seconds it took to compute the result from the last
+            result that was cached.
+
+            The result of the whole pipeline is always cached, but the result
+            of part of it is only cached if computing it took at least
+            settings.CACHE_CHECKPOINT_RATIO times as long as writing it is
+            expected to; otherwise it is cheaper to compute again from the
+            last result that was. Returns True if the result was cached. """
+        key = self.stepKey(index)
+        snapshot = dict(value)
+        for k in ('block_values', 'block_values_display', 'block_scenario_values', 'block_scenario_display', 'graph_outputs'):
+            snapshot[k] = list(value[k])
+        snapshot['data_table'] = value['data_table'].snapshot()
+        self.snapshots = {key: snapshot}
+
+        table = value['data_table']
+        cells = len(table.rows) * (len(table.scenarioColumns) + len(table.valueColumns))
+        if index < len(self.blocks) and CACHE_WRITES['cells'] > 0:
+            estimate = CACHE_WRITES['time'] * cells / CACHE_WRITES['cells']
+            if cost < settings.CACHE_CHECKPOINT_RATIO * estimate:
+                self.trace.append(self.traceEntry('cache skip', None,
+                    rows_out=None, scenario_columns=None, value_columns=None,
+                    key=key,
+                    note='computed in %.1f ms, writing would take about %.1f ms' % (cost * 1000, estimate * 1000)))
+                return False
+
+        started = measure()
+        self.cacheSet(key, value, cost, {
+            'rows': len(table.rows),
+            'dependencies': dict([(dep, self.modified.get(dep)) for dep in self.dependencies(index)])
+        })
+        CACHE_WRITES['time'] += measured(started)['time']
+        CACHE_WRITES['cells'] += cells
+        return True
+
+    def dependencies(self, index):
+        """ Returns what the result of the first index blocks depends on
+            besides the pipeline itself - the log files, and the formats
+            used by those blocks - as a list of (kind, key) tuples. """
+        deps = [('log', l) for l in self.logs]
+        for (block, cacheKey) in self.blocks[:index]:
+            if isinstance(block, FormatBlock):
+                deps.append(('format', block.key))
+            elif isinstance(block, GraphBlock):
+                deps.append(('graphformat', block.format_key))
+        return deps
+
+    def modifiedTimes(self):
+        """ Returns the last modified time of each of the logs and of the
+            formats used by the blocks, as a dictionary keyed by (kind, key).
+            A format that doesn't exist has no time. """
+        modified = {}
+        for l in self.logs:
+            modified[('log', l)] = os.path.getmtime(os.path.join(settings.BM_LOG_DIR, l))
+
+        deps = self.dependencies(len(self.blocks))
+        keys = [key for (kind, key) in deps if kind == 'format']
+        for key in keys:
+            modified[('format', key)] = None
+        if len(keys) > 0:
+            for (key, mtime) in FormatStyle.objects.filter(key__in=keys).values_list('key', 'modified'):
+                modified[('format', key)] = time.mktime(mtime.timetuple())
+
+        # Graph formats inherit from their parents, so a graph format was
+        # last modified when it or any of its ancestors was
+        keys = [key for (kind, key) in deps if kind == 'graphformat']
+        for key in keys:
+            modified[('graphformat', key)] = None
+        if len(keys) > 0:
+            for graphFormat in GraphFormat.objects.filter(key__in=keys):
+                mtime = 0
+                seen = set()
+                ancestor = graphFormat
+                while ancestor is not None and ancestor.key not in seen:
+                    seen.add(ancestor.key)
+                    mtime = max(mtime, time.mktime(ancestor.modified.timetuple()))
+                    ancestor = ancestor.parent
+                modified[('graphformat', graphFormat.key)] = mtime
+        return modified
+
+    def upToDate(self, header):
+        """ Returns True if none of the dependencies recorded in a cache
+            entry's header have changed since it was cached, so that editing
+            a format only invalidates the results of the blocks after the
+            first one using it. """
+        deps = header.get('dependencies')
+        if not isinstance(deps, dict):
+            return False
+        for (dep, mtime) in deps.iteritems():
+            if dep not in self.modified or self.modified[dep] != mtime:
+                return False
+        return True
+
+    def snapshotAvailableIndex(self):
+        """ Returns how much of the pipeline the latest snapshot covers, like
+            cacheAvailableIndex, or -1 if there is no snapshot. """
+        for idx in range(len(self.blocks), -1, -1):
+            if self.stepKey(idx) in self.snapshots:
+                return idx
+        return -1
+
+    def traceCache(self, operation, key, started, cacheBefore, trace=None, note=''):
+        (read, written) = self.cacheBytes()
+        (self.trace if trace is None else trace).append(self.traceEntry(operation, None,
+            rows_out=None, scenario_columns=None, value_columns=None,
+            cache_read=read - cacheBefore[0],
+            cache_written=written - cacheBefore[1],
+            key=key,
+            note=note,
+            **measured(started)))
+
+    def traceEntry(self, block, index, **fields):
+        """ Describes a step of applying the pipeline, for explaining it.
+            Fields that aren't given are taken from the data table as it is
+            now. Times are in seconds, and memory (the growth in the peak
+            memory use of the process) in kilobytes. Cache operations are
+            traced on their own as well as in the step that made them. """
+        entry = {
+            'block': block,
+            'index': index,
+            'rows_in': None,
+            'rows_out': len(self.dataTable.rows) if self.dataTable else None,
+            'scenario_columns': len(self.dataTable.scenarioColumns) if self.dataTable else None,
+            'value_columns': len(self.dataTable.valueColumns) if self.dataTable else None,
+            'groups': None,
+            'time': 0.0,
+            'cpu': 0.0,
+            'memory': 0,
+            'cache_read': 0,
+            'cache_written': 0,
+            'cached': False,
+            'note': ''
+        }
+        entry.update(fields)
+        return entry
+
+    def explain(self):
+        """ Explains the pipeline without running the blocks that aren't
+            cached. The table is loaded (from the cache, if possible) and the
+            effect of each block that follows is estimated from its column
+            statistics. Returns a list of trace entries like those recorded
+            by apply, with estimated row and group counts. """
+        if len(self.logs) == 0:
+            raise PipelineError("No log files are selected.", 'selected log files')
+
+        self.trace = list(self.decodeTrace)
+        started = measure()
+        cacheBefore = self.cacheBytes()
+        cacheValue = self.cacheLoad() if self.cacheAvailableIndex > -1 else None
+        if cacheValue is not None:
+            self.dataTable = cacheValue['data_table']
+            self.messages = self.dataTable.messages
+            self.traceCached(started, cacheBefore)
+        else:
+            try:
+                self.dataTable = DataTable(logs=self.logs, wait=not self.webClient)
+                self.messages = self.dataTable.messages
+                self.traceCached(started, cacheBefore)
+                started = measure()
+                rowsIn = len(self.dataTable.rows)
+                self.dataTable.selectScenarioColumns(self.scenarioCols)
+                self.dataTable.selectValueColumns(self.valueCols, self.derivedValueCols)
+                if self.flags & Pipeline.FLAG_PREVIEW:
+                    self.preview()
+                self.trace.append(self.traceEntry('select', None, rows_in=rowsIn, **measured(started)))
+            except (LogTabulateStarted, PipelineError, PipelineAmbiguityException):
+                raise
+            except:
+                raise PipelineLoadException(*sys.exc_info())
+
+        stats = self.dataTable.columnStatistics()
+        firstBlockToRun = 0 if self.cacheAvailableIndex == -1 else self.cacheAvailableIndex
+        for i,(block,cacheKey) in enumerate(self.blocks[firstBlockToRun:]):
+            started = measure()
+            try:
+                (new_stats, groups) = block.estimate(stats)
+            except:
+                raise PipelineBlockException(i+firstBlockToRun, *sys.exc_info())
+            self.trace.append(self.traceEntry(block.__class__.__name__, i+firstBlockToRun,
+                rows_in=int(round(stats['rows'])),
+                rows_out=int(round(new_stats['rows'])),
+                scenario_columns=len(new_stats['scenario']),
+                value_columns=len(new_stats['values']),
+                groups=None if groups is None else int(round(groups)),
+                note='estimated',
+                **measured(started)))
+            stats = new_stats
+        return self.trace
+
+    def traceCached(self, started, cacheBefore, index=None, note=''):
+        """ Adds trace entries for loading the data table, and for the blocks
+            that were served from the cache (or, given the index they end at,
+            from a snapshot). """
+        if index is None:
+            index = self.cacheAvailableIndex
+        (read, written) = self.cacheBytes()
+        if index == -1:
+            self.trace.append(self.traceEntry('load', None,
+                cache_read=read - cacheBefore[0],
+                cache_written=written - cacheBefore[1],
+                **measured(started)))
+            return
+        # Only the table after the last cached block was actually loaded, so
+        # that is the only one we know anything about
+        steps = [('load', None)] + [(block.__class__.__name__, i) for i,(block,cacheKey) in enumerate(self.blocks[:index])]
+        for (name, step) in steps[:-1]:
+            self.trace.append(self.traceEntry(name, step, cached=True,
+                rows_out=None, scenario_columns=None, value_columns=None,
+                note=note))
+        (name, step) = steps[-1]
+        self.trace.append(self.traceEntry(name, step, cached=True,
+            cache_read=read - cacheBefore[0],
+            note=note,
+            **measured(started)))
+
+    def pushdownCount(self, start):
+        """ Returns the number of blocks straight after the one at index
+            start that can be applied before it without changing the result,
+            given the current data table. """
+        block = self.blocks[start][0]
+        end = start + 1
+        while end < len(self.blocks) and block.commutesWith(self.blocks[end][0], self.dataTable):
+            end += 1
+        return end - start - 1
+
+    def rowLocalRun(self, start):
+        """ Returns the number of consecutive row-local blocks starting at
+            index start (or 1 if the block at start isn't row-local). """
+        end = start + 1
+        if self.blocks[start][0].ROW_LOCAL:
+            while end < len(self.blocks) and self.blocks[end][0].ROW_LOCAL:
+                end += 1
+        return end - start
+
     def apply(self):
+        """ Applies the pipeline, returning the values for each block and the
+            graphs. Only one process computes a pipeline at once: any others
+            wait for it to finish, and then load its result from the cache.
+            If it takes longer than settings.PIPELINE_LOCK_TIMEOUT they give
+            up waiting and compute the pipeline themselves. """
+        finalIndex = len(self.blocks)
+        try:
+            if self.cacheAvailableIndex == finalIndex or self.snapshotAvailableIndex() == finalIndex or len(self.logs) == 0:
+                return self.compute()
+            with cache.lock(self.stepKey(finalIndex), settings.PIPELINE_LOCK_TIMEOUT) as lock:
+                if lock.waited:
+                    if not lock.acquired:
+                        logging.warning("Gave up waiting for another process to apply %s" % self.stepKey(finalIndex))
+                    # What the cache holds may have changed while we waited
+                    self.decodeTrace = []
+                    self.probeCache(self.decodeTrace)
+                return self.compute()
+        except BlockFailed as failed:
+            e = failed.error
+            # Remove this block + the rest of the pipeline, and try again
+            # This is safe - if we've gotten to this point, everything
+            # before this block has already worked. The lock has been
+            # released by now, so others can apply the pipeline meanwhile.
+            del self.blocks[e.block:]
+            (block_scenario_values, block_scenario_display, block_values, block_values_display, graph_outputs) = self.apply()
+            e.dataTable = self.dataTable
+            e.messages = self.messages
+            e.graph_outputs = graph_outputs
+            e.block_values = block_values
+            e.block_values_display = block_values_display
+            e.block_scenario_values = block_scenario_values
+            e.block_scenario_display = block_scenario_display
+            raise e
+
+    def compute(self):
+        """ Applies the pipeline, without waiting for any other process. """
         if len(self.logs) == 0:
             raise PipelineError("No log files are selected.", 'selected log files')
         
@@ -151,9 +516,29 @@ class Pipeline(object):
         def extractValueDisplay(display, cols):
             return [v.display if isinstance(v, ScenarioValue) else str(v) for v in [display[x] for x in cols]]
 
-        # Preempt the pipeline if necessary
-        if self.cacheAvailableIndex > -1:
-            cacheValue = cache.get(self.cacheAvailableKey)
+        self.trace = list(self.decodeTrace)
+        started = measure()
+        cacheBefore = self.cacheBytes()
+
+        # Preempt the pipeline if necessary, from a snapshot if there is one
+        # at least as late as the cache
+        availableIndex = self.snapshotAvailableIndex()
+        useSnapshot = availableIndex > -1 and availableIndex >= self.cacheAvailableIndex
+        cacheValue = None
+        if not useSnapshot and self.cacheAvailableIndex > -1:
+            cacheValue = self.cacheLoad()
+        if useSnapshot:
+            snapshot = self.snapshots[self.stepKey(availableIndex)]
+            self.dataTable = snapshot['data_table'].snapshot()
+            self.messages = self.dataTable.messages
+            graph_outputs = list(snapshot['graph_outputs'])
+            block_scenario_values = list(snapshot['block_scenario_values'])
+            block_scenario_display = list(snapshot['block_scenario_display'])
+            block_values = list(snapshot['block_values'])
+            block_values_display = list(snapshot['block_values_display'])
+            self.traceCached(started, cacheBefore, availableIndex, 'snapshot')
+        elif cacheValue is not None:
+            availableIndex = self.cacheAvailableIndex
             self.dataTable = cacheValue['data_table']
             self.messages = self.dataTable.messages
             graph_outputs = cacheValue['graph_outputs']
@@ -161,10 +546,17 @@ class Pipeline(object):
             block_scenario_display = cacheValue['block_scenario_display']
             block_values = cacheValue['block_values']
             block_values_display = cacheValue['block_values_display']
+            self.traceCached(started, cacheBefore)
         else:
+            availableIndex = -1
             try:
                 self.dataTable = DataTable(logs=self.logs, wait=not self.webClient)
                 self.messages = self.dataTable.messages
+                self.traceCached(started, cacheBefore)
+                loadTime = measured(started)['time']
+                started = measure()
+                cacheBefore = self.cacheBytes()
+                rowsIn = len(self.dataTable.rows)
 
                 # Values for the pipeline
                 selectedValueCols = list(self.dataTable.valueColumns)
@@ -180,6 +572,8 @@ class Pipeline(object):
                 # Values before the first block.
                 self.dataTable.selectScenarioColumns(self.scenarioCols)
                 self.dataTable.selectValueColumns(self.valueCols, self.derivedValueCols)
+                if self.flags & Pipeline.FLAG_PREVIEW:
+                    self.preview()
                 selectedValueCols = list(self.dataTable.valueColumns)
                 selectedValueCols.sort()
                 selectedScenarioCols = list(self.dataTable.scenarioColumns)
@@ -191,7 +585,10 @@ class Pipeline(object):
                 block_scenario_display.append(extractDisplay(scenarioValues))
 
                 # Cache it
-                cache.set(self.cacheKeyBase, {
+                cacheTrace = len(self.trace)
+                selectCost = measured(started)
+                uncached = loadTime + selectCost['time']
+                if self.keep(0, {
                     'last_modified': self.timestamp,
                     'data_table': self.dataTable,
                     'block_values': block_values,
@@ -199,7 +596,14 @@ class Pipeline(object):
                     'block_scenario_values': block_scenario_values,
                     'block_scenario_display': block_scenario_display,
                     'graph_outputs': graph_outputs
-                })
+                }, uncached):
+                    uncached = 0.0
+                (read, written) = self.cacheBytes()
+                self.trace.insert(cacheTrace, self.traceEntry('select', None,
+                    rows_in=rowsIn,
+                    cache_read=read - cacheBefore[0],
+                    cache_written=written - cacheBefore[1],
+                    **selectCost))
             except LogTabulateStarted:
                 raise
             except PipelineAmbiguityException as e:
@@ -214,61 +618,175 @@ class Pipeline(object):
             except:
                 raise PipelineLoadException(*sys.exc_info())
 
-        # e.g. if cacheAvailableIndex = 2, we've already loaded the output up to
+        # e.g. if availableIndex = 2, we've already loaded the output up to
         # and including block 2, so the first block to run is block 3, but
         # self.blocks is zero-indexed, so the first index to run is 2
-        firstBlockToRun = 0 if self.cacheAvailableIndex == -1 else self.cacheAvailableIndex
-        for i,(block,cacheKey) in enumerate(self.blocks[firstBlockToRun:]):
+        firstBlockToRun = 0 if availableIndex == -1 else availableIndex
+        if availableIndex != -1:
+            # The time spent since the last result that was cached
+            uncached = 0.0
+        i = firstBlockToRun
+        while i < len(self.blocks):
+            # Filters that can't change the result are moved ahead of the
+            # block they follow, so that it has fewer rows to work on.
+            # Otherwise, runs of consecutive row-local blocks are fused into a
+            # single pass over the rows. Either way each block still gets its
+            # own entry in the block values, so the UI can't tell the
+            # difference.
+            pushed = self.pushdownCount(i)
+            runLength = pushed + 1 if pushed > 0 else self.rowLocalRun(i)
+            current = i
+            started = measure()
+            cacheBefore = self.cacheBytes()
+            rowsIn = len(self.dataTable.rows)
+            stageTrace = []
             try:
-                ret = block.apply(self.dataTable, self.messages)
-            except PipelineAmbiguityException as e:
-                e.block = i + firstBlockToRun
-                # Remove this block + the rest of the pipeline, and try again
-                # This is safe - if we've gotten to this point, everything
-                # before this block has already worked
-                del self.blocks[i+firstBlockToRun:]
-                (block_scenario_values, block_scenario_display, block_values, block_values_display, graph_outputs) = self.apply()
-                e.dataTable = self.dataTable
-                e.messages = self.messages
-                e.graph_outputs = graph_outputs
-                e.block_values = block_values
-                e.block_values_display = block_values_display
-                e.block_scenario_values = block_scenario_values
-                e.block_scenario_display = block_scenario_display
-                raise e
-            except PipelineError as e :
-                e.block = i + firstBlockToRun
-                # Remove this block + the rest of the pipeline, and try again
-                # This is safe - if we've gotten to this point, everything
-                # before this block has already worked
-                del self.blocks[i+firstBlockToRun:]
-                (block_scenario_values, block_scenario_display, block_values, block_values_display, graph_outputs) = self.apply()
-                e.dataTable = self.dataTable
-                e.messages = self.messages
-                e.graph_outputs = graph_outputs
-                e.block_values = block_values
-                e.block_values_display = block_values_display
-                e.block_scenario_values = block_scenario_values
-                e.block_scenario_display = block_scenario_display
-                raise e
+                if pushed > 0:
+                    # The scenario values after the moved block, and after
+                    # each filter but the last, are worked out from the rows
+                    # left at that point. None of these blocks change the
+                    # value columns.
+                    block = self.blocks[i][0]
+                    stages = [block.scenarioValuesAfter(self.dataTable)]
+                    for current in range(i + 1, i + runLength):
+                        stageStarted = measure()
+                        stageRowsIn = len(self.dataTable.rows)
+                        self.blocks[current][0].apply(self.dataTable, self.messages)
+                        stageTrace.append(self.traceEntry(self.blocks[current][0].__class__.__name__, current,
+                            rows_in=stageRowsIn,
+                            note='moved ahead of block %d' % (i + 1),
+                            **measured(stageStarted)))
+                        if current < i + pushed:
+                            stages.append(block.scenarioValuesAfter(self.dataTable))
+                    current = i
+                    stageRowsIn = len(self.dataTable.rows)
+                    block.apply(self.dataTable, self.messages)
+                    stages.append(None)
+                    # The moved block is charged with everything the filters
+                    # weren't, including working out its scenario values
+                    cost = measured(started)
+                    for key in cost:
+                        cost[key] -= sum([t[key] for t in stageTrace])
+                    stageTrace.insert(0, self.traceEntry(block.__class__.__name__, i,
+                        rows_in=stageRowsIn,
+                        groups=block.group_count,
+                        note='applied after block %d' % (i + 2) if pushed == 1 else 'applied after blocks %d-%d' % (i + 2, i + runLength),
+                        **cost))
+                elif runLength > 1:
+                    stages = []
+                    stageValues = []
+                    stageValuesDisplay = []
+                    stageColumns = []
+                    indexed = self.blocks[i][0].INDEXED
+                    for current in range(i, i + runLength):
+                        block = self.blocks[current][0]
+                        if current == i and indexed:
+                            block.apply(self.dataTable, self.messages)
+                        else:
+                            block.prepare(self.dataTable, self.messages)
+                        selectedValueCols = list(self.dataTable.valueColumns)
+                        selectedValueCols.sort()
+                        stageValues.append(selectedValueCols)
+                        stageValuesDisplay.append(extractValueDisplay(self.dataTable.valueColumnsDisplay, selectedValueCols))
+                        stageColumns.append((len(self.dataTable.scenarioColumns), len(selectedValueCols)))
+                        stages.append((current, block, {}))
+
+                    # Push each row through the run, recording the scenario
+                    # values it has after every block it survives. An indexed
+                    # first block has already selected the rows, so they only
+                    # need its scenario values recorded.
+                    rows = []
+                    dropped = [0] * runLength
+                    first = 0
+                    if indexed:
+                        dropped[0] = rowsIn - len(self.dataTable.rows)
+                        first = 1
+                    for row in self.dataTable:
+                        for current, block, scenarioValues in stages:
+                            if current - i >= first:
+                                row = block.applyRow(row)
+                            if row is None:
+                                dropped[current - i] += 1
+                                break
+                            for col in row.scenario:
+                                if col in scenarioValues:
+                                    scenarioValues[col].add(row.scenario[col])
+                                else:
+                                    scenarioValues[col] = set([row.scenario[col]])
+                        else:
+                            rows.append(row)
+                    self.dataTable.rows = rows
+
+                    for current, block, scenarioValues in stages[first:]:
+                        block.finish(self.dataTable, self.messages)
+
+                    # The whole run is charged to its first block
+                    cost = measured(started)
+                    stageRowsIn = rowsIn
+                    for k, (current, block, scenarioValues) in enumerate(stages):
+                        stageTrace.append(self.traceEntry(block.__class__.__name__, current,
+                            rows_in=stageRowsIn,
+                            rows_out=stageRowsIn - dropped[k],
+                            scenario_columns=stageColumns[k][0],
+                            value_columns=stageColumns[k][1],
+                            note='fused with blocks %d-%d' % (i + 1, i + runLength),
+                            **(cost if k == 0 else {})))
+                        stageRowsIn -= dropped[k]
+                else:
+                    block = self.blocks[i][0]
+                    block.timings = []
+                    ret = block.apply(self.dataTable, self.messages)
+                    stageTrace.append(self.traceEntry(block.__class__.__name__, i,
+                        rows_in=rowsIn,
+                        groups=block.group_count,
+                        **measured(started)))
+            except (PipelineAmbiguityException, PipelineError) as e:
+                # apply() tries the blocks before this one again
+                e.block = current
+                raise BlockFailed(e)
             except:
-                raise PipelineBlockException(i+firstBlockToRun, *sys.exc_info())
-            
-            if isinstance(block, GraphBlock):
-                graph_outputs.append(ret)
-            
-            selectedValueCols = list(self.dataTable.valueColumns)
-            selectedValueCols.sort()
-            selectedScenarioCols = list(self.dataTable.scenarioColumns)
-            selectedScenarioCols.sort()
-            block_values.append(selectedValueCols)
-            block_values_display.append(extractValueDisplay(self.dataTable.valueColumnsDisplay, selectedValueCols))
-            scenarioValues = self.dataTable.getScenarioValues()
-            block_scenario_values.append(extractValues(scenarioValues))
-            block_scenario_display.append(extractDisplay(scenarioValues))
-
-            # Cache it
-            cache.set(cacheKey, {
+                raise PipelineBlockException(current, *sys.exc_info())
+
+            if pushed > 0:
+                selectedValueCols = list(self.dataTable.valueColumns)
+                selectedValueCols.sort()
+                for scenarioValues in stages:
+                    if scenarioValues is None:
+                        scenarioValues = self.dataTable.getScenarioValues()
+                    else:
+                        scenarioValues = order_scenario_values(scenarioValues)
+                    block_values.append(selectedValueCols)
+                    block_values_display.append(extractValueDisplay(self.dataTable.valueColumnsDisplay, selectedValueCols))
+                    block_scenario_values.append(extractValues(scenarioValues))
+                    block_scenario_display.append(extractDisplay(scenarioValues))
+            elif runLength > 1:
+                for k, (current, block, scenarioValues) in enumerate(stages):
+                    scenarioValues = order_scenario_values(scenarioValues)
+                    block_values.append(stageValues[k])
+                    block_values_display.append(stageValuesDisplay[k])
+                    block_scenario_values.append(extractValues(scenarioValues))
+                    block_scenario_display.append(extractDisplay(scenarioValues))
+            else:
+                if isinstance(block, GraphBlock):
+                    graph_outputs.append(ret)
+
+                selectedValueCols = list(self.dataTable.valueColumns)
+                selectedValueCols.sort()
+                selectedScenarioCols = list(self.dataTable.scenarioColumns)
+                selectedScenarioCols.sort()
+                block_values.append(selectedValueCols)
+                block_values_display.append(extractValueDisplay(self.dataTable.valueColumnsDisplay, selectedValueCols))
+                scenarioValues = self.dataTable.getScenarioValues()
+                block_scenario_values.append(extractValues(scenarioValues))
+                block_scenario_display.append(extractDisplay(scenarioValues))
+
+            # Cache it. Only the table after the last block of a reordered or
+            # fused run is ever built, so that is the only one that can be
+            # cached.
+            i += runLength
+            cacheTrace = len(self.trace)
+            uncached += measured(started)['time']
+            if self.keep(i, {
                 'last_modified': self.timestamp,
                 'data_table': self.dataTable,
                 'block_values': block_values,
@@ -276,7 +794,14 @@ class Pipeline(object):
                 'block_scenario_values': block_scenario_values,
                 'block_scenario_display': block_scenario_display,
                 'graph_outputs': graph_outputs
-            })
-
+            }, uncached):
+                uncached = 0.0
+            (read, written) = self.cacheBytes()
+            stageTrace[-1]['cache_read'] = read - cacheBefore[0]
+            stageTrace[-1]['cache_written'] = written - cacheBefore[1]
+            if runLength == 1:
+                for (name, note, cost) in block.timings:
+                    stageTrace.append(self.traceEntry(name, i - 1, rows_out=None, scenario_columns=None, value_columns=None, note=note, **cost))
+            self.trace[cacheTrace:cacheTrace] = stageTrace
 
         return (block_scenario_values, block_scenario_display, block_values, block_values_display, graph_outputs)
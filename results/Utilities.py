@@ -1,4 +1,4 @@
-import math
+import math, random, time, resource
 
 def scenario_hash(scenario, exclude=None, include=None):
     """ Hashes a scenario dictionary by either including or excluding values
@@ -92,6 +92,40 @@ def length_cmp(a, b):
     else:
         return -1
 
+def scenario_sort_key(val):
+    """ Used to sort scenario values in the same way they are ordered on a
+        graph: formatted values first in the order of their format, then
+        numeric values, then everything else alphabetically.
+    """
+    from plotty.results.DataTypes import ScenarioValue
+    if isinstance(val, ScenarioValue) and val.index is not None:
+        return (0, val.index)
+    if isinstance(val, ScenarioValue):
+        val = val.value
+    try:
+        return (1, float(val))
+    except (ValueError, TypeError):
+        return (2, str(val))
+
+def measure():
+    """ Returns a snapshot of the wall time, CPU time and peak memory use of
+        this process, to be passed to measured() when a step is done. The CPU
+        time includes that of finished child processes, such as gnuplot.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+    return (time.time(), cpu, usage.ru_maxrss)
+
+def measured(start):
+    """ Returns what a step has cost since a snapshot from measure(), as a
+        dictionary of the wall time and CPU time (in seconds) and the growth
+        of the peak memory use (in kilobytes). Python can't tell us how much
+        a step allocated, so the peak resident set size is the best we have.
+    """
+    end = measure()
+    return {'time': end[0] - start[0], 'cpu': end[1] - start[1], 'memory': end[2] - start[2]}
+
 def normdev(p):
     """ Compute negative Gaussian deviates
     
@@ -228,3 +262,160 @@ def t_quantile(alpha, df):
 
     return math.sqrt(df*y)
 
+
+def select_kth(values, k):
+    """ Returns the k-th smallest (counting from zero) of a list of numbers in
+        expected linear time, using quickselect with a three-way partition so
+        that runs of equal values do not make it quadratic. The list is
+        reordered in place, leaving every element after position k no smaller
+        than the one returned.
+    """
+    lo = 0
+    hi = len(values) - 1
+    while lo < hi:
+        pivot = values[random.randint(lo, hi)]
+        lt, i, gt = lo, lo, hi
+        while i <= gt:
+            v = values[i]
+            if v < pivot:
+                values[lt], values[i] = v, values[lt]
+                lt += 1
+                i += 1
+            elif v > pivot:
+                values[gt], values[i] = v, values[gt]
+                gt -= 1
+            else:
+                i += 1
+        if k < lt:
+            hi = lt - 1
+        elif k > gt:
+            lo = gt + 1
+        else:
+            return pivot
+    return values[k]
+
+def quantile(values, q):
+    """ Returns the q-th quantile (0 <= q <= 1) of a list of numbers,
+        interpolating linearly between the closest ranks. The list is
+        reordered in place by select_kth.
+    """
+    if len(values) == 0:
+        return float('nan')
+    pos = q * (len(values) - 1)
+    k = int(math.floor(pos))
+    lower = select_kth(values, k)
+    if pos == k:
+        return lower
+    upper = min(values[k+1:])
+    return lower + (upper - lower) * (pos - k)
+
+def incomplete_beta(a, b, x):
+    """ Compute the regularised incomplete beta function I_x(a, b), using its
+    continued fraction expansion evaluated by the modified Lentz method.
+
+    Source: W. H. Press et al. 1992. Numerical Recipes in C, 2nd edition,
+    section 6.4. """
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    bt = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1.0 - x))
+    # The continued fraction converges quickly only on this side
+    if x >= (a + 1.0) / (a + b + 2.0):
+        return 1.0 - incomplete_beta(b, a, 1.0 - x)
+
+    tiny = 1e-300
+    qab = a + b
+    qap = a + 1.0
+    qam = a - 1.0
+    c = 1.0
+    d = 1.0 - qab * x / qap
+    if abs(d) < tiny:
+        d = tiny
+    d = 1.0 / d
+    h = d
+    for m in xrange(1, 201):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        if abs(d) < tiny:
+            d = tiny
+        c = 1.0 + aa / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        if abs(d) < tiny:
+            d = tiny
+        c = 1.0 + aa / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 3e-14:
+            break
+    return bt * h / a
+
+def t_pvalue(t, df):
+    """ Compute the two-tailed p-value of the statistic t under a t
+    distribution with df degrees of freedom (which need not be whole). """
+    if df <= 0 or math.isnan(t):
+        return float('nan')
+    return incomplete_beta(df / 2.0, 0.5, float(df) / (df + t * t))
+
+def welch_t_test(a, b):
+    """ Welch's unequal variances t-test of the difference between the means
+    of two samples. Returns (t, df, p), where p is two-tailed, or NaNs if
+    either sample has fewer than two values or neither has any spread. """
+    na = len(a)
+    nb = len(b)
+    if na < 2 or nb < 2:
+        return float('nan'), float('nan'), float('nan')
+    ma = math.fsum(a) / na
+    mb = math.fsum(b) / nb
+    va = math.fsum([(x - ma) ** 2 for x in a]) / (na - 1) / na
+    vb = math.fsum([(x - mb) ** 2 for x in b]) / (nb - 1) / nb
+    if va + vb == 0:
+        return float('nan'), float('nan'), float('nan')
+    t = (mb - ma) / math.sqrt(va + vb)
+    df = (va + vb) ** 2 / (va ** 2 / (na - 1) + vb ** 2 / (nb - 1))
+    return t, df, t_pvalue(t, df)
+
+def mann_whitney_u(a, b):
+    """ Mann-Whitney U test of whether values in sample b tend to be larger or
+    smaller than those in sample a. Returns (U, p), where U counts the pairs
+    in which the value from b is larger (ties count half) and p is two-tailed,
+    using the normal approximation with tie and continuity corrections. """
+    na = len(a)
+    nb = len(b)
+    if na == 0 or nb == 0:
+        return float('nan'), float('nan')
+    pooled = sorted([(x, 0) for x in a] + [(x, 1) for x in b])
+    n = na + nb
+    rank_sum_b = 0.0
+    tie_term = 0.0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and pooled[j + 1][0] == pooled[i][0]:
+            j += 1
+        # Tied values share the average of their ranks
+        rank = (i + j) / 2.0 + 1
+        ties = j - i + 1
+        tie_term += ties ** 3 - ties
+        for k in xrange(i, j + 1):
+            if pooled[k][1] == 1:
+                rank_sum_b += rank
+        i = j + 1
+    u = rank_sum_b - nb * (nb + 1) / 2.0
+    mean = na * nb / 2.0
+    var = na * nb / 12.0 * ((n + 1) - tie_term / (n * (n - 1))) if n > 1 else 0.0
+    if var <= 0:
+        return u, float('nan')
+    z = (abs(u - mean) - 0.5) / math.sqrt(var)
+    if z < 0:
+        z = 0.0
+    return u, math.erfc(z / math.sqrt(2))
@@ -174,6 +174,25 @@ var Utilities = {
         });
     },
 
+    /**
+     * Create the html for a table of what each step of the pipeline cost
+     */
+    makeTimingTable: function(timings) {
+        var cell = function(value) {
+            return '<td>' + (value === null || typeof value === 'undefined' ? '' : value) + '</td>';
+        };
+        var html = '<table class="timings"><thead><tr><th>Step</th><th>Block</th><th>Rows in</th><th>Rows out</th><th>Groups</th>'
+                 + '<th>Wall (ms)</th><th>CPU (ms)</th><th>Peak memory (KB)</th><th>Cache read (bytes)</th><th>Cache written (bytes)</th><th>Note</th></tr></thead><tbody>';
+        jQuery.each(timings, function(i, t) {
+            var note = t.cached ? 'cached' : t.note;
+            html += '<tr>' + cell(t.block) + cell(typeof t.index === 'number' ? t.index + 1 : '')
+                  + cell(t.rows_in) + cell(t.rows_out) + cell(t.groups)
+                  + cell((t.time * 1000).toFixed(1)) + cell((t.cpu * 1000).toFixed(1)) + cell(t.memory)
+                  + cell(t.cache_read) + cell(t.cache_written) + cell(note) + '</tr>';
+        });
+        return html + '</tbody></table>';
+    },
+
     /**
      * Return the set of keys from a map.
      */
@@ -393,8 +412,8 @@ var Block = Base.extend({
 var Blocks = {
     /**
      * The filter block allows certain filters to be specified that will
-     * remove rows from the data.
-     * TODO more complex filtering - AND/OR combinations
+     * remove rows from the data. Filters are ANDed together, unless the
+     * MATCH_ANY flag is set, in which case they are ORed together.
      */
     FilterBlock: Block.extend({
         /**
@@ -417,7 +436,16 @@ var Blocks = {
          */
         TYPE: {
             IS: 1,
-            IS_NOT: 2
+            IS_NOT: 2,
+            IN: 3,
+            NOT_IN: 4
+        },
+
+        /**
+         * The available flags for this block
+         */
+        FLAGS: {
+            MATCH_ANY: 1 << 0
         },
         
         /**
@@ -425,7 +453,8 @@ var Blocks = {
          **/
 
         /**
-         * The currently valid filters
+         * The currently valid filters. For IN and NOT_IN filters, the value
+         * is a list of values joined by Pipeline.encoder.TUPLE_SEPARATOR.
          */
         filters: null,
         
@@ -466,6 +495,17 @@ var Blocks = {
                 thisBlock.loadState();
                 if (thisBlock.complete()) Pipeline.refresh();
             });
+            $('input.filter-match-any', this.element).change(function() {
+                thisBlock.readState();
+                if (thisBlock.complete()) Pipeline.refresh();
+            });
+        },
+
+        /**
+         * Whether a filter type matches against a list of values
+         */
+        isMultiple: function(type) {
+            return type == this.TYPE.IN || type == this.TYPE.NOT_IN;
         },
         
         /**
@@ -521,12 +561,21 @@ var Blocks = {
                 var isSelect = $('.select-filter-is', this);
                 var valueSelect = $('.select-filter-value', this);
 
+                var value = valueSelect.val();
+                if ( jQuery.isArray(value) ) {
+                    value = value.length > 0 ? value.join(Pipeline.encoder.TUPLE_SEPARATOR) : -1;
+                }
+                else if ( value === null ) {
+                    value = -1;
+                }
+
                 thisBlock.filters.push({
                     scenario: scenarioSelect.val(),
                     is: isSelect.val(),
-                    value: valueSelect.val()
+                    value: value
                 });
             });
+            this.setFlag(this.FLAGS.MATCH_ANY, $('input.filter-match-any', this.element).is(':checked'));
         },
 
         /**
@@ -556,14 +605,34 @@ var Blocks = {
                 // logs.
                 scenarioSelect.val(filter.scenario);
                 isSelect.val(filter.is);
+                var multiple = thisBlock.isMultiple(filter.is);
+                if ( multiple ) {
+                    valueSelect.attr('multiple', 'multiple');
+                }
+                else {
+                    valueSelect.removeAttr('multiple');
+                }
                 if ( filter.scenario != -1 ) {
                     Utilities.updateSelect(valueSelect, thisBlock.scenarioDisplayCache[filter.scenario], thisBlock.scenarioValuesCache[filter.scenario]);
                 }
                 else {
                     Utilities.updateSelect(valueSelect, [], []);
                 }
-                valueSelect.val(filter.value);
+                if ( multiple ) {
+                    // No placeholder option in a multiple select
+                    $('option[value=-1]', valueSelect).remove();
+                    valueSelect.val(filter.value == -1 ? [] : String(filter.value).split(Pipeline.encoder.TUPLE_SEPARATOR));
+                }
+                else {
+                    valueSelect.val(filter.value);
+                }
             });
+
+            if ( this.getFlag(this.FLAGS.MATCH_ANY) ) {
+                $('input.filter-match-any', this.element).attr('checked', 'checked');
+            } else {
+                $('input.filter-match-any', this.element).removeAttr('checked');
+            }
         },
        
         refreshColumns: function() {
@@ -575,6 +644,18 @@ var Blocks = {
                     changed = true;
                     return;
                 } 
+                if ( filter.value != -1 && thisBlock.isMultiple(filter.is) ) {
+                    // Drop any of the values that have disappeared
+                    var values = String(filter.value).split(Pipeline.encoder.TUPLE_SEPARATOR);
+                    var kept = jQuery.grep(values, function(v) {
+                        return jQuery.inArray(v, thisBlock.scenarioValuesCache[filter.scenario]) > -1;
+                    });
+                    if ( kept.length != values.length ) {
+                        thisBlock.filters[i].value = kept.length > 0 ? kept.join(Pipeline.encoder.TUPLE_SEPARATOR) : -1;
+                        changed = true;
+                    }
+                    return;
+                }
                 if ( filter.value != -1 && jQuery.inArray(filter.value, thisBlock.scenarioValuesCache[filter.scenario]) == -1 ) {
                     thisBlock.filters[i].value = -1;
                     changed = true;
@@ -631,6 +712,9 @@ var Blocks = {
             var scenario = $('.select-filter-column', row).val();
             var is       = $('.select-filter-is', row).val();
             var value    = $('.select-filter-value', row).val();
+            if ( jQuery.isArray(value) ) {
+                value = value.join(Pipeline.encoder.TUPLE_SEPARATOR);
+            }
             
             return {scenario: scenario, is: is, value: value};
         }
@@ -663,14 +747,18 @@ var Blocks = {
          */
         TYPE: {
             MEAN: 1,
-            GEOMEAN: 2
+            GEOMEAN: 2,
+            MEDIAN: 3,
+            P90: 4,
+            P99: 5
         },
 
         /**
          * The available flags for this block
          */
         FLAGS: {
-            ADD_SEPARATE_COLUMN: 1 << 0
+            ADD_SEPARATE_COLUMN: 1 << 0,
+            BOOTSTRAP_CI: 1 << 1
         },
         
         /**
@@ -681,6 +769,11 @@ var Blocks = {
          * The scenario column to aggregate over
          */
         column: -1,
+
+        /**
+         * The number of resamples for bootstrap confidence intervals
+         */
+        resamples: 1000,
         
         /**
          * The type of aggregate to use. This should be a value from
@@ -722,19 +815,26 @@ var Blocks = {
             this.flags = parseInt(parts[0]);
 
             var settings = parts[1].split(Pipeline.encoder.PARAM_SEPARATOR);
-            if ( settings.length != 2 ) {
+            if ( settings.length != 2 && settings.length != 3 ) {
                 console.debug("Aggregate block invalid: incorrect number of settings");
                 return;
             }
             this.type = settings[0];
             this.column = settings[1];
+            if ( settings.length == 3 ) {
+                this.resamples = parseInt(settings[2]);
+            }
         },
         
         /**
          * Encode this block into a parameter string based on its configuration.
          */
         encode: function() {
-            return this.flags + Pipeline.encoder.GROUP_SEPARATOR + this.type + Pipeline.encoder.PARAM_SEPARATOR + this.column;
+            var str = this.flags + Pipeline.encoder.GROUP_SEPARATOR + this.type + Pipeline.encoder.PARAM_SEPARATOR + this.column;
+            if ( this.getFlag(this.FLAGS.BOOTSTRAP_CI) ) {
+                str += Pipeline.encoder.PARAM_SEPARATOR + this.resamples;
+            }
+            return str;
         },
 
         /**
@@ -745,10 +845,16 @@ var Blocks = {
             var typeSelect = $('.select-aggregate-type', this.element);
             var scenarioSelect = $('.select-aggregate-column', this.element);
             var sepColCheck = $('input.aggregate-add-column', this.element);
+            var bootstrapCheck = $('input.aggregate-bootstrap', this.element);
+            var resamples = parseInt($('.text-aggregate-resamples', this.element).val());
 
             this.type = typeSelect.val();
             this.column = scenarioSelect.val();
             this.setFlag(this.FLAGS.ADD_SEPARATE_COLUMN, sepColCheck.is(':checked'));
+            this.setFlag(this.FLAGS.BOOTSTRAP_CI, bootstrapCheck.is(':checked'));
+            if ( !isNaN(resamples) && resamples > 0 ) {
+                this.resamples = resamples;
+            }
         },
         
         /**
@@ -769,6 +875,15 @@ var Blocks = {
             } else {
                 $('input.aggregate-add-column', this.element).removeAttr('checked');
             }
+
+            $('.text-aggregate-resamples', this.element).val(this.resamples);
+            if ( this.getFlag(this.FLAGS.BOOTSTRAP_CI) ) {
+                $('input.aggregate-bootstrap', this.element).attr('checked', 'checked');
+                $('.text-aggregate-resamples', this.element).show();
+            } else {
+                $('input.aggregate-bootstrap', this.element).removeAttr('checked');
+                $('.text-aggregate-resamples', this.element).hide();
+            }
         },
        
         refreshColumns: function() {
@@ -1560,66 +1675,928 @@ var Blocks = {
             }
         },
 
-        popupDelete: function() {
-            var popup = this.myPopup;
+        popupDelete: function() {
+            var popup = this.myPopup;
+            var thisBlock = this;
+            var key = $('.text-format-key', popup).val();
+            if ( key != '' ) {
+                Pipeline.ajax.deleteGraphFormat(key, function(data) {
+                    if ( data.error == false ) {
+                        thisBlock.myPopup = thisBlock.myPopup.appendTo(thisBlock.element).hide();
+                        thisBlock.myPopupFilter = thisBlock.myPopupFilter.appendTo(thisBlock.element).hide();
+                        thisBlock.format = -1;
+                        thisBlock.loadState();
+                        Pipeline.refresh();
+                    }
+                });
+            }
+        }
+    }),
+
+    /**
+     * The value filter block allows certain filters to be specified that will
+     * remove rows from the data.
+     */
+    ValueFilterBlock: Block.extend({
+        /**
+         ** Static fields
+         **/
+
+        /**
+         * The ID of the template for this filter
+         */
+        TEMPLATE_ID: "#pipeline-valuefilter-template",
+
+        /**
+         * The ID of this block for encoding (the inverse of the mapping in
+         * Pipeline.encoder.MAPPINGS)
+         */
+        ID: 5,
+
+        /**
+         * The type of filter
+         */
+        TYPE: {
+            IS: 1,
+            IS_NOT: 2
+        },
+        
+        /**
+         ** Object fields
+         **/
+
+        /**
+         * The currently valid filters
+         */
+        filters: null,
+        
+        /**
+         * The options table for selecting filters
+         */
+        optionsTable: null,
+        
+        /**
+         ** Object methods
+         **/
+
+        /**
+         * Creates a new block. See Block.constructor for parameters.
+         */
+        constructor: function(insertIndex) {
+            this.base(insertIndex);
+            this.filters = [{column: -1, is: 1, lowerbound: '-inf', upperbound: '+inf'}];
+            
+            // Create a closure to use as the callback for removing objects.
+            // This way, the scope of this block is maintained.
+            var thisBlock = this;
+            var removeClosure = function(row) {
+                thisBlock.removeFilter.call(thisBlock, row); 
+            };
+            var addClosure = function(row, i) {
+                thisBlock.filters.splice(i, 0, {column: -1, is: 1, lowerbound: '-inf', upperbound: '+inf'});
+                thisBlock.loadState();
+            };
+            
+            // Create the option table
+            this.optionsTable = new OptionsTable($('.pipeline-valuefilter-table', this.element), removeClosure, Pipeline.refresh, addClosure);
+            
+            // Hook the dropdowns and text inputs
+            $(this.element).delegate('select, input', 'change', function() {
+                thisBlock.readState();
+                Pipeline.refresh();
+            });
+        },
+        
+        /**
+        * Decode a parameter string and set this block's configuration according
+        * to those parameters.
+         */
+        decode: function(params) {
+            this.filters = [];
+            var parts = params.split(Pipeline.encoder.GROUP_SEPARATOR);
+            // There must be at least two - a flagword and one filter
+            if ( parts.length < 2 ) {
+                console.debug("ValueFilter block invalid: not enough parts");
+                return;
+            }
+
+            this.flags = parseInt(parts[0]);
+
+            var filts = parts.slice(1);
+            var thisBlock = this;
+            jQuery.each(filts, function(i ,filter) {
+                var settings = filter.split(Pipeline.encoder.PARAM_SEPARATOR);
+                // Exactly four parts - column, is, lowerbound, upperbound
+                if ( settings.length != 4 ) {
+                    console.debug("ValueFilter invalid: not enough parts in ", filter);
+                }
+                thisBlock.filters.push({column: settings[0], is: settings[1], lowerbound: settings[2], upperbound: settings[3]});
+            });
+        },
+        
+        /**
+         * Encode this block into a parameter string based on its configuration.
+         */
+        encode: function() {
+            var strs = [this.flags];
+            jQuery.each(this.filters, function(i, filter) {
+                if ( filter.scenario != -1 ) {
+                    strs.push(filter.column + Pipeline.encoder.PARAM_SEPARATOR
+                              + filter.is + Pipeline.encoder.PARAM_SEPARATOR
+                              + filter.lowerbound + Pipeline.encoder.PARAM_SEPARATOR
+                              + filter.upperbound);
+                }
+            });
+            return strs.join(Pipeline.encoder.GROUP_SEPARATOR);
+        },
+
+        /**
+         * Take this block's HTML values and load them into local
+         * configuration.
+         */
+        readState: function() {
+            this.filters = [];
+            var thisBlock = this;
+            $('tr', this.element).each(function() {
+                var columnSelect = $('.select-valuefilter-column', this);
+                var isSelect = $('.select-valuefilter-is', this);
+                var lowerboundText = $('.text-valuefilter-lowerbound', this);
+                var upperboundText = $('.text-valuefilter-upperbound', this);
+
+                thisBlock.filters.push({
+                    column: columnSelect.val(),
+                    is: isSelect.val(),
+                    lowerbound: lowerboundText.val(),
+                    upperbound: upperboundText.val()
+                });
+            });
+        },
+
+        /**
+         * Take this block's local configuration and load it into the
+         * HTML.
+         */
+        loadState: function() {
+            var thisBlock = this;
+
+            // Get rid of all but the first row
+            this.optionsTable.reset();
+            
+            // Update the value columns
+            $('.select-valuefilter-column', this.element).each(function() {
+                Utilities.updateSelect(this, thisBlock.valueDisplayCache, thisBlock.valueColumnsCache, true);
+            });
+
+            // Create new rows for each filter
+            var thisBlock = this;
+            jQuery.each(this.filters, function(i, filter) {
+                var row = thisBlock.optionsTable.addRow();
+                var columnSelect = $('.select-valuefilter-column', row);
+                var isSelect = $('.select-valuefilter-is', row);
+                var lowerboundText = $('.text-valuefilter-lowerbound', row);
+                var upperboundText = $('.text-valuefilter-upperbound', row);
+                
+                // Note here we assume the scenario dropdown has already been
+                // updated, and the value cache is also up to date with new
+                // logs.
+                columnSelect.val(filter.column);
+                isSelect.val(filter.is);
+                lowerboundText.val(filter.lowerbound);
+                upperboundText.val(filter.upperbound);
+            });
+        },
+        
+        refreshColumns: function() {
+            var thisBlock = this;
+            var changed = false;
+            
+            jQuery.each(this.filters, function(i, filter) {
+                // If the selected scenario isn't in the new available ones,
+                // reset this row
+                if ( filter.column != -1 && jQuery.inArray(filter.column, thisBlock.valueColumnsCache) == -1 ) {
+                    filter.column = -1;
+                    changed = true;
+                    return;
+                }
+            });
+            
+            return changed;
+        },
+
+        complete: function() {
+            var valid = true;
+            jQuery.each(this.filters, function(i, filter) {
+                if ( filter.column == -1 ) {
+                    valid = false;
+                }
+            });
+
+            return valid;
+        },
+        
+        /**
+         * A row is about to be removed from the OptionsTable. We need to
+         * clean it up here.
+         *
+         * @param row Element The table row to be removed
+         */
+        removeFilter: function(row) {
+            var value = this.filterValue(row);
+            
+            for ( var i = 0; i < this.filters.length; i++ ) {
+                if ( this.filters[i].scenario == value.scenario
+                     && this.filters[i].is == value.is
+                     && this.filters[i].value == value.value ) {
+                    this.filters.splice(i, 1);
+                    break;
+                }
+            }
+        },
+        
+        /**
+         * Turns a <tr> in the OptionsTable into a dictionary
+         *
+         * @param row Element The table row to gather values from
+         * @return dict|boolean The values in the given row, or false if
+         *   the selection is incomplete
+         */
+        filterValue: function(row) {
+            var column     = $('.select-valuefilter-column', row).val();
+            var is         = $('.select-valuefilter-is', row).val();
+            var lowerbound = $('.text-valuefilter-lowerbound', row).val();
+            var upperbound = $('.text-valuefilter-upperbound', row).val();
+            
+            return {column: column, is: is, lowerbound: lowerbound, upperbound: upperbound};
+        }
+    }),
+
+    /**
+     * The sort block orders the rows by one or more scenario or value columns,
+     * optionally keeping only the first few rows of each group.
+     */
+    SortBlock: Block.extend({
+        /**
+         ** Static fields
+         **/
+
+        /**
+         * The ID of the template for this block
+         */
+        TEMPLATE_ID: "#pipeline-sort-template",
+
+        /**
+         * The ID of this block for encoding (the inverse of the mapping in
+         * Pipeline.encoder.MAPPINGS)
+         */
+        ID: 8,
+
+        /**
+         * The direction of a sort key
+         */
+        TYPE: {
+            ASCENDING: 1,
+            DESCENDING: 2
+        },
+
+        /**
+         ** Object fields
+         **/
+
+        /**
+         * The columns to sort by, in order of precedence
+         */
+        keys: null,
+
+        /**
+         * The number of rows to keep from each group, or 0 for all of them
+         */
+        limit: 0,
+
+        /**
+         * The scenario columns used to group the rows before the limit is
+         * applied.
+         */
+        group: null,
+
+        /**
+         * The options table for selecting sort keys
+         */
+        optionsTable: null,
+
+        /**
+         ** Object methods
+         **/
+
+        /**
+         * Creates a new block. See Block.constructor for parameters.
+         */
+        constructor: function(insertIndex) {
+            this.base(insertIndex);
+            this.keys = [{column: -1, type: 1}];
+            this.limit = 0;
+            this.group = [];
+
+            // Create a closure to use as the callback for removing objects.
+            // This way, the scope of this block is maintained.
+            var thisBlock = this;
+            var removeClosure = function(row) {
+                thisBlock.removeKey.call(thisBlock, row);
+            };
+            var addClosure = function(row, i) {
+                thisBlock.keys.splice(i, 0, {column: -1, type: 1});
+                thisBlock.loadState();
+            };
+
+            // Create the option table
+            this.optionsTable = new OptionsTable($('.pipeline-sort-table', this.element), removeClosure, Pipeline.refresh, addClosure);
+
+            // Hook the dropdowns and text inputs
+            $(this.element).delegate('select, input', 'change', function() {
+                thisBlock.readState();
+                Pipeline.refresh();
+            });
+        },
+
+        /**
+         * Decode a parameter string and set this block's configuration according
+         * to those parameters.
+         */
+        decode: function(params) {
+            this.keys = [];
+            this.group = [];
+            var parts = params.split(Pipeline.encoder.GROUP_SEPARATOR);
+            // There must be at least three - a flagword, settings and one key
+            if ( parts.length < 3 ) {
+                console.debug("Sort block invalid: not enough parts");
+                return;
+            }
+
+            this.flags = parseInt(parts[0]);
+
+            var settings = parts[1].split(Pipeline.encoder.PARAM_SEPARATOR);
+            if ( settings.length != 2 ) {
+                console.debug("Sort block invalid: incorrect number of settings");
+                return;
+            }
+            this.limit = parseInt(settings[0]) || 0;
+            var groupings = settings[1].split(Pipeline.encoder.TUPLE_SEPARATOR);
+            for ( var i = 0; i < groupings.length; i++ ) {
+                if ( $.trim(groupings[i]).length > 0 ) { // Make sure it's not empty
+                    this.group.push($.trim(groupings[i]));
+                }
+            }
+
+            var thisBlock = this;
+            jQuery.each(parts.slice(2), function(i, key) {
+                var settings = key.split(Pipeline.encoder.PARAM_SEPARATOR);
+                // Exactly two parts - column, type
+                if ( settings.length != 2 ) {
+                    console.debug("Sort invalid: not enough parts in ", key);
+                    return;
+                }
+                thisBlock.keys.push({column: settings[0], type: settings[1]});
+            });
+        },
+
+        /**
+         * Encode this block into a parameter string based on its configuration.
+         */
+        encode: function() {
+            var strs = [this.flags];
+            strs.push(this.limit + Pipeline.encoder.PARAM_SEPARATOR + this.group.join(Pipeline.encoder.TUPLE_SEPARATOR));
+            jQuery.each(this.keys, function(i, key) {
+                if ( key.column != -1 ) {
+                    strs.push(key.column + Pipeline.encoder.PARAM_SEPARATOR + key.type);
+                }
+            });
+            return strs.join(Pipeline.encoder.GROUP_SEPARATOR);
+        },
+
+        /**
+         * Take this block's HTML values and load them into local
+         * configuration.
+         */
+        readState: function() {
+            this.keys = [];
+            var thisBlock = this;
+            $('tr', this.optionsTable.element).each(function() {
+                var columnSelect = $('.select-sort-column', this);
+                var typeSelect = $('.select-sort-type', this);
+
+                thisBlock.keys.push({
+                    column: columnSelect.val(),
+                    type: typeSelect.val()
+                });
+            });
+
+            var limit = parseInt($('.text-sort-limit', this.element).val());
+            this.limit = (isNaN(limit) || limit < 0) ? 0 : limit;
+            this.group = Utilities.multiSelectValue($('.select-sort-group', this.element));
+        },
+
+        /**
+         * Take this block's local configuration and load it into the
+         * HTML.
+         */
+        loadState: function() {
+            var thisBlock = this;
+
+            // Get rid of all but the first row
+            this.optionsTable.reset();
+
+            // Both scenario and value columns can be sorted on
+            var columns = this.scenarioColumnsCache.concat(this.valueColumnsCache);
+            var display = this.scenarioColumnsCache.concat(this.valueDisplayCache);
+            $('.select-sort-column', this.element).each(function() {
+                Utilities.updateSelect(this, display, columns, true);
+            });
+
+            // Create new rows for each key
+            jQuery.each(this.keys, function(i, key) {
+                var row = thisBlock.optionsTable.addRow();
+                $('.select-sort-column', row).val(key.column);
+                $('.select-sort-type', row).val(key.type);
+            });
+
+            $('.text-sort-limit', this.element).val(this.limit > 0 ? this.limit : '');
+
+            // Update the grouping
+            Utilities.updateMultiSelect($('.select-sort-group', this.element), this.scenarioColumnsCache, this.scenarioColumnsCache, true);
+            $('.select-sort-group input:checkbox', this.element).each(function() {
+                if ( jQuery.inArray($(this).val(), thisBlock.group) > -1 ) {
+                    $(this).attr('checked', true);
+                }
+                else {
+                    $(this).removeAttr('checked');
+                }
+            });
+        },
+
+        refreshColumns: function() {
+            var thisBlock = this;
+            var changed = false;
+
+            jQuery.each(this.keys, function(i, key) {
+                // If the selected column isn't in the new available ones,
+                // reset this row
+                if ( key.column != -1
+                     && jQuery.inArray(key.column, thisBlock.scenarioColumnsCache) == -1
+                     && jQuery.inArray(key.column, thisBlock.valueColumnsCache) == -1 ) {
+                    key.column = -1;
+                    changed = true;
+                }
+            });
+
+            var group = jQuery.grep(this.group, function(grp) {
+                return jQuery.inArray(grp, thisBlock.scenarioColumnsCache) > -1;
+            });
+            if ( group.length != this.group.length ) {
+                this.group = group;
+                changed = true;
+            }
+
+            return changed;
+        },
+
+        complete: function() {
+            var valid = true;
+            jQuery.each(this.keys, function(i, key) {
+                if ( key.column == -1 ) {
+                    valid = false;
+                }
+            });
+
+            return valid;
+        },
+
+        /**
+         * A row is about to be removed from the OptionsTable. We need to
+         * clean it up here.
+         *
+         * @param row Element The table row to be removed
+         */
+        removeKey: function(row) {
+            var column = $('.select-sort-column', row).val();
+            var type = $('.select-sort-type', row).val();
+
+            for ( var i = 0; i < this.keys.length; i++ ) {
+                if ( this.keys[i].column == column && this.keys[i].type == type ) {
+                    this.keys.splice(i, 1);
+                    break;
+                }
+            }
+        }
+    }),
+
+    /**
+     * The sample block keeps a random sample of the rows, either of the whole
+     * table or of each group of rows.
+     */
+    SampleBlock: Block.extend({
+        /**
+         ** Static fields
+         **/
+
+        /**
+         * The ID of the template for this block
+         */
+        TEMPLATE_ID: "#pipeline-sample-template",
+
+        /**
+         * The ID of this block for encoding (the inverse of the mapping in
+         * Pipeline.encoder.MAPPINGS)
+         */
+        ID: 9,
+
+        /**
+         ** Object fields
+         **/
+
+        /**
+         * The number of rows to keep from each group
+         */
+        size: 100,
+
+        /**
+         * The seed used to pick the sample
+         */
+        seed: 0,
+
+        /**
+         * The scenario columns used to group the rows before sampling
+         */
+        group: null,
+
+        /**
+         ** Object methods
+         **/
+
+        /**
+         * Creates a new block. See Block.constructor for parameters.
+         */
+        constructor: function(insertIndex) {
+            this.base(insertIndex);
+            this.size = 100;
+            this.seed = 0;
+            this.group = [];
+
+            // Hook the dropdowns and text inputs
+            var thisBlock = this;
+            $(this.element).delegate('select, input', 'change', function() {
+                thisBlock.readState();
+                Pipeline.refresh();
+            });
+        },
+
+        /**
+         * Decode a parameter string and set this block's configuration according
+         * to those parameters.
+         */
+        decode: function(params) {
+            this.group = [];
+            var parts = params.split(Pipeline.encoder.GROUP_SEPARATOR);
+            // Exactly 2 parts - flagword and settings
+            if ( parts.length != 2 ) {
+                console.debug("Sample block invalid: incorrect number of parts");
+                return;
+            }
+
+            this.flags = parseInt(parts[0]);
+
+            var settings = parts[1].split(Pipeline.encoder.PARAM_SEPARATOR);
+            if ( settings.length != 3 ) {
+                console.debug("Sample block invalid: incorrect number of settings");
+                return;
+            }
+            this.size = parseInt(settings[0]);
+            this.seed = parseInt(settings[1]);
+            var groupings = settings[2].split(Pipeline.encoder.TUPLE_SEPARATOR);
+            for ( var i = 0; i < groupings.length; i++ ) {
+                if ( $.trim(groupings[i]).length > 0 ) { // Make sure it's not empty
+                    this.group.push($.trim(groupings[i]));
+                }
+            }
+        },
+
+        /**
+         * Encode this block into a parameter string based on its configuration.
+         */
+        encode: function() {
+            return this.flags + Pipeline.encoder.GROUP_SEPARATOR
+                   + this.size + Pipeline.encoder.PARAM_SEPARATOR
+                   + this.seed + Pipeline.encoder.PARAM_SEPARATOR
+                   + this.group.join(Pipeline.encoder.TUPLE_SEPARATOR);
+        },
+
+        /**
+         * Take this block's HTML values and load them into local
+         * configuration.
+         */
+        readState: function() {
+            this.size = parseInt($('.text-sample-size', this.element).val());
+            this.seed = parseInt($('.text-sample-seed', this.element).val()) || 0;
+            this.group = Utilities.multiSelectValue($('.select-sample-group', this.element));
+        },
+
+        /**
+         * Take this block's local configuration and load it into the
+         * HTML.
+         */
+        loadState: function() {
+            var thisBlock = this;
+
+            $('.text-sample-size', this.element).val(isNaN(this.size) ? '' : this.size);
+            $('.text-sample-seed', this.element).val(this.seed);
+
+            // Update the grouping
+            Utilities.updateMultiSelect($('.select-sample-group', this.element), this.scenarioColumnsCache, this.scenarioColumnsCache, true);
+            $('.select-sample-group input:checkbox', this.element).each(function() {
+                if ( jQuery.inArray($(this).val(), thisBlock.group) > -1 ) {
+                    $(this).attr('checked', true);
+                }
+                else {
+                    $(this).removeAttr('checked');
+                }
+            });
+        },
+
+        refreshColumns: function() {
+            var thisBlock = this;
+            var group = jQuery.grep(this.group, function(grp) {
+                return jQuery.inArray(grp, thisBlock.scenarioColumnsCache) > -1;
+            });
+            if ( group.length != this.group.length ) {
+                this.group = group;
+                return true;
+            }
+            return false;
+        },
+
+        complete: function() {
+            return !isNaN(this.size) && this.size > 0;
+        }
+    }),
+
+    /**
+     * The outlier block removes (or flags) rows whose values are outliers
+     * among the rows that would be aggregated with them.
+     */
+    OutlierBlock: Block.extend({
+        /**
+         ** Static fields
+         **/
+
+        /**
+         * The ID of the template for this block
+         */
+        TEMPLATE_ID: "#pipeline-outlier-template",
+
+        /**
+         * The ID of this block for encoding (the inverse of the mapping in
+         * Pipeline.encoder.MAPPINGS)
+         */
+        ID: 'a',
+
+        /**
+         * The test used to find outliers
+         */
+        TYPE: {
+            IQR: 1,
+            MAD: 2,
+            SIGMA: 3
+        },
+
+        /**
+         * The default threshold for each type of test
+         */
+        DEFAULT_THRESHOLD: {
+            1: 1.5,
+            2: 3,
+            3: 3
+        },
+
+        /**
+         * The available flags for this block
+         */
+        FLAGS: {
+            FLAG_ONLY: 1 << 0
+        },
+
+        /**
+         ** Object fields
+         **/
+
+        /**
+         * The scenario column the rows would be aggregated over
+         */
+        column: -1,
+
+        /**
+         * The type of test to use
+         */
+        type: null,
+
+        /**
+         * How far outside the bounds a value must be to be an outlier
+         */
+        threshold: null,
+
+        /**
+         * The value columns to test (all of them if empty)
+         */
+        values: null,
+
+        /**
+         ** Object methods
+         **/
+
+        /**
+         * Creates a new block. See Block.constructor for parameters.
+         */
+        constructor: function(insertIndex) {
+            this.base(insertIndex);
+            this.type = this.TYPE.IQR;
+            this.threshold = this.DEFAULT_THRESHOLD[this.type];
+            this.values = [];
+
+            // Hook the dropdowns and text inputs
+            var thisBlock = this;
+            $(this.element).delegate('select, input', 'change', function() {
+                var type = thisBlock.type;
+                thisBlock.readState();
+                // Changing the test resets the threshold to its default
+                if ( type != thisBlock.type ) {
+                    thisBlock.threshold = thisBlock.DEFAULT_THRESHOLD[thisBlock.type];
+                    $('.text-outlier-threshold', thisBlock.element).val(thisBlock.threshold);
+                }
+                Pipeline.refresh();
+            });
+        },
+
+        /**
+         * Decode a parameter string and set this block's configuration according
+         * to those parameters.
+         */
+        decode: function(params) {
+            this.values = [];
+            var parts = params.split(Pipeline.encoder.GROUP_SEPARATOR);
+            // Exactly 3 parts - flagword, settings and value columns
+            if ( parts.length != 3 ) {
+                console.debug("Outlier block invalid: incorrect number of parts");
+                return;
+            }
+
+            this.flags = parseInt(parts[0]);
+
+            var settings = parts[1].split(Pipeline.encoder.PARAM_SEPARATOR);
+            if ( settings.length != 3 ) {
+                console.debug("Outlier block invalid: incorrect number of settings");
+                return;
+            }
+            this.type = settings[0];
+            this.column = settings[1];
+            this.threshold = settings[2];
+
+            var values = parts[2].split(Pipeline.encoder.PARAM_SEPARATOR);
+            for ( var i = 0; i < values.length; i++ ) {
+                if ( $.trim(values[i]).length > 0 ) { // Make sure it's not empty
+                    this.values.push($.trim(values[i]));
+                }
+            }
+        },
+
+        /**
+         * Encode this block into a parameter string based on its configuration.
+         */
+        encode: function() {
+            return this.flags + Pipeline.encoder.GROUP_SEPARATOR
+                   + this.type + Pipeline.encoder.PARAM_SEPARATOR
+                   + this.column + Pipeline.encoder.PARAM_SEPARATOR
+                   + this.threshold + Pipeline.encoder.GROUP_SEPARATOR
+                   + this.values.join(Pipeline.encoder.PARAM_SEPARATOR);
+        },
+
+        /**
+         * Take this block's HTML values and load them into local
+         * configuration.
+         */
+        readState: function() {
+            this.type = $('.select-outlier-type', this.element).val();
+            this.column = $('.select-outlier-column', this.element).val();
+            this.threshold = $('.text-outlier-threshold', this.element).val();
+            this.values = Utilities.multiSelectValue($('.select-outlier-values', this.element));
+            this.setFlag(this.FLAGS.FLAG_ONLY, $('input.outlier-flag-only', this.element).is(':checked'));
+        },
+
+        /**
+         * Take this block's local configuration and load it into the
+         * HTML.
+         */
+        loadState: function() {
+            var thisBlock = this;
+            var scenarioSelect = $('.select-outlier-column', this.element);
+
+            Utilities.updateSelect(scenarioSelect, this.scenarioColumnsCache, this.scenarioColumnsCache);
+
+            $('.select-outlier-type', this.element).val(this.type);
+            scenarioSelect.val(this.column);
+            $('.text-outlier-threshold', this.element).val(this.threshold);
+
+            // Update the value columns
+            Utilities.updateMultiSelect($('.select-outlier-values', this.element), this.valueDisplayCache, this.valueColumnsCache, true);
+            $('.select-outlier-values input:checkbox', this.element).each(function() {
+                if ( jQuery.inArray($(this).val(), thisBlock.values) > -1 ) {
+                    $(this).attr('checked', true);
+                }
+                else {
+                    $(this).removeAttr('checked');
+                }
+            });
+
+            if ( this.getFlag(this.FLAGS.FLAG_ONLY) ) {
+                $('input.outlier-flag-only', this.element).attr('checked', 'checked');
+            } else {
+                $('input.outlier-flag-only', this.element).removeAttr('checked');
+            }
+        },
+
+        refreshColumns: function() {
             var thisBlock = this;
-            var key = $('.text-format-key', popup).val();
-            if ( key != '' ) {
-                Pipeline.ajax.deleteGraphFormat(key, function(data) {
-                    if ( data.error == false ) {
-                        thisBlock.myPopup = thisBlock.myPopup.appendTo(thisBlock.element).hide();
-                        thisBlock.myPopupFilter = thisBlock.myPopupFilter.appendTo(thisBlock.element).hide();
-                        thisBlock.format = -1;
-                        thisBlock.loadState();
-                        Pipeline.refresh();
-                    }
-                });
+            var changed = false;
+
+            if ( this.column != -1 && jQuery.inArray(this.column, this.scenarioColumnsCache) == -1 ) {
+                this.column = -1;
+                changed = true;
+            }
+
+            var values = jQuery.grep(this.values, function(v) {
+                return jQuery.inArray(v, thisBlock.valueColumnsCache) > -1;
+            });
+            if ( values.length != this.values.length ) {
+                this.values = values;
+                changed = true;
             }
+
+            return changed;
+        },
+
+        complete: function() {
+            return this.column != -1 && !isNaN(parseFloat(this.threshold));
         }
     }),
 
     /**
-     * The value filter block allows certain filters to be specified that will
-     * remove rows from the data.
+     * The comparison block tests whether two values of a scenario column
+     * (for example two builds) differ significantly within each group.
      */
-    ValueFilterBlock: Block.extend({
+    ComparisonBlock: Block.extend({
         /**
          ** Static fields
          **/
 
         /**
-         * The ID of the template for this filter
+         * The ID of the template for this block
          */
-        TEMPLATE_ID: "#pipeline-valuefilter-template",
+        TEMPLATE_ID: "#pipeline-comparison-template",
 
         /**
          * The ID of this block for encoding (the inverse of the mapping in
          * Pipeline.encoder.MAPPINGS)
          */
-        ID: 5,
+        ID: 'b',
 
         /**
-         * The type of filter
+         * The statistical test to use
          */
         TYPE: {
-            IS: 1,
-            IS_NOT: 2
+            WELCH: 1,
+            MANN_WHITNEY: 2
         },
-        
+
         /**
          ** Object fields
          **/
 
         /**
-         * The currently valid filters
+         * The scenario column whose values are compared
          */
-        filters: null,
-        
+        column: -1,
+
         /**
-         * The options table for selecting filters
+         * The value of the column to compare against
          */
-        optionsTable: null,
-        
+        baseline: -1,
+
+        /**
+         * The value of the column being compared
+         */
+        candidate: -1,
+
+        /**
+         * The type of test to use
+         */
+        type: null,
+
         /**
          ** Object methods
          **/
@@ -1629,70 +2606,48 @@ var Blocks = {
          */
         constructor: function(insertIndex) {
             this.base(insertIndex);
-            this.filters = [{column: -1, is: 1, lowerbound: '-inf', upperbound: '+inf'}];
-            
-            // Create a closure to use as the callback for removing objects.
-            // This way, the scope of this block is maintained.
+            this.type = this.TYPE.WELCH;
+
+            // Hook the dropdowns
             var thisBlock = this;
-            var removeClosure = function(row) {
-                thisBlock.removeFilter.call(thisBlock, row); 
-            };
-            var addClosure = function(row, i) {
-                thisBlock.filters.splice(i, 0, {column: -1, is: 1, lowerbound: '-inf', upperbound: '+inf'});
-                thisBlock.loadState();
-            };
-            
-            // Create the option table
-            this.optionsTable = new OptionsTable($('.pipeline-valuefilter-table', this.element), removeClosure, Pipeline.refresh, addClosure);
-            
-            // Hook the dropdowns and text inputs
-            $(this.element).delegate('select, input', 'change', function() {
+            $(this.element).delegate('select', 'change', function() {
                 thisBlock.readState();
-                Pipeline.refresh();
+                thisBlock.loadState();
+                if ( thisBlock.complete() ) Pipeline.refresh();
             });
         },
-        
+
         /**
-        * Decode a parameter string and set this block's configuration according
-        * to those parameters.
+         * Decode a parameter string and set this block's configuration according
+         * to those parameters.
          */
         decode: function(params) {
-            this.filters = [];
             var parts = params.split(Pipeline.encoder.GROUP_SEPARATOR);
-            // There must be at least two - a flagword and one filter
-            if ( parts.length < 2 ) {
-                console.debug("ValueFilter block invalid: not enough parts");
+            // Exactly 2 parts - flagword and settings
+            if ( parts.length != 2 ) {
+                console.debug("Comparison block invalid: incorrect number of parts");
                 return;
             }
 
             this.flags = parseInt(parts[0]);
 
-            var filts = parts.slice(1);
-            var thisBlock = this;
-            jQuery.each(filts, function(i ,filter) {
-                var settings = filter.split(Pipeline.encoder.PARAM_SEPARATOR);
-                // Exactly four parts - column, is, lowerbound, upperbound
-                if ( settings.length != 4 ) {
-                    console.debug("ValueFilter invalid: not enough parts in ", filter);
-                }
-                thisBlock.filters.push({column: settings[0], is: settings[1], lowerbound: settings[2], upperbound: settings[3]});
-            });
+            var settings = parts[1].split(Pipeline.encoder.PARAM_SEPARATOR);
+            if ( settings.length != 4 ) {
+                console.debug("Comparison block invalid: incorrect number of settings");
+                return;
+            }
+            this.type = settings[0];
+            this.column = settings[1];
+            this.baseline = settings[2];
+            this.candidate = settings[3];
         },
-        
+
         /**
          * Encode this block into a parameter string based on its configuration.
          */
         encode: function() {
-            var strs = [this.flags];
-            jQuery.each(this.filters, function(i, filter) {
-                if ( filter.scenario != -1 ) {
-                    strs.push(filter.column + Pipeline.encoder.PARAM_SEPARATOR
-                              + filter.is + Pipeline.encoder.PARAM_SEPARATOR
-                              + filter.lowerbound + Pipeline.encoder.PARAM_SEPARATOR
-                              + filter.upperbound);
-                }
-            });
-            return strs.join(Pipeline.encoder.GROUP_SEPARATOR);
+            return this.flags + Pipeline.encoder.GROUP_SEPARATOR
+                   + [this.type, this.column, this.baseline, this.candidate].join(Pipeline.encoder.PARAM_SEPARATOR);
         },
 
         /**
@@ -1700,21 +2655,18 @@ var Blocks = {
          * configuration.
          */
         readState: function() {
-            this.filters = [];
-            var thisBlock = this;
-            $('tr', this.element).each(function() {
-                var columnSelect = $('.select-valuefilter-column', this);
-                var isSelect = $('.select-valuefilter-is', this);
-                var lowerboundText = $('.text-valuefilter-lowerbound', this);
-                var upperboundText = $('.text-valuefilter-upperbound', this);
-
-                thisBlock.filters.push({
-                    column: columnSelect.val(),
-                    is: isSelect.val(),
-                    lowerbound: lowerboundText.val(),
-                    upperbound: upperboundText.val()
-                });
-            });
+            var column = $('.select-comparison-column', this.element).val();
+            this.type = $('.select-comparison-type', this.element).val();
+            if ( column != this.column ) {
+                // The values of the old column no longer apply
+                this.column = column;
+                this.baseline = -1;
+                this.candidate = -1;
+            }
+            else {
+                this.baseline = $('.select-comparison-baseline', this.element).val();
+                this.candidate = $('.select-comparison-candidate', this.element).val();
+            }
         },
 
         /**
@@ -1722,96 +2674,47 @@ var Blocks = {
          * HTML.
          */
         loadState: function() {
-            var thisBlock = this;
+            var scenarioSelect = $('.select-comparison-column', this.element);
+            var baselineSelect = $('.select-comparison-baseline', this.element);
+            var candidateSelect = $('.select-comparison-candidate', this.element);
 
-            // Get rid of all but the first row
-            this.optionsTable.reset();
-            
-            // Update the value columns
-            $('.select-valuefilter-column', this.element).each(function() {
-                Utilities.updateSelect(this, thisBlock.valueDisplayCache, thisBlock.valueColumnsCache, true);
-            });
+            Utilities.updateSelect(scenarioSelect, this.scenarioColumnsCache, this.scenarioColumnsCache);
+            $('.select-comparison-type', this.element).val(this.type);
+            scenarioSelect.val(this.column);
 
-            // Create new rows for each filter
-            var thisBlock = this;
-            jQuery.each(this.filters, function(i, filter) {
-                var row = thisBlock.optionsTable.addRow();
-                var columnSelect = $('.select-valuefilter-column', row);
-                var isSelect = $('.select-valuefilter-is', row);
-                var lowerboundText = $('.text-valuefilter-lowerbound', row);
-                var upperboundText = $('.text-valuefilter-upperbound', row);
-                
-                // Note here we assume the scenario dropdown has already been
-                // updated, and the value cache is also up to date with new
-                // logs.
-                columnSelect.val(filter.column);
-                isSelect.val(filter.is);
-                lowerboundText.val(filter.lowerbound);
-                upperboundText.val(filter.upperbound);
-            });
+            if ( this.column == -1 ) {
+                Utilities.updateSelect(baselineSelect, [], []);
+                Utilities.updateSelect(candidateSelect, [], []);
+            }
+            else {
+                Utilities.updateSelect(baselineSelect, this.scenarioDisplayCache[this.column], this.scenarioValuesCache[this.column]);
+                Utilities.updateSelect(candidateSelect, this.scenarioDisplayCache[this.column], this.scenarioValuesCache[this.column]);
+            }
+            baselineSelect.val(this.baseline);
+            candidateSelect.val(this.candidate);
         },
-        
+
         refreshColumns: function() {
-            var thisBlock = this;
+            if ( this.column != -1 && jQuery.inArray(this.column, this.scenarioColumnsCache) == -1 ) {
+                this.column = -1;
+                this.baseline = -1;
+                this.candidate = -1;
+                return true;
+            }
             var changed = false;
-            
-            jQuery.each(this.filters, function(i, filter) {
-                // If the selected scenario isn't in the new available ones,
-                // reset this row
-                if ( filter.column != -1 && jQuery.inArray(filter.column, thisBlock.valueColumnsCache) == -1 ) {
-                    filter.column = -1;
-                    changed = true;
-                    return;
-                }
-            });
-            
+            if ( this.baseline != -1 && jQuery.inArray(this.baseline, this.scenarioValuesCache[this.column]) == -1 ) {
+                this.baseline = -1;
+                changed = true;
+            }
+            if ( this.candidate != -1 && jQuery.inArray(this.candidate, this.scenarioValuesCache[this.column]) == -1 ) {
+                this.candidate = -1;
+                changed = true;
+            }
             return changed;
         },
 
         complete: function() {
-            var valid = true;
-            jQuery.each(this.filters, function(i, filter) {
-                if ( filter.column == -1 ) {
-                    valid = false;
-                }
-            });
-
-            return valid;
-        },
-        
-        /**
-         * A row is about to be removed from the OptionsTable. We need to
-         * clean it up here.
-         *
-         * @param row Element The table row to be removed
-         */
-        removeFilter: function(row) {
-            var value = this.filterValue(row);
-            
-            for ( var i = 0; i < this.filters.length; i++ ) {
-                if ( this.filters[i].scenario == value.scenario
-                     && this.filters[i].is == value.is
-                     && this.filters[i].value == value.value ) {
-                    this.filters.splice(i, 1);
-                    break;
-                }
-            }
-        },
-        
-        /**
-         * Turns a <tr> in the OptionsTable into a dictionary
-         *
-         * @param row Element The table row to gather values from
-         * @return dict|boolean The values in the given row, or false if
-         *   the selection is incomplete
-         */
-        filterValue: function(row) {
-            var column     = $('.select-valuefilter-column', row).val();
-            var is         = $('.select-valuefilter-is', row).val();
-            var lowerbound = $('.text-valuefilter-lowerbound', row).val();
-            var upperbound = $('.text-valuefilter-upperbound', row).val();
-            
-            return {column: column, is: is, lowerbound: lowerbound, upperbound: upperbound};
+            return this.column != -1 && this.baseline != -1 && this.candidate != -1;
         }
     }),
 
@@ -2566,7 +3469,8 @@ var Pipeline = {
      * Possible flags; ORed onto Pipeline.flags
      */
     FLAGS: {
-        NOTHING: 0 // not a real flag, just for demonstration
+        NOTHING: 0, // not a real flag, just for demonstration
+        PREVIEW: 1 << 0 // run the pipeline over a sample of the rows
     },
     
     /**
@@ -2587,7 +3491,11 @@ var Pipeline = {
             4: Blocks.GraphBlock,
             5: Blocks.ValueFilterBlock,
             6: Blocks.CompositeScenarioBlock,
-            7: Blocks.FormatBlock
+            7: Blocks.FormatBlock,
+            8: Blocks.SortBlock,
+            9: Blocks.SampleBlock,
+            a: Blocks.OutlierBlock,
+            b: Blocks.ComparisonBlock
         }
     },
     
@@ -2824,6 +3732,24 @@ var Pipeline = {
         $('#add-format').click(function() {
             Pipeline.createBlock(Blocks.FormatBlock);
         });
+        $('#add-sort').click(function() {
+            Pipeline.createBlock(Blocks.SortBlock);
+        });
+        $('#add-sample').click(function() {
+            Pipeline.createBlock(Blocks.SampleBlock);
+        });
+        $('#add-outlier').click(function() {
+            Pipeline.createBlock(Blocks.OutlierBlock);
+        });
+        $('#add-comparison').click(function() {
+            Pipeline.createBlock(Blocks.ComparisonBlock);
+        });
+
+        // Hook the preview checkbox
+        $('#preview-sample').change(function() {
+            Pipeline.setFlag(Pipeline.FLAGS.PREVIEW, $(this).is(':checked'));
+            Pipeline.refresh();
+        });
 
         // Hook the button for showing large tables
         $('#load-large-table').click(function() {
@@ -3069,6 +3995,22 @@ var Pipeline = {
             $(this).parents("#pipeline-insert").remove();
             Pipeline.createBlock(Blocks.FormatBlock, block);
         });
+        $('#insert-sort', addBlock).click(function() {
+            $(this).parents("#pipeline-insert").remove();
+            Pipeline.createBlock(Blocks.SortBlock, block);
+        });
+        $('#insert-sample', addBlock).click(function() {
+            $(this).parents("#pipeline-insert").remove();
+            Pipeline.createBlock(Blocks.SampleBlock, block);
+        });
+        $('#insert-outlier', addBlock).click(function() {
+            $(this).parents("#pipeline-insert").remove();
+            Pipeline.createBlock(Blocks.OutlierBlock, block);
+        });
+        $('#insert-comparison', addBlock).click(function() {
+            $(this).parents("#pipeline-insert").remove();
+            Pipeline.createBlock(Blocks.ComparisonBlock, block);
+        });
         addBlock.append('<div class="pipeline-footer"></div>');
         $('.pipeline-header', addBlock).html("<img src='static/brick_add.png'/> Insert Block");
         $('.pipeline-header-right', addBlock).html('<input type="image" class="remove-button" src="static/cross.png"/>');
@@ -3275,6 +4217,9 @@ var Pipeline = {
                     $('#large-table-confirm').hide();
                     Utilities.outputTableSort();
                 }
+                if (data.timings && data.timings.length > 0) {
+                    output.append(Utilities.makeFoldable('Timing', Utilities.makeTimingTable(data.timings), false, false));
+                }
                 output.show();
                 if (data.graphs && data.graphs.length > 0) {
                     reformatGraphs(graphs);
@@ -3683,6 +4628,11 @@ var Pipeline = {
     setFlags: function(flags) {
         Pipeline.flags = parseInt(flags);
         // Update the UI
+        if ( Pipeline.getFlag(Pipeline.FLAGS.PREVIEW) ) {
+            $('#preview-sample').attr('checked', 'checked');
+        } else {
+            $('#preview-sample').removeAttr('checked');
+        }
     },
 
     /**
@@ -3706,7 +4656,7 @@ var Pipeline = {
      * @return boolean true if the flag is on, false if off
      */
     getFlag: function(flag) {
-        return (Pipeline.flags & flag) == 0;
+        return (Pipeline.flags & flag) != 0;
     },
 
     /**
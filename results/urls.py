@@ -11,6 +11,7 @@ urlpatterns = patterns('plotty.results',
     (r'^ajax/log-values/(?P<logs>.*)/$', 'views_ajax.log_values'),    
     (r'^ajax/filter-values/(?P<logs>.*)/(?P<col>.*)/$', 'views_ajax.filter_values'),
     (r'^ajax/pipeline/(?P<pipeline>.*)$', 'views_ajax.pipeline'),
+    (r'^ajax/explain/(?P<pipeline>.*)$', 'views_ajax.explain'),
     (r'^ajax/save-pipeline/$', 'views_ajax.save_pipeline'),
     (r'^ajax/delete-pipeline/$', 'views_ajax.delete_saved_pipeline'),
     (r'^ajax/create-shorturl/$', 'views_ajax.create_shorturl'),
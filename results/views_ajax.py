@@ -98,7 +98,33 @@ def pipeline(request, pipeline):
                                     'warn_html': msg_output,
                                     'table_html': table_output,
                                     'rows': len(dt.rows),
-                                    'graphs': graph_outputs}))
+                                    'graphs': graph_outputs,
+                                    'timings': p.trace}))
+
+def explain(request, pipeline):
+    """ Explains where the time in a pipeline goes. By default this is a dry
+        run, which estimates the effect of each block that isn't cached from
+        the statistics of the table it starts from. With ?execute=1, the
+        pipeline is run, and what actually happened is reported. """
+    execute = request.GET.get('execute', '0') == '1'
+    p = Pipeline(web_client=True)
+    try:
+        p.decode(pipeline)
+        if execute:
+            p.apply()
+        else:
+            p.explain()
+    except LogTabulateStarted as e:
+        return HttpResponse(json.dumps({'tabulating': True, 'log': e.log, 'pid': e.pid, 'index': e.index, 'total': e.length}))
+    except (PipelineBlockException, PipelineLoadException) as e:
+        return HttpResponse(json.dumps({'error': True, 'index': getattr(e, 'block', None), 'message': e.msg, 'traceback': e.traceback, 'blocks': p.trace}))
+    except (PipelineError, PipelineAmbiguityException) as e:
+        return HttpResponse(json.dumps({'error': True, 'ambiguity': isinstance(e, PipelineAmbiguityException), 'index': e.block, 'message': e.msg, 'blocks': p.trace}))
+
+    return HttpResponse(json.dumps({'error': False,
+                                    'execute': execute,
+                                    'cache_index': p.cacheAvailableIndex,
+                                    'blocks': p.trace}))
 
 def delete_saved_pipeline(request):
     if 'name' not in request.POST:
@@ -26,9 +26,38 @@ CACHE_ROOT = os.path.join(ROOT_DIR, 'cache')
 # 7 days; this is really redundant since we store timeouts for our cache items anyway
 CACHE_TIMEOUT = 7*24*60*60
 CACHE_MAX_ENTRIES = 300
-CACHE_CULL_FRACTION = 2 # delete 1/CACHE_CULL_FRACTION entries when max entries reached
-CACHE_OPTIONS = 'timeout=%d&max_entries=%d&cull_frequency=%d' % (CACHE_TIMEOUT, CACHE_MAX_ENTRIES, CACHE_CULL_FRACTION)
+CACHE_CULL_FRACTION = 2 # delete 1/CACHE_CULL_FRACTION entries when max entries or size reached
+CACHE_MAX_SIZE = 4*1024*1024*1024 # bytes; 0 for no limit
+# Each second an entry took to compute keeps it in the cache as long as this
+# many seconds of recency would; 0 culls least recently used entries first
+CACHE_COST_WEIGHT = 60*60
+CACHE_MEMORY_SIZE = 256*1024*1024 # bytes of recently used entries kept unpickled by each process
+# How cache values are compressed: 'none', 'zlib' or 'bz2', and the level
+# to compress at (0-9 for zlib, 1-9 for bz2; others are clamped to these).
+# cache-benchmark.py compares them on real pipelines.
+CACHE_CODEC = 'none'
+CACHE_LEVEL = 6
+CACHE_OPTIONS = 'timeout=%d&max_entries=%d&cull_frequency=%d&max_size=%d&cost_weight=%d&memory_size=%d&codec=%s&level=%d' % (CACHE_TIMEOUT, CACHE_MAX_ENTRIES, CACHE_CULL_FRACTION, CACHE_MAX_SIZE, CACHE_COST_WEIGHT, CACHE_MEMORY_SIZE, CACHE_CODEC, CACHE_LEVEL)
 CACHE_BACKEND = "plotty.results.Cache://%s?%s" % (os.path.join(ROOT_DIR, 'cache/log'), CACHE_OPTIONS)
+# The result of part of a pipeline is only cached if computing it (from the
+# last part that was cached) took at least this many times as long as writing
+# it to the cache is expected to; 0 caches the result of every block
+CACHE_CHECKPOINT_RATIO = 1.0
+# Seconds to wait for another process applying the same pipeline before
+# applying it anyway
+PIPELINE_LOCK_TIMEOUT = 2*60
+# The number of rows kept when a pipeline is run in preview mode, and the seed
+# used to pick them (fixed so that previews can be cached)
+PREVIEW_ROWS = 1000
+PREVIEW_SEED = 0
+# Bootstrap confidence intervals are seeded so that they are reproducible.
+# They are computed in the process serving the request unless
+# BOOTSTRAP_PROCESSES is more than 1, in which case an aggregate with enough
+# groups forks a pool of that many processes; only do that where forking the
+# server is safe
+BOOTSTRAP_SEED = 0
+BOOTSTRAP_PROCESSES = 1
+BOOTSTRAP_POOL_MIN_GROUPS = 200
 
 GNUPLOT_EXECUTABLE = 'gnuplot'
 if IS_SQUIRREL: